@@ -0,0 +1,243 @@
+from gcode import GProgram
+from itertools import islice
+from math import sqrt, atan2, cos, sin, pi
+
+class Analysis(object):
+    '''Results of analyzing a program
+
+    Positions and distances are in mm, in the coordinate system active at the
+    start of the program, which is assumed to start at its origin. G92 offsets
+    are followed, while moves after G28, G30 or G53 only count once all axes
+    are known again.
+    '''
+    def __init__(self):
+        self.statements = 0
+        self.metric = None
+        self.mixed_units = False
+        self.envelope = {}
+        self.feedrates = []
+        self.cut_distance = 0.0
+        self.rapid_distance = 0.0
+        self.unknown_moves = 0
+        self.counts = {}
+
+    @property
+    def units(self):
+        if self.mixed_units:
+            return 'mixed'
+        if self.metric is None:
+            return None
+        return 'mm' if self.metric else 'inch'
+
+
+class Analyzer(object):
+    'Follows the modal state through a program in a single pass, collecting an Analysis'
+    axes = ('X', 'Y', 'Z')
+    # Plane: (first axis, second axis, linear axis), and the matching arc offset words
+    planes = {17: ((0, 1, 2), ('I', 'J')),
+              18: ((2, 0, 1), ('K', 'I')),
+              19: ((1, 2, 0), ('J', 'K'))}
+    moves = (0, 1, 2, 3, 38.2)
+    homing = (28, 30, 53)
+
+    def __init__(self):
+        self.result = Analysis()
+        self.scale = 1.0
+        self.absolute = True
+        self.motion = None
+        self.plane = 17
+        self.system = 54
+        self.position = [0.0, 0.0, 0.0]
+        self.offset = [0.0, 0.0, 0.0]
+        self.moved = False
+        self.feed = None
+        self.feedrates = set()
+        self.low = [None, None, None]
+        self.high = [None, None, None]
+
+    def include(self, point):
+        low, high = self.low, self.high
+        for i in range(3):
+            value = point[i]
+            if low[i] is None or value < low[i]:
+                low[i] = value
+            if high[i] is None or value > high[i]:
+                high[i] = value
+
+    def analyze(self, program):
+        if not isinstance(program, GProgram):
+            program = GProgram(program)
+
+        addresses, values, floats, counts = program.addresses, program.values, program.floats, self.result.counts
+        letters = [chr(i) for i in range(256)]
+        start = 0
+        for end in islice(program.offsets, 1, None):
+            words, gcodes, mcodes = {}, [], []
+            for i in range(start, end):
+                address = letters[addresses[i]]
+                value = values[i] if floats[i] else int(values[i])
+                if addresses[i] == GProgram.comment:
+                    name = 'comment'
+                elif addresses[i] == GProgram.filemark:
+                    name = 'filemark'
+                elif address in 'GM':
+                    name = '%s%s' % (address, value)
+                    if address == 'G':
+                        gcodes.append(value)
+                    else:
+                        mcodes.append(value)
+                else:
+                    name = address
+                    words[address] = value
+                counts[name] = counts.get(name, 0) + 1
+            self.statement(words, gcodes, mcodes)
+            start = end
+
+        result = self.result
+        result.statements = len(program)
+        result.feedrates = sorted(self.feedrates)
+        if self.low[0] is not None:
+            result.envelope = dict(zip(self.axes, zip(self.low, self.high)))
+        return result
+
+    def follow(self, statement):
+        'Follows a single GStatement, for when statements arrive one at a time'
+        words, gcodes, mcodes = {}, [], []
+        for code in statement:
+            if code.type != 'code':
+                continue
+            if code.address == 'G':
+                gcodes.append(code.command)
+            elif code.address == 'M':
+                mcodes.append(code.command)
+            else:
+                words[code.address] = code.command
+        self.statement(words, gcodes, mcodes)
+
+    def statement(self, words, gcodes, mcodes):
+        nonmodal = None
+        for command in gcodes:
+            if command in self.moves:
+                self.motion = command
+            elif command == 80:
+                self.motion = None
+            elif command in (17, 18, 19):
+                self.plane = command
+            elif command in (20, 21):
+                metric = command == 21
+                if self.result.metric is None or not self.moved:
+                    self.result.metric = metric
+                elif metric != self.result.metric:
+                    self.result.mixed_units = True
+                self.scale = 1.0 if metric else 25.4
+            elif command == 90:
+                self.absolute = True
+            elif command == 91:
+                self.absolute = False
+            elif 54 <= command <= 59:
+                self.system = command
+            elif command in (10, 28, 28.1, 30, 30.1, 53, 92, 92.1):
+                nonmodal = command
+
+        if 'F' in words:
+            self.feedrates.add(words['F'])
+            self.feed = words['F'] * self.scale
+
+        present = [axis in words for axis in self.axes]
+        if nonmodal == 92:
+            for i, axis in enumerate(self.axes):
+                if present[i] and self.position[i] is not None:
+                    self.offset[i] = self.position[i] - words[axis] * self.scale
+            return
+        elif nonmodal == 92.1:
+            self.offset = [0.0, 0.0, 0.0]
+            return
+        elif nonmodal in self.homing:
+            # The machine position of the work origin is not known
+            for i in range(3):
+                if present[i] or nonmodal != 53:
+                    self.position[i] = None
+            return
+        elif nonmodal is not None or True not in present or self.motion is None:
+            return
+
+        target = []
+        for i, axis in enumerate(self.axes):
+            cur = self.position[i]
+            if not present[i]:
+                target.append(cur)
+            elif self.absolute:
+                target.append(words[axis] * self.scale + self.offset[i])
+            elif cur is not None:
+                target.append(cur + words[axis] * self.scale)
+            else:
+                target.append(None)
+
+        self.moved = True
+        if None in self.position or None in target:
+            self.result.unknown_moves += 1
+        elif self.motion in (2, 3):
+            self.arc(self.position, target, words)
+        else:
+            self.line(self.position, target)
+        self.position = target
+
+    def line(self, start, end):
+        x, y, z = start
+        d = sqrt((end[0] - x) ** 2 + (end[1] - y) ** 2 + (end[2] - z) ** 2)
+        if self.motion == 0:
+            self.result.rapid_distance += d
+        else:
+            self.result.cut_distance += d
+        self.include(start)
+        self.include(end)
+
+    def arc(self, start, end, words):
+        'Returns the center, radius, start angle and sweep of the arc, or None if it is invalid'
+        (a0, a1, linear), offsets = self.planes[self.plane]
+        x, y = end[a0] - start[a0], end[a1] - start[a1]
+        if 'R' in words:
+            r = words['R'] * self.scale
+            h = 4 * r * r - x * x - y * y
+            if h < 0 or (x == 0 and y == 0):
+                self.result.unknown_moves += 1
+                return None
+            h = -sqrt(h) / sqrt(x * x + y * y)
+            if self.motion == 3:
+                h = -h
+            if r < 0:
+                h = -h
+            i, j = 0.5 * (x - y * h), 0.5 * (y + x * h)
+        else:
+            i, j = words.get(offsets[0], 0) * self.scale, words.get(offsets[1], 0) * self.scale
+
+        c0, c1 = start[a0] + i, start[a1] + j
+        radius = sqrt(i * i + j * j)
+        begin = atan2(-j, -i)
+        sweep = atan2(end[a1] - c1, end[a0] - c0) - begin
+        if self.motion == 2:
+            sweep = -sweep
+        sweep %= 2 * pi
+        if sweep < 1e-9:
+            # Same start and end point is a full circle
+            sweep = 2 * pi
+
+        helix = end[linear] - start[linear]
+        self.result.cut_distance += sqrt((radius * sweep) ** 2 + helix * helix)
+        self.include(start)
+        self.include(end)
+
+        # The extremes of the arc are where it crosses the plane axes
+        direction = 1 if self.motion == 3 else -1
+        for k in range(4):
+            angle = k * pi / 2
+            if (direction * (angle - begin)) % (2 * pi) <= sweep:
+                point = list(start)
+                point[a0] = c0 + radius * cos(angle)
+                point[a1] = c1 + radius * sin(angle)
+                self.include(point)
+        return c0, c1, radius, begin, sweep
+
+
+def analyze(program):
+    return Analyzer().analyze(program)
@@ -0,0 +1,189 @@
+from gcode import GProgram, GWireImage, GSerializer, GCodeParser
+from optimizer import *
+from cnc import CNC
+from collections import deque
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+def corpus_easel(rng):
+    'Verbose output, every word on every line, like Easel produces'
+    yield '%\nG21\nG90\nM3 S12000\n'
+    x, y, z = 0.0, 0.0, 5.0
+    while True:
+        if rng.random() < 0.05:
+            z = 5.0 if z < 0 else -rng.choice((0.5, 1.0, 1.5))
+            yield 'G1 X%.4f Y%.4f Z%.4f F%.4f\n' % (x, y, z, 228.6)
+        x = max(0.0, min(300.0, x + rng.uniform(-2, 2)))
+        y = max(0.0, min(300.0, y + rng.uniform(-2, 2)))
+        yield 'G1 X%.4f Y%.4f Z%.4f F%.4f\n' % (x, y, z, 800.0)
+
+def corpus_contour(rng):
+    'Dense 3D surfacing, short moves changing all three axes'
+    yield 'G21 G90 G17\nG0 Z5\nG0 X0 Y0\nG1 Z0 F600\n'
+    x, y = 0.0, 0.0
+    while True:
+        x += 0.05
+        if x > 100:
+            x, y = 0.0, y + 0.2
+            yield 'G0 Z5\nG0 X0 Y%.3f\nG1 Z0\n' % y
+        yield 'X%.3f Y%.3f Z%.3f\n' % (x, y, -2 + 1.5 * rng.random() * rng.random())
+
+def corpus_arcs(rng):
+    'Pocketing made of arcs in both directions'
+    yield 'G21 G90 G17\nG0 Z5\nG0 X10 Y0\nG1 Z-1 F500\n'
+    while True:
+        r = rng.uniform(1, 20)
+        yield 'G0 X%.3f Y0\n' % r
+        yield 'G3 X%.3f Y0 I%.3f J0\n' % (-r, -r)
+        yield 'G2 X%.3f Y0 I%.3f J0\n' % (r, r)
+        yield 'G1 X%.3f Y%.3f\n' % (rng.uniform(0, 5), rng.uniform(0, 5))
+
+def corpus_comments(rng):
+    'Post processor chatter, with comments on their own lines and after moves'
+    yield '%\n(Generated by some CAM package)\n(Tool: 1/8in flat end mill)\nG21 G90\n'
+    n = 0
+    while True:
+        n += 1
+        if n % 20 == 0:
+            yield '(Operation %d: contour, stepdown %.2f)\n' % (n, rng.uniform(0.1, 1))
+        yield 'G1 X%.3f Y%.3f (move %d)\n' % (rng.uniform(0, 100), rng.uniform(0, 100), n)
+
+corpora = {'easel': corpus_easel,
+           'contour': corpus_contour,
+           'arcs': corpus_arcs,
+           'comments': corpus_comments}
+
+def generate(name, size, fileobj, seed=0):
+    'Writes lines of a corpus until size bytes have been written'
+    written = 0
+    for chunk in corpora[name](random.Random(seed)):
+        fileobj.write(chunk.encode('ascii'))
+        written += len(chunk)
+        if written >= size:
+            break
+    return written
+
+def parse_size(s):
+    'Parses sizes like 1KB, 10MB or 1GB'
+    s = s.upper().rstrip('B')
+    for suffix, factor in (('K', 1024), ('M', 1024 ** 2), ('G', 1024 ** 3)):
+        if s.endswith(suffix):
+            return int(float(s[:-1]) * factor)
+    return int(s)
+
+class LoopbackSerial(object):
+    'Serial stand-in that acknowledges every line at once, so only the sender is measured'
+    def __init__(self):
+        self.responses = deque()
+        self.written = 0
+
+    @property
+    def in_waiting(self):
+        return len(self.responses) * 4
+
+    def write(self, data):
+        self.written += len(data)
+        for i in range(bytearray(data).count(b'\n')):
+            self.responses.append(b'ok\r\n')
+
+    def read(self, n=1):
+        data = b''
+        while self.responses and len(data) < n:
+            data += self.responses.popleft()
+        return data
+
+# The parse options benchmarked, with every optional pass on
+options = {'tolerance': 0.01, 'arcs': 0.01, 'reorder': True, 'hops': 1.0, 'stock_top': 0.5}
+
+def passes():
+    return make_passes(**options)
+
+class Bench(object):
+    '''Times every stage from parsing to sending on one corpus
+
+    Stages run one after the other on fully materialized programs, so each
+    can be timed on its own. Byte counts are those of the program written
+    out with str(), measured outside of the timed sections.
+    '''
+    def __init__(self, name, size, directory=None):
+        self.name = name
+        self.size = size
+        self.directory = directory
+        self.stages = []
+
+    def record(self, stage, seconds, input_bytes, output_bytes, statements):
+        self.stages.append({'stage': stage,
+                            'seconds': seconds,
+                            'input_bytes': input_bytes,
+                            'output_bytes': output_bytes,
+                            'statements': statements,
+                            'mb_per_s': input_bytes / seconds / 1e6 if seconds else None,
+                            'statements_per_s': statements / seconds if seconds else None,
+                            'peak_memory': peak_memory()})
+
+    def run(self):
+        fd, path = tempfile.mkstemp(suffix='.nc', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                size = generate(self.name, self.size, f)
+
+            start = time.time()
+            program = GProgram()
+            with open(path, 'rb') as f:
+                program.extend(GCodeParser().iter_parse(f))
+            seconds = time.time() - start
+            nbytes = len(GWireImage(program).data)
+            self.record('parse', seconds, size, nbytes, len(program))
+        finally:
+            os.remove(path)
+
+        for optimizer in passes():
+            start = time.time()
+            program = GProgram(optimizer.iter_optimize(iter(program)))
+            seconds = time.time() - start
+            output = len(GWireImage(program).data)
+            self.record(type(optimizer).__name__, seconds, nbytes, output, len(program))
+            nbytes = output
+
+        start = time.time()
+        wire = GWireImage(program)
+        self.record('stringify', time.time() - start, nbytes, len(wire.data), len(program))
+
+        start = time.time()
+        compact = GWireImage(program, GSerializer())
+        self.record('serialize', time.time() - start, nbytes, len(compact.data), len(program))
+
+        cnc = CNC(None, 115200)
+        cnc.serial = LoopbackSerial()
+        cnc.add_program(compact)
+        start = time.time()
+        cnc.send_queue()
+        self.record('send', time.time() - start, len(compact.data), cnc.serial.written, len(compact))
+
+        return {'corpus': self.name, 'size': size, 'stages': self.stages}
+
+def run(names, sizes, directory=None, version=None):
+    results = []
+    for name in names:
+        for size in sizes:
+            results.append(Bench(name, size, directory).run())
+    return {'version': version,
+            'options': options,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'results': results}
+
+def dump(report, fileobj):
+    json.dump(report, fileobj, indent=2, sort_keys=True)
+    fileobj.write('\n')
+
+if __name__ == '__main__':
+    names = sys.argv[1].split(',') if len(sys.argv) > 1 else sorted(corpora)
+    sizes = [parse_size(s) for s in sys.argv[2].split(',')] if len(sys.argv) > 2 else [1024 ** 2]
+    dump(run(names, sizes), sys.stdout)
@@ -0,0 +1,109 @@
+from gcode import GProgram
+import gcode
+import optimizer
+import hashlib
+import os
+import tempfile
+
+def default_path():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pycnc')
+
+def revision(modules=(gcode, optimizer)):
+    'Hashes the source of the parser and optimizer, which decide what a job optimizes to'
+    h = hashlib.sha256()
+    for module in modules:
+        with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+class JobCache(object):
+    '''On-disk cache of optimized programs, keyed by content
+
+    Keys hash the input bytes together with everything that affects the
+    output: the revision of the parser and optimizer sources, the parser and
+    the optimizer passes and their options. Programs are stored with GProgram.dump. Hits refresh the file
+    modification time, and the least recently used entries are removed once
+    the cache grows beyond max_size bytes.
+
+    Any error reading or writing the cache is treated as a miss.
+    '''
+    suffix = '.job'
+
+    def __init__(self, path=None, max_size=256 * 1024 * 1024):
+        self.path = path or default_path()
+        self.max_size = max_size
+        self.revision = revision()
+
+    def key(self, source, *options):
+        '''Hashes a file object and options. Returns None if the file cannot be
+        rewound afterwards, e.g. a pipe'''
+        try:
+            start = source.tell()
+        except (IOError, OSError, ValueError):
+            return None
+
+        h = hashlib.sha256()
+        h.update(self.revision.encode('ascii'))
+        h.update(repr(options).encode('utf-8'))
+        while True:
+            data = source.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data if isinstance(data, bytes) else data.encode('utf-8'))
+        source.seek(start)
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + self.suffix)
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                program = GProgram.load(f)
+            os.utime(filename, None)
+            return program
+        except Exception:
+            return None
+
+    def put(self, key, program):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+        except (IOError, OSError):
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                program.dump(f)
+            os.rename(tmp, self.filename(key))
+            self.evict()
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            st = os.stat(os.path.join(self.path, name))
+            entries.append((st.st_mtime, st.st_size, name))
+
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def iter_store(self, key, statements):
+        'Passes statements through, storing them once all have been consumed'
+        program = GProgram()
+        for statement in statements:
+            program.append(statement)
+            yield statement
+        self.put(key, program)
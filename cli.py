@@ -1,22 +1,66 @@
 from __future__ import print_function
 
-from gcode import GCode, GStatement, GCodeParser, GManager
-from cnc import CNC
+from gcode import GCode, GStatement, GProgram, GWireImage, GSerializer, GCodeParser, GCodeReferenceParser, GManager
+from cnc import CNC, DuplexCNC
+from cache import JobCache
+from estimator import estimate
+from emulator import Emulator
+import parallel
+from source import MappedView, MappedSource
+from resume import CheckpointIndex
+from telemetry import Telemetry
+import bench
 from optimizer import * # Optimizer, CommentRemover, FileMarkRemover, CodeSaver, EmptyStatementRemover
 
 from progressbar import ProgressBar, ETA, Percentage, Bar
 import click
 
-import sys, signal
+from io import StringIO
+from itertools import chain
+from bisect import bisect_left, bisect_right
+from multiprocessing import Pool
+import sys, os, signal, time, json, glob, tempfile
+
+version = '0.1'
+
+# What files in a directory given to parse count as jobs
+gcode_extensions = ('.nc', '.ngc', '.gcode', '.gc', '.tap', '.g')
+
+class SourceFile(click.File):
+    'Maps regular files into memory, and opens anything else, like - for stdin, as a plain file'
+    def __init__(self):
+        click.File.__init__(self, 'rb')
+
+    def convert(self, value, param, ctx):
+        if hasattr(value, 'read') or value == '-' or not os.path.isfile(value):
+            return click.File.convert(self, value, param, ctx)
+        try:
+            source = MappedSource(value)
+        except (IOError, OSError) as e:
+            self.fail('Could not open file: %s: %s' % (value, e), param, ctx)
+        if ctx is not None:
+            ctx.call_on_close(source.close)
+        return source
 
 @click.group()
-@click.version_option('0.1')
+@click.version_option(version)
 def main():
     signal.signal(signal.SIGWINCH, signal.SIG_IGN)
 
-def make_progressbar(length, prefix=''):
+class StatusLabel(object):
+    'Progress bar widget showing the last status report'
+    def __init__(self):
+        self.status = None
+
+    def update(self, pbar):
+        if self.status is None:
+            return ''
+        pos = self.status.get('WPos', self.status.get('MPos', ()))
+        return '%s %s ' % (self.status['state'], ','.join('%.3f' % i for i in pos))
+
+def make_progressbar(length, prefix='', status=''):
     progressbar = ProgressBar(maxval=length,
-                               widgets=[prefix, Percentage(), ' ', Bar(), ' ', ETA()]).start()
+                               widgets=[prefix, status, Percentage(), ' ', Bar(), ' ', ETA()]).start()
     def update(i):
         progressbar.update(i)
 
@@ -24,98 +68,340 @@ def make_progressbar(length, prefix=''):
         progressbar.finish()
     return (update, complete)
 
-def parse_and_optimize(code, noopt):
-    parser = GCodeParser()
-    code = parser.parse(code)
-    if noopt:
-        return code
-    opt = Optimizer(CommentRemover(),
-                    FileMarkRemover(),
-                    CodeSaver(),
-                    EmptyMoveRemover(),
-                    GrblCleaner(),
-                    FeedratePatcher(),
-                    MPatcher(),
-                    EmptyStatementRemover())
-    return opt.optimize(code)
-
-def generate_stats(codes):
+def parse_and_optimize(source, passes, reference=False, cache=None, jobs=1, profile=None):
+    parser = GCodeReferenceParser() if reference else GCodeParser()
+    if profile is not None:
+        # Cached or parallel jobs would leave nothing to measure
+        optimizer = Optimizer(*passes)
+        optimizer.profile = profile
+        return optimizer.iter_optimize(parser.iter_parse(source))
+
+    key = None
+    if cache is not None:
+        key = cache.key(source, version, type(parser).__name__,
+                        [(type(p).__name__, sorted(vars(p).items())) for p in passes])
+    if key is not None:
+        program = cache.get(key)
+        if program is not None:
+            return program
+
+    path = getattr(source, 'name', None)
+    if jobs > 1 and not reference and path is not None and os.path.isfile(path):
+        program = parallel.parse_and_optimize(path, Optimizer(*passes), jobs)
+        if key is not None:
+            cache.put(key, program)
+        return program
+
+    code = parser.iter_parse(source)
+    if passes:
+        code = Optimizer(*passes).iter_optimize(code)
+    if key is not None:
+        code = cache.iter_store(key, code)
+    return code
+
+def expand_inputs(inputs):
+    '''Files named on the command line. Directories stand for the G-code files
+    in them and patterns for the files they match, leaving out earlier output'''
+    paths = []
+    for name in inputs:
+        if os.path.isdir(name):
+            matches = [os.path.join(name, f) for f in sorted(os.listdir(name))
+                       if os.path.splitext(f)[1].lower() in gcode_extensions]
+        elif os.path.exists(name):
+            paths.append(name)
+            continue
+        else:
+            # Patterns the shell left alone, quoted or too long for it
+            matches = sorted(glob.glob(name))
+        paths.extend(path for path in matches if os.path.isfile(path) and not is_output(path))
+
+    unique, seen = [], set()
+    for path in paths:
+        if os.path.abspath(path) not in seen:
+            seen.add(os.path.abspath(path))
+            unique.append(path)
+    return unique
+
+def is_output(path):
+    return os.path.splitext(os.path.splitext(path)[0])[1] == '.opt'
+
+def output_path(path, outdir):
+    'Where the optimized version of a file goes: in outdir, or next to it as NAME.opt.EXT'
+    if outdir is not None:
+        return os.path.join(outdir, os.path.basename(path))
+    stem, ext = os.path.splitext(path)
+    return stem + '.opt' + ext
+
+def optimize_job(task):
+    '''Optimizes one file of a batch, as parse -o would, in a pool process.
+    Returns the file and output names, their sizes in bytes and lines, the
+    seconds it took, and what went wrong, if anything'''
+    path, output, options = task
+    start = time.time()
+    size, lines = os.path.getsize(path), 0
+    try:
+        with MappedSource(path) as source:
+            lines = source.line_count()
+            passes = make_passes(options['noopt'], options['tolerance'], options['arcs'], options['reorder'],
+                                 options['reverse'], options['hops'], options['stock_top'])
+            codes = parse_and_optimize(source, passes, options['reference'], None if options['nocache'] else JobCache())
+            wire = GWireImage(GProgram([GStatement(GCode('G', 90))]), make_serializer(options['resolution']))
+            wire.extend(codes)
+
+        # Written aside first, so a failure never leaves half a job behind
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                wire.write(f)
+            os.rename(tmp, output)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return path, output, size, lines, os.path.getsize(output), len(wire), time.time() - start, None
+    except Exception as e:
+        return path, output, size, lines, 0, 0, time.time() - start, '%s: %s' % (type(e).__name__, e)
+
+def run_batch(paths, outdir, jobs, options):
+    'Optimizes files on a pool of jobs processes, printing a line per file and a summary'
+    tasks = [(path, output_path(path, outdir), options) for path in paths]
+    outputs = {}
+    for path, output, options in tasks:
+        if os.path.abspath(output) == os.path.abspath(path):
+            print('%s would be overwritten, use another output directory' % path)
+            return -1
+        if os.path.abspath(output) in outputs:
+            print('%s and %s would both be written to %s' % (outputs[os.path.abspath(output)], path, output))
+            return -1
+        outputs[os.path.abspath(output)] = path
+    if outdir is not None and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    # Largest first, so a big file started last does not hold everything up
+    tasks.sort(key=lambda task: -os.path.getsize(task[0]))
+    start = time.time()
+    pool = Pool(min(jobs, len(tasks))) if jobs > 1 and len(tasks) > 1 else None
+    results = []
+    try:
+        for result in pool.imap_unordered(optimize_job, tasks) if pool else (optimize_job(task) for task in tasks):
+            path, output, size, lines, out_size, out_lines, seconds, error = result
+            if error is None:
+                print('%s: %d -> %d bytes, %d -> %d lines, %.1f s' % (output, size, out_size, lines, out_lines, seconds))
+            else:
+                print('%s: failed, %s' % (path, error))
+            results.append(result)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    print(format_batch(results, time.time() - start))
+    if any(result[-1] is not None for result in results):
+        return -1
+
+def format_batch(results, seconds):
+    done = [result for result in results if result[-1] is None]
+    size, lines, out_size, out_lines, busy = [sum(result[k] for result in done) for k in (2, 3, 4, 5, 6)]
+    output = '''
+Batch:
+  Files: %d optimized, %d failed
+''' % (len(done), len(results) - len(done))
+    if done:
+        output += '  Bytes: %d -> %d (%+.1f%%)\n' % (size, out_size, 100.0 * (out_size - size) / size if size else 0)
+        output += '  Lines: %d -> %d (%+.1f%%)\n' % (lines, out_lines, 100.0 * (out_lines - lines) / lines if lines else 0)
+    output += '  Time: %.1f s, files took %.1f s in all\n' % (seconds, busy)
+    return output
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%d:%02d:%02d' % (hours, minutes, seconds)
+
+def make_serializer(resolution):
+    if resolution is None:
+        return None
+    return GSerializer(resolution)
+
+def report_passes(passes):
+    'Prints what the passes that keep count of their savings saved'
+    kinds = dict((type(p), p) for p in passes)
+    report_retracts(kinds.get(RetractSaver))
+    report_air(kinds.get(AirMovePromoter))
+    report_reorder(kinds.get(RapidReorderer))
+
+def report_reorder(reorder):
+    'Prints the rapid distance reordering saved, unless the job came from the cache'
+    if reorder is None or not getattr(reorder, 'reordered', 0):
+        return
+    if '%.1f' % reorder.before == '%.1f' % reorder.after:
+        # Nothing saved that would show
+        return
+    saved = reorder.before - reorder.after
+    print('Reordered %d cut islands, rapids between them went from %.1f to %.1f mm, %.1f mm (%.0f%%) less' % (
+        reorder.reordered, reorder.before, reorder.after, saved, 100 * saved / reorder.before if reorder.before else 0),
+        file=sys.stderr)
+
+def report_retracts(hops):
+    'Prints the Z travel removing retracts saved, unless the job came from the cache'
+    if hops is None or not getattr(hops, 'removed', 0):
+        return
+    print('Replaced %d retracts with moves at depth, %.1f mm less Z travel' % (hops.removed, hops.lifted),
+        file=sys.stderr)
+
+def report_air(air):
+    'Prints the feed moves turned into rapids, unless the job came from the cache'
+    if air is None or not getattr(air, 'promoted', 0):
+        return
+    print('Turned %d feed moves above the stock, %.1f mm in all, into rapids' % (air.promoted, air.promoted_length),
+        file=sys.stderr)
+
+def format_profile(profile, fmt):
+    if fmt == 'json':
+        return json.dumps([vars(p) for p in profile], indent=2, sort_keys=True)
+
+    output = '''
+Optimizer passes:
+-----------------------
+  %-22s %9s %19s %19s %23s %9s
+''' % ('pass', 'seconds', 'statements', 'codes', 'bytes', 'peak MB')
+    for p in profile:
+        output += '  %-22s %9.3f %9d %9d %9d %9d %11d %11d %9.1f\n' % (
+            p.name, p.seconds, p.statements_in, p.statements_out, p.codes_in, p.codes_out,
+            p.bytes_in, p.bytes_out, p.peak_memory / 1e6)
+    if profile:
+        total = sum(p.seconds for p in profile)
+        saved = profile[0].bytes_in - profile[-1].bytes_out
+        output += '  %d passes took %.3f s and saved %d bytes\n' % (len(profile), total, saved)
+    return output
+
+def format_telemetry(telemetry):
+    summary = telemetry.summary()
+    output = '''
+Telemetry:
+-----------------------
+  %d lines, %d bytes in %s''' % (summary['lines'], summary['bytes'], format_duration(summary['seconds']))
+    if summary['bytes_per_s']:
+        output += ', %.0f bytes/s' % summary['bytes_per_s']
+    output += '\n'
+    latency = summary['latency']
+    if latency['count']:
+        output += '  Line latency: %.1f ms median, %.1f ms 90%%, %.1f ms 99%%, %.1f ms max\n' % tuple(
+            latency[k] * 1000 for k in ('p50', 'p90', 'p99', 'max'))
+    for name, label in (('planner', 'Planner'), ('rx', 'Receive buffer')):
+        fill = summary[name]
+        if fill['count']:
+            output += '  %s fill: %.1f mean, %d median, %d max over %d reports\n' % (
+                label, fill['mean'], fill['p50'], fill['max'], fill['count'])
+    return output
+
+def generate_stats(codes, wire=None, baudrate=115200):
+    timing = estimate(codes, wire, baudrate=baudrate)
+    result = timing.analysis
     output = '''
 Job information:
 -----------------------
   %d codes
-''' % len(codes)
+''' % result.statements
 
-    manager = GManager(*codes)
-    try:
-        is_metric = manager.detect_metric()
-        if is_metric == True:
-            output += '  Metric units\n'
-        elif is_metric == False:
-            output += '  Imperial units\n'
-        else:
-            output += '  No units\n'
-    except Exception, e:
-        output += '  Unable to detect units (%s)\n' % str(e)
+    units = {'mm': 'Metric units', 'inch': 'Imperial units', 'mixed': 'Mixed units'}
+    output += '  %s\n' % units.get(result.units, 'No units')
 
-    try:
-        workarea = manager.detect_workarea()
+    if result.envelope:
+        output += '  Required workarea (mm):\n'
+        for axis in sorted(result.envelope):
+            output += '     %s: %f, %f\n' % (axis, result.envelope[axis][0], result.envelope[axis][1])
+    if result.unknown_moves:
+        output += '  %d moves from unknown positions left out\n' % result.unknown_moves
 
-        output += '  Required workarea (without arcs):\n'
-        for axis in workarea:
-            output += '     %s: %f, %f\n' % (axis, workarea[axis][0], workarea[axis][1])
+    output += '  Cutting: %.1f mm, rapids: %.1f mm\n' % (result.cut_distance, result.rapid_distance)
 
-    except Exception, e:
-        output += '  Unable to detect workarea (%s)\n' % str(e)
+    if len(result.feedrates):
+        output += '  Feedrates:\n'
+        output += '    %s\n' % ', '.join([str(i) for i in result.feedrates])
 
-    try:
-        rates = manager.detect_feedrates()
-        if len(rates):
-            output += '  Feedrates:\n'
-            output += '    %s\n' % ', '.join([str(i) for i in rates])
-    except RuntimeError:
-        output += '  Unable to detect feedrates\n'
+    output += '  Codes:\n'
+    output += '    %s\n' % ', '.join(['%s: %d' % (name, result.counts[name]) for name in sorted(result.counts)])
+
+    output += '  Estimated run time: %s\n' % format_duration(timing.time)
+    if timing.starved:
+        output += '  Lines cannot be sent fast enough at %d baud, the planner will run dry in %d places:\n' % (baudrate, len(timing.starved))
+        for first, last in timing.starved[:10]:
+            output += '    lines %d-%d\n' % (first + 1, last + 1)
 
     return output
 
 
 @main.command()
 @click.option('-c', '--code', 'code', metavar='CODE', type=str, help='inline gcode')
-@click.option('-f', '--file', 'ifile', metavar='INPUT', type=click.File('rb'), help='gcode file')
+@click.option('-f', '--file', 'ifile', metavar='INPUT', type=SourceFile(), help='gcode file')
 @click.option('-d', '--dump', 'dump', is_flag=True, help='dump code to stdout')
 @click.option('-o', '--output', 'ofile', metavar='OUTPUT', type=click.File('wb'), help='output')
-@click.option('-s', '--stats', 'stats', is_flag=True, help='print stats to stderr')
+@click.option('-s', '--stats', 'stats', is_flag=True, help='print stats and an estimated run time, which takes about 25 s per million moves, to stderr')
 @click.option('-n', '--no-opt', 'noopt', is_flag=True, help='disable optimizations')
-def parse(code, ifile, dump, ofile, stats, noopt):
+@click.option('--reference-parser', 'reference', is_flag=True, help='use the slow reference parser')
+@click.option('-t', '--tolerance', 'tolerance', type=float, metavar='MM', help='merge G0/G1 moves deviating less than this')
+@click.option('-a', '--arcs', 'arcs', type=float, metavar='MM', help='replace G1 moves on a circle with arcs deviating less than this')
+@click.option('-r', '--resolution', 'resolution', type=float, metavar='MM', help='write numbers with no more digits than this needs, and drop words that change nothing')
+@click.option('--no-cache', 'nocache', is_flag=True, help='do not use or fill the cache of optimized jobs')
+@click.option('-j', '--jobs', 'jobs', default=1, metavar='N', help='parse and optimize files in N processes')
+@click.option('--profile', 'profile', type=click.Choice(['table', 'json']), help='time every optimizer pass and print what it saved to stderr, skips the cache')
+@click.option('-R', '--reorder', 'reorder', is_flag=True, help='reorder cuts between retracts to shorten rapids')
+@click.option('--reverse', 'reverse', is_flag=True, help='with -R, also cut open single depth paths backwards where shorter')
+@click.option('-H', '--hops', 'hops', type=float, metavar='MM', help='stay at depth rather than retract for hops shorter than this, or along earlier cuts')
+@click.option('--stock-top', 'stock_top', type=float, metavar='MM', help='turn feed moves staying above this height into rapids')
+@click.option('-O', '--output-dir', 'outdir', type=click.Path(file_okay=False), metavar='DIR', help='with files given as arguments, write the results here rather than next to them as NAME.opt.EXT')
+@click.argument('inputs', nargs=-1, type=click.Path())
+def parse(code, ifile, dump, ofile, stats, noopt, reference, tolerance, arcs, resolution, nocache, jobs, profile, reorder, reverse, hops, stock_top, outdir, inputs):
+    if inputs:
+        if code or ifile or dump or ofile or stats or profile:
+            print("Files given as arguments are optimized in a batch, which takes no -c, -f, -d, -o, -s or --profile")
+            return -1
+        paths = expand_inputs(inputs)
+        if not paths:
+            print("No files to optimize")
+            return -1
+        options = {'noopt': noopt, 'reference': reference, 'tolerance': tolerance, 'arcs': arcs,
+                   'resolution': resolution, 'nocache': nocache, 'reorder': reorder, 'reverse': reverse,
+                   'hops': hops, 'stock_top': stock_top}
+        return run_batch(paths, outdir, jobs, options)
+    elif outdir:
+        print("An output directory only applies to files given as arguments")
+        return -1
+
     if not ifile and not code:
         print("Need either file or code")
         return -1
 
     if ifile:
-        code = ifile.read()
+        source = ifile
     else:
-        code = '\n'.join(code.split(';'))
+        source = StringIO(u'\n'.join(code.split(';')))
 
-    codes = parse_and_optimize(code, noopt)
+    profiles = None if profile is None else []
+    passes = make_passes(noopt, tolerance, arcs, reorder, reverse, hops, stock_top)
+    codes = parse_and_optimize(source, passes, reference, None if nocache else JobCache(), jobs, profiles)
+    if profiles is not None:
+        print(format_profile(profiles, profile), file=sys.stderr)
 
     absolute = GStatement(GCode('G', 90))
-    codes.insert(0, absolute)
-
+    program = GProgram([absolute])
     if stats:
-        print(generate_stats(codes), file=sys.stderr)
+        program.extend(codes)
+        codes = ()
 
-    s = []
-    for statement in codes:
-        s.append(str(statement))
+    # A cached program is a GProgram, which both can extend from without decoding
+    wire = GWireImage(program, make_serializer(resolution))
+    wire.extend(codes)
+    report_passes(passes)
+    if stats:
+        print(generate_stats(program, wire), file=sys.stderr)
 
     if ofile:
-        ofile.write('\n'.join(s))
+        wire.write(ofile)
     if dump:
-        print('\n'.join(s),)
+        wire.write(sys.stdout)
 
 
 @main.command()
-@click.argument('device', help='serial device')
+@click.argument('device')
 @click.option('-b', '--baudrate', default=115200, help='baudrate')
 def alarm(device, baudrate):
     cnc = CNC(device, baudrate)
@@ -124,51 +410,116 @@ def alarm(device, baudrate):
 
 
 @main.command()
-@click.argument('device', help='serial device')
+@click.argument('device')
 @click.option('-c', '--code', 'code', metavar='CODE', type=str, help='inline gcode')
-@click.option('-f', '--file', 'ifile', metavar='INPUT', type=click.File('rb'), help='gcode file')
+@click.option('-f', '--file', 'ifile', metavar='INPUT', type=SourceFile(), help='gcode file')
 @click.option('-b', '--baudrate', default=115200, help='baudrate')
 @click.option('-m', '--metric', 'measure', flag_value='metric', default=True, help='start in metric mode')
 @click.option('-i', '--imperial', 'measure', flag_value='imperial', help='start in imperial mode')
 @click.option('-y', '--yes', 'yes', is_flag=True, help='do not ask questions')
-@click.option('-s', '--stats', 'stats', is_flag=True, help='print stats to stderr')
+@click.option('-s', '--stats', 'stats', is_flag=True, help='print stats and an estimated run time, which takes about 25 s per million moves, to stderr')
 @click.option('-n', '--no-opt', 'noopt', is_flag=True, help='disable optimizations')
 @click.option('-z', '--zero', 'zero', is_flag=True, help='zero machine after run')
-def send(code, ifile, device, baudrate, measure, yes, noopt, stats, zero):
+@click.option('--reference-parser', 'reference', is_flag=True, help='use the slow reference parser')
+@click.option('--stream', 'stream', is_flag=True, help='send while parsing, errors in the file show up mid-job')
+@click.option('-t', '--tolerance', 'tolerance', type=float, metavar='MM', help='merge G0/G1 moves deviating less than this')
+@click.option('-a', '--arcs', 'arcs', type=float, metavar='MM', help='replace G1 moves on a circle with arcs deviating less than this')
+@click.option('-r', '--resolution', 'resolution', type=float, metavar='MM', help='write numbers with no more digits than this needs, and drop words that change nothing')
+@click.option('--ping-pong', 'pingpong', is_flag=True, help='wait for each line to be acknowledged before sending the next')
+@click.option('-p', '--poll', 'poll', default=0.25, metavar='SECONDS', help='status report interval, 0 to disable')
+@click.option('--no-cache', 'nocache', is_flag=True, help='do not use or fill the cache of optimized jobs')
+@click.option('-j', '--jobs', 'jobs', default=1, metavar='N', help='parse and optimize files in N processes')
+@click.option('--profile', 'profile', type=click.Choice(['table', 'json']), help='time every optimizer pass and print what it saved to stderr, skips the cache')
+@click.option('-R', '--reorder', 'reorder', is_flag=True, help='reorder cuts between retracts to shorten rapids')
+@click.option('--reverse', 'reverse', is_flag=True, help='with -R, also cut open single depth paths backwards where shorter')
+@click.option('-H', '--hops', 'hops', type=float, metavar='MM', help='stay at depth rather than retract for hops shorter than this, or along earlier cuts')
+@click.option('--stock-top', 'stock_top', type=float, metavar='MM', help='turn feed moves staying above this height into rapids')
+@click.option('--telemetry', 'telemetry', type=click.File('w'), metavar='OUTPUT', help='write line latencies and buffer fill over time to this file, as JSON lines')
+@click.option('--resume-at', 'resume', type=int, metavar='LINE', help='restart the job at this line, as numbered in messages of an earlier run')
+@click.option('--safe-z', 'safe_z', type=float, metavar='Z', help='height to retract to before resuming, defaults to the highest Z of the job')
+def send(code, ifile, device, baudrate, measure, yes, noopt, stats, zero, reference, stream, tolerance, arcs, resolution, pingpong, poll, nocache, jobs, profile, reorder, reverse, hops, stock_top, telemetry, resume, safe_z):
     if not ifile and not code:
         print("Need either file or code")
         return -1
 
+    if stream and (stats or not ifile):
+        print("Streaming requires a file and no stats")
+        return -1
+
+    if stream and resume is not None:
+        print("Resuming requires the whole job up front, not streaming")
+        return -1
+
     if ifile:
-        code = ifile.read()
+        source = ifile
     else:
-        code = '\n'.join(code.split(';'))
+        source = StringIO(u'\n'.join(code.split(';')))
 
-    codes = parse_and_optimize(code, noopt)
+    # Streaming sends as the file is parsed, chunks would only arrive once all are done
+    profiles = None if profile is None else []
+    passes = make_passes(noopt, tolerance, arcs, reorder, reverse, hops, stock_top)
+    codes = parse_and_optimize(source, passes, reference, None if nocache else JobCache(), 1 if stream else jobs, profiles)
+    if profiles is not None:
+        print(format_profile(profiles, profile), file=sys.stderr)
 
     absolute = GStatement(GCode('G', 90))
     spindle_start = GStatement(GCode('M', 3))
-    codes.insert(0, absolute)
-    codes.insert(0, spindle_start)
 
     if measure == 'metric':
         adjust = GCode('G', 21)
     else:
         adjust = GCode('G', 20)
 
-    codes.insert(0, GStatement(adjust))
+    preamble = [GStatement(adjust), spindle_start, absolute]
+    postamble = []
 
     if zero:
         zero = GStatement(GCode('G', 0),
                                 GCode('Z', 0),
                                 GCode('X', 0),
                                 GCode('Y', 0))
-        codes.append(zero)
+        postamble.append(zero)
+
+    postamble.append(GStatement(GCode('M', 5)))
 
-    codes.append(GStatement(GCode('M', 5)))
+    if stream:
+        codes = chain(preamble, codes, postamble)
+    else:
+        program = GProgram(preamble)
+        program.extend(codes)
+        program.extend(postamble)
+        codes = GWireImage(program, make_serializer(resolution))
+        report_passes(passes)
+
+    # Messages number lines as in the whole job, resumed or not
+    first, skipped = 0, 0
+    if resume is not None:
+        if not 1 <= resume <= len(codes):
+            print('The job has lines 1 to %d' % len(codes))
+            return -1
+        job = codes
+        statement = bisect_right(job.statements, job.offsets[resume - 1]) - 1
+        first = bisect_left(job.offsets, job.statements[statement])
+        try:
+            program = CheckpointIndex(program).resume(statement, safe_z)
+        except RuntimeError as e:
+            print(e)
+            return -1
+        codes = GWireImage(program, make_serializer(resolution))
+        skipped = len(job) - len(codes)
+        print('Resuming at line %d, after restoring the machine state with:' % (first + 1))
+        for i in range(first - skipped):
+            print('    %s' % codes[i].tobytes().rstrip(b'\n').decode('utf-8'))
+
+    def number(i):
+        if i is None:
+            return 'no line'
+        elif i + skipped < first:
+            return 'resume preamble'
+        return 'line %d' % (i + skipped + 1)
 
     if stats:
-        print(generate_stats(codes), file=sys.stderr)
+        print(generate_stats(program, codes, baudrate), file=sys.stderr)
 
     if not yes:
         print()
@@ -179,24 +530,90 @@ def send(code, ifile, device, baudrate, measure, yes, noopt, stats, zero):
                 print('Aborting')
                 return -1
 
-    cnc = CNC(device, baudrate)
-    cnc.add_codes(*codes)
-
-    cnc.onprogress, cnc.oncomplete = make_progressbar(len(cnc), 'Buffer: ')
-    cnc.onalarm = lambda x: print('\nalarm: %s, %s' % (x, cnc.cur))
-    cnc.onerror = lambda x: print('\nerror: %s, %s' % (x, cnc.cur))
+    cnc = DuplexCNC(device, baudrate, poll)
+    if telemetry:
+        cnc.telemetry = Telemetry(cnc.rx_buffer_size)
+    status = StatusLabel()
+    if stream:
+        # The queue length is unknown, so show how far into the file we are
+        cnc.add_stream(codes, make_serializer(resolution))
+        update, cnc.oncomplete = make_progressbar(os.fstat(ifile.fileno()).st_size, 'File: ', status)
+        cnc.onprogress = lambda i: update(ifile.tell())
+    else:
+        cnc.add_program(codes)
+        cnc.onprogress, cnc.oncomplete = make_progressbar(len(cnc), 'Buffer: ', status)
+    cnc.onstatus = lambda x: setattr(status, 'status', x)
+    cnc.onalarm = lambda x: print('\nalarm: %s, last acknowledged %s' % (x, number(cnc.line)))
+    cnc.onerror = lambda x: print('\nerror: %s, %s: %s' % (x, number(cnc.line), cnc.cur))
+    cnc.oninfo = lambda x: print('\ninfo: %s' % x)
 
     try:
         cnc.connect()
-        cnc.send_queue()
+        cnc.send_queue(streaming=not pingpong)
     except KeyboardInterrupt:
         print()
-        print('Interrupted')
+        print('Interrupted, last acknowledged %s' % number(cnc.line))
         print('Raising position alarm')
         cnc.halt()
         return -1
+    finally:
+        cnc.stop()
+        if telemetry:
+            cnc.telemetry.dump(telemetry)
+            print(format_telemetry(cnc.telemetry), file=sys.stderr)
 
     return 0
 
+@main.command('bench')
+@click.option('-c', '--corpus', 'names', default=','.join(sorted(bench.corpora)), help='comma separated corpora: %s' % ', '.join(sorted(bench.corpora)))
+@click.option('--size', 'sizes', default='1MB', help='comma separated corpus sizes, like 1KB,10MB,1GB')
+@click.option('-o', '--output', 'ofile', metavar='OUTPUT', type=click.File('w'), default='-', help='where to write the JSON report')
+def run_bench(names, sizes, ofile):
+    names = names.split(',')
+    for name in names:
+        if name not in bench.corpora:
+            print('Unknown corpus: %s' % name)
+            return -1
+
+    report = bench.run(names, [bench.parse_size(size) for size in sizes.split(',')], version=version)
+    bench.dump(report, ofile)
+
+@main.command()
+@click.option('-f', '--file', 'ifile', metavar='INPUT', type=SourceFile(), required=True, help='gcode file')
+@click.option('-n', '--lines', 'n', default=10, help='lines to show from the start and the end')
+def preview(ifile, n):
+    if not isinstance(ifile, MappedView):
+        ifile = MappedView(ifile.read())
+
+    count = ifile.line_count()
+    print('%d lines, %d bytes' % (count, len(ifile)))
+    if count <= 2 * n:
+        lines = ifile.head(count)
+    else:
+        lines = ifile.head(n) + [b'...'] + ifile.tail(n)
+    for line in lines:
+        print(line.rstrip(b'\r').decode('utf-8', 'replace'))
+
+@main.command()
+@click.option('--speed', 'speed', default=1.0, metavar='FACTOR', help='run moves this many times faster than the machine would')
+def emulate(speed):
+    emulator = Emulator(speed)
+    emulator.start()
+    print('Emulating grbl on %s, Ctrl-C to stop' % emulator.path)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        emulator.close()
+
+    stats = emulator.stats()
+    print('%d lines, %d errors, %d blocks' % (stats['lines'], stats['errors'], stats['blocks']))
+    print('Receive buffer: peak %d bytes, %d bytes dropped' % (stats['peak_rx'], stats['overflows']))
+    print('Planner ran dry %d times, for %.3f s' % (stats['starved'], stats['starved_time']))
+    if stats['stop_latency']:
+        print('Stop latency: %s' % ', '.join(['%.3f s' % t for t in stats['stop_latency']]))
+
 if __name__ == '__main__':
     main()
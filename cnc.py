@@ -1,38 +1,76 @@
 from serial import Serial, SerialException
 from time import sleep
+from itertools import chain
+from collections import deque
+from threading import Thread, Lock, Condition
+from gcode import GWireImage
+import re
+
+status_field = re.compile(br'([A-Za-z]+):(-?[\d.]+(?:,-?[\d.]+)*)')
+
+def parse_status(s):
+    '''Parses a grbl status report into a dict
+
+    Handles both <Idle,MPos:0.000,0.000,0.000,WPos:...> (grbl 0.9) and
+    <Idle|MPos:0.000,0.000,0.000|FS:0,0> (grbl 1.1). Numeric fields become
+    tuples of floats, the machine state is stored under 'state'.
+    '''
+    fields = re.split(br'[,|]', s.strip(b'<>'), 1)
+    status = {'state': fields[0].decode('ascii')}
+    for name, values in status_field.findall(fields[-1] if len(fields) > 1 else b''):
+        status[name.decode('ascii')] = tuple(float(v) for v in values.split(b','))
+    return status
 
 class ResultParser(object):
     def __init__(self, callback):
         self.buffer = b''
         self.callback = callback
 
-    def feed(self, c):
-        if c == b'\r': # Ignore
-            return False
-        elif c == b'\n':
-            s = self.buffer
-            self.buffer = b''
-            if s == b'ok':
-                self.callback('ok')
-            elif s[:5] == b'error':
-                self.callback('error', s[5:])
-            elif s[:5] == b'ALARM':
-                self.callback('alarm', s[6:])
-            else:
-                self.callback('info', s)
-            return True
+    def dispatch(self, s):
+        if s == b'ok':
+            self.callback('ok')
+        elif s[:5] == b'error':
+            self.callback('error', s[5:])
+        elif s[:5] == b'ALARM':
+            self.callback('alarm', s[6:])
+        elif s[:1] == b'<':
+            self.callback('status', parse_status(s))
         else:
-            self.buffer += c
-            return False
+            self.callback('info', s)
+
+    def feed_bytes(self, data):
+        'Feeds any amount of data, dispatching all completed lines. Returns the number of lines'
+        self.buffer += data.replace(b'\r', b'')
+        if b'\n' not in data:
+            return 0
+
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for s in lines:
+            self.dispatch(s)
+        return len(lines)
+
+    def feed(self, c):
+        return self.feed_bytes(c) > 0
 
 class CNC(object):
+    # grbl has a 128 byte serial receive buffer, of which 127 can be filled
+    rx_buffer_size = 127
+
     def __init__(self, devpath, baudrate):
         self.devpath = devpath
         self.baudrate = baudrate
         self.serial = None
-        self.queue = []
+        self.queue = GWireImage()
         self.result_parser = ResultParser(self.rescb)
         self.cur = None
+        # Index of the line answered last, and so of cur after an error
+        self.line = None
+        self.pending = deque()
+        self.buffered = 0
+        self.aborted = False
+        # A Telemetry, to record what happens to every line
+        self.telemetry = None
 
     def __len__(self):
         return len(self.queue)
@@ -49,6 +87,12 @@ class CNC(object):
     def onalarm(self, msg):
         pass
 
+    def oninfo(self, msg):
+        pass
+
+    def onstatus(self, status):
+        pass
+
     def connect(self):
         if self.serial is not None:
             self.serial.close()
@@ -58,15 +102,35 @@ class CNC(object):
             self.connect()
 
     def rescb(self, val, arg=None):
+        if val == 'info':
+            self.oninfo(arg)
+            return
+        elif val == 'status':
+            if self.telemetry is not None:
+                self.telemetry.status(arg)
+            self.onstatus(arg)
+            return
+
+        if val in ('ok', 'error') and self.pending:
+            # Responses come back in the order the lines were sent
+            line, i = self.pending.popleft()
+            if self.telemetry is not None:
+                self.telemetry.answered(i, len(line), self.buffered, val == 'ok')
+            self.buffered -= len(line)
+            self.line = i
+            if val == 'ok':
+                self.onprogress(i)
+            else:
+                self.cur = line.tobytes().rstrip(b'\n').decode('utf-8')
+
         if val == 'ok':
             return
         elif val == 'alarm':
             self.onalarm(arg)
-        elif val == 'error':
-            self.onerror(arg)
         else:
             self.onerror(arg)
-        self.queue = []
+        self.queue = GWireImage()
+        self.aborted = True
 
     def await_connect(self):
         a = self.serial.read(2)
@@ -79,29 +143,195 @@ class CNC(object):
     def add_codes(self, *codes):
         self.queue.extend(codes)
 
+    def add_program(self, program):
+        self.queue.extend(program)
+
+    def add_stream(self, statements, serializer=None):
+        'Queues an iterable of statements, which is only consumed and encoded while sending'
+        self.queue = chain(self.queue, GWireImage.iter_encode(statements, serializer))
+
     def halt(self):
-        self.serial.write('\x18\n')
+        self.serial.write(b'\x18\n')
         self.monitor()
 
     def hold(self):
-        self.serial.write('!\n')
+        self.serial.write(b'!\n')
         self.monitor()
 
-    def send_queue(self):
-        for i, cmd in enumerate(self.queue):
-            self.cur = cmd
-            self.serial.write(str(cmd)+'\n')
+    def send_queue(self, streaming=True):
+        '''Sends the queue, and waits for all of it to be acknowledged
+
+        When streaming, lines are sent as long as they fit in grbl's receive
+        buffer, counting the characters of lines not yet acknowledged.
+        Otherwise, every line waits for the response to the previous one.
+        Lines are slices of the pre-encoded queue, nothing is formatted here.
+        '''
+        limit = self.rx_buffer_size if streaming else 0
+        self.pending.clear()
+        self.buffered = 0
+        self.aborted = False
+
+        for i, line in enumerate(self.queue):
+            self.await_room(len(line), limit)
+            if self.aborted:
+                return
+            self.write_line(line, i)
+
+        # Nothing fits in an empty buffer, so this waits for every response
+        self.await_room(1, 0)
+        if not self.aborted:
+            self.oncomplete()
+
+    def has_room(self, length, limit):
+        return not self.pending or self.buffered + length <= limit
+
+    def await_room(self, length, limit):
+        while not self.has_room(length, limit) and not self.aborted:
             self.monitor()
-            self.onprogress(i)
 
-        self.oncomplete()
+    def write_line(self, line, i):
+        if self.telemetry is not None:
+            self.telemetry.sent(i)
+        self.pending.append((line, i))
+        self.buffered += len(line)
+        self.serial.write(line)
+
+    def waiting(self):
+        try:
+            return self.serial.in_waiting
+        except AttributeError:
+            # pyserial before 3.0
+            return self.serial.inWaiting()
 
     def monitor(self):
+        '''Reads whatever has arrived, until at least one response has been
+        dispatched. Read errors, as when the port goes away, are raised'''
         while True:
+            s = self.serial.read(max(1, self.waiting()))
+            if self.result_parser.feed_bytes(s):
+                break
+
+
+class DuplexCNC(CNC):
+    '''CNC that reads, writes and polls on separate threads
+
+    A reader thread dispatches responses as they arrive, the queue is sent
+    from a writer thread, and a poller asks for a status report every
+    poll_interval seconds. Real-time commands (feed hold, resume, status and
+    reset) are written immediately, without waiting for any response.
+    '''
+    def __init__(self, devpath, baudrate, poll_interval=0.25):
+        CNC.__init__(self, devpath, baudrate)
+        self.poll_interval = poll_interval
+        self.write_lock = Lock()
+        self.responses = Condition()
+        self.running = False
+        self.threads = []
+        # What made the reader give up, raised from send_queue
+        self.failure = None
+
+    def connect(self):
+        CNC.connect(self)
+        if self.running:
+            return
+
+        # Let the reader wake up regularly, so it can be stopped
+        self.serial.timeout = 0.1
+        self.running = True
+        self.threads = [Thread(target=self.read_loop)]
+        if self.poll_interval:
+            self.threads.append(Thread(target=self.poll_loop))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def read_loop(self):
+        while self.running:
             try:
-                s = self.serial.read(1)
-            except SerialException:
-                pass
+                s = self.serial.read(max(1, self.waiting()))
+            except SerialException as e:
+                # The port is gone, as when unplugged, so nothing will be answered
+                with self.responses:
+                    self.failure = e
+                    self.aborted = True
+                    self.responses.notify_all()
+                return
 
-            if self.result_parser.feed(s):
-                break
+            if s:
+                with self.responses:
+                    self.result_parser.feed_bytes(s)
+                    self.responses.notify_all()
+
+    def poll_loop(self):
+        while self.running:
+            self.realtime(b'?')
+            sleep(self.poll_interval)
+
+    def realtime(self, c):
+        with self.write_lock:
+            self.serial.write(c)
+
+    def halt(self):
+        self.realtime(b'\x18')
+        with self.responses:
+            # A reset empties grbl's buffers, nothing pending will be answered
+            self.aborted = True
+            self.pending.clear()
+            self.buffered = 0
+            self.responses.notify_all()
+
+    def hold(self):
+        self.realtime(b'!')
+
+    def resume(self):
+        self.realtime(b'~')
+
+    def await_room(self, length, limit):
+        with self.responses:
+            while not self.has_room(length, limit) and not self.aborted and self.failure is None:
+                self.responses.wait(0.1)
+            if self.failure is not None:
+                # Starting to send clears aborted, even after the reader gave up
+                self.aborted = True
+
+    def write_line(self, line, i):
+        with self.responses:
+            if self.telemetry is not None:
+                self.telemetry.sent(i)
+            self.pending.append((line, i))
+            self.buffered += len(line)
+        with self.write_lock:
+            self.serial.write(line)
+
+    def send_queue(self, streaming=True):
+        '''Sends the queue from a writer thread
+
+        The calling thread only waits for the writer, so it stays free to
+        handle interrupts and issue real-time commands. Read errors on the
+        reader thread abort the job and are raised here.
+        '''
+        if self.failure is not None:
+            raise self.failure
+        errors = []
+        def writer():
+            try:
+                CNC.send_queue(self, streaming)
+            except Exception as e:
+                errors.append(e)
+
+        thread = Thread(target=writer)
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(0.1)
+
+        if errors:
+            raise errors[0]
+        if self.failure is not None:
+            raise self.failure
@@ -0,0 +1,409 @@
+from gcode import GStatement, GCodeParser, GCodeParserError
+from optimizer import GrblCleaner
+from estimator import Estimator
+from collections import deque
+from threading import Thread, Lock, Condition
+import os
+import select
+import time
+import tty
+
+class Interpreter(Estimator):
+    'Estimator fed one statement at a time, handing out blocks as they are planned'
+    def __init__(self, **settings):
+        Estimator.__init__(self, **settings)
+        self.ends = []
+
+    def block(self, start, end):
+        n = len(self.lengths)
+        Estimator.block(self, start, end)
+        if len(self.lengths) > n:
+            self.ends.append(tuple(end))
+
+    def take(self):
+        'Returns the (length, nominal speed, acceleration, end) of new blocks'
+        blocks = list(zip(self.lengths, self.nominal, self.accel, self.ends))
+        for planned in (self.lengths, self.nominal, self.accel, self.junction, self.statements, self.nbytes):
+            del planned[:]
+        self.ends = []
+        return blocks
+
+
+class Emulator(object):
+    '''grbl 0.9 stand-in on a pseudo-terminal, for testing senders
+
+    Bytes that do not fit the receive buffer are dropped and counted as
+    overflows, like grbl would. Lines are parsed and interpreted with the
+    Estimator's model, and their blocks wait in a planner buffer of
+    block_buffer_size, so lines are only acknowledged once their blocks fit.
+    Blocks run at their nominal speed, plus the time to accelerate to it
+    when the planner had run dry. speed scales time, so 10 runs a job ten
+    times faster.
+
+    Real-time commands act as soon as they are read. Feed hold pauses the
+    current block, reset empties all buffers and raises an alarm if the
+    machine was moving, after which G-code is refused until $X or $H.
+
+    Opening the device reboots it, printing the startup banner, as opening
+    the port resets the Arduino grbl runs on.
+
+    The counters in stats() cover the sender: peak receive buffer use,
+    overflows, how often and for how long the planner ran dry mid-job, and
+    how long after a feed hold or reset motion stopped. Running dry counts
+    when lines were already waiting, or when the next block arrived within
+    idle_gap seconds, but not when a dwell or M code had to wait for it.
+    '''
+    banner = b"\r\nGrbl 0.9j ['$' for help]\r\n"
+    # 128 byte ring buffer, one byte always stays empty
+    rx_buffer_size = 127
+    line_buffer_size = 70
+    words = 'GMXYZIJKRFSPTNL'
+    commands = bytearray(b'?!~\x18')
+    newline = ord('\n')
+    boot_time = 0.2
+    idle_gap = 0.5
+
+    def __init__(self, speed=1.0, block_buffer_size=16, **settings):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        # With no end open, reads fail until a sender opens the device
+        os.close(slave)
+        self.speed = speed
+        self.block_buffer_size = block_buffer_size
+        self.settings = settings
+        self.parser = GCodeParser()
+
+        self.changed = Condition()
+        self.write_lock = Lock()
+        self.rx = bytearray()
+        self.blocks = deque()
+        self.interpreter = Interpreter(buffer_blocks=block_buffer_size, **settings)
+        self.position = [0.0, 0.0, 0.0]
+        self.state = 'Idle'
+        self.moving = False
+        self.held = False
+        self.busy = False
+        self.syncing = False
+        self.resets = 0
+        self.stop_requested = None
+
+        self.lines = 0
+        self.errors = 0
+        self.peak_rx = 0
+        self.overflows = 0
+        self.executed = 0
+        self.starved = 0
+        self.starved_time = 0.0
+        self.stop_latency = []
+
+        self.connected = False
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.threads = [Thread(target=self.read_loop),
+                        Thread(target=self.line_loop),
+                        Thread(target=self.motion_loop)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def close(self):
+        with self.changed:
+            self.running = False
+            self.changed.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        os.close(self.master)
+
+    def stats(self):
+        return {'lines': self.lines,
+                'errors': self.errors,
+                'peak_rx': self.peak_rx,
+                'overflows': self.overflows,
+                'blocks': self.executed,
+                'starved': self.starved,
+                'starved_time': self.starved_time,
+                'stop_latency': list(self.stop_latency)}
+
+    def write(self, data):
+        with self.write_lock:
+            if self.connected:
+                os.write(self.master, data)
+
+    def respond(self, message):
+        if message != b'ok':
+            self.errors += 1
+        self.write(message + b'\r\n')
+
+    def read_loop(self):
+        while self.running:
+            try:
+                ready = select.select([self.master], [], [], 0.1)[0]
+                data = bytearray(os.read(self.master, 1024)) if ready else bytearray()
+            except OSError:
+                self.connected = False
+                time.sleep(0.05)
+                continue
+
+            if not self.connected:
+                self.boot()
+                continue
+            with self.changed:
+                for c in data:
+                    if c in self.commands:
+                        self.realtime(c)
+                    elif len(self.rx) < self.rx_buffer_size:
+                        self.rx.append(c)
+                    else:
+                        self.overflows += 1
+                self.peak_rx = max(self.peak_rx, len(self.rx))
+                self.changed.notify_all()
+
+    def realtime(self, c):
+        'Acts on a real-time command, holding the lock'
+        if c == ord('?'):
+            self.write(self.status())
+        elif c == ord('!'):
+            if self.moving and not self.held:
+                self.held = True
+                self.state = 'Hold'
+                self.stop_requested = time.time()
+        elif c == ord('~'):
+            if self.held:
+                self.held = False
+                self.state = 'Run' if self.moving else 'Idle'
+        elif c == ord('\x18'):
+            if self.moving:
+                self.stop_requested = time.time()
+                self.write(b'ALARM: Abort during cycle\r\n')
+                self.state = 'Alarm'
+            self.reset()
+            if self.state == 'Alarm':
+                self.write(b"['$H'|'$X' to unlock]\r\n")
+
+    def reset(self):
+        'Empties all buffers, keeping the position, holding the lock'
+        self.resets += 1
+        self.held = False
+        del self.rx[:]
+        self.blocks.clear()
+        self.interpreter = Interpreter(buffer_blocks=self.block_buffer_size, **self.settings)
+        self.interpreter.position = list(self.position)
+        self.write(self.banner)
+
+    def boot(self):
+        '''Starts over when a sender opens the device, like opening the port
+        resets the Arduino grbl runs on'''
+        # Give the sender time to flush its input, as the bootloader would
+        time.sleep(self.boot_time)
+        with self.changed:
+            self.connected = True
+            self.state = 'Idle'
+            self.position = [0.0, 0.0, 0.0]
+            self.reset()
+            self.changed.notify_all()
+
+    def status(self):
+        work = [self.position[i] - self.interpreter.offset[i] for i in range(3)]
+        return (b'<%s,MPos:%.3f,%.3f,%.3f,WPos:%.3f,%.3f,%.3f,Buf:%d,RX:%d>\r\n' %
+                tuple([self.state.encode('ascii')] + self.position + work + [len(self.blocks), len(self.rx)]))
+
+    def line_loop(self):
+        while True:
+            with self.changed:
+                while self.running and self.newline not in self.rx:
+                    self.changed.wait(0.1)
+                if not self.running:
+                    return
+                end = self.rx.index(b'\n')
+                line = bytes(self.rx[:end])
+                del self.rx[:end + 1]
+                self.busy = True
+                resets = self.resets
+
+            try:
+                self.lines += 1
+                self.execute(line.strip().upper(), resets)
+            finally:
+                with self.changed:
+                    self.busy = False
+
+    def execute(self, line, resets):
+        if not line:
+            self.respond(b'ok')
+        elif len(line) >= self.line_buffer_size:
+            self.respond(b'error: Line overflow')
+        elif line.startswith(b'$'):
+            self.system(line)
+        elif self.state == 'Alarm':
+            self.respond(b'error: Alarm lock')
+        else:
+            self.gcode(line, resets)
+
+    def system(self, line):
+        with self.changed:
+            if line in (b'$X', b'$H'):
+                if line == b'$H':
+                    self.position = [0.0, 0.0, 0.0]
+                    self.interpreter.position = [0.0, 0.0, 0.0]
+                elif self.state == 'Alarm':
+                    self.write(b'[Caution: Unlocked]\r\n')
+                self.state = 'Run' if self.moving else 'Idle'
+            elif line == b'$$':
+                rates = self.settings.get('max_rate', (5000.0, 5000.0, 500.0))
+                for i, rate in enumerate(rates):
+                    self.write(b'$%d=%.3f\r\n' % (110 + i, rate))
+        self.respond(b'ok')
+
+    def gcode(self, line, resets):
+        try:
+            codes = [code for statement in self.parser.parse(line.decode('ascii')) for code in statement]
+        except (GCodeParserError, UnicodeDecodeError, ValueError):
+            self.respond(b'error: Expected command letter')
+            return
+
+        words, gcodes, mcodes = {}, [], []
+        for code in codes:
+            if code.type != 'code':
+                continue
+            if code.address not in self.words:
+                self.respond(b'error: Unsupported command')
+                return
+            if code.address == 'G':
+                gcodes.append(code.command)
+            elif code.address == 'M':
+                mcodes.append(code.command)
+            else:
+                words[code.address] = code.command
+        if ([g for g in gcodes if g not in GrblCleaner.supported_g] or
+                [m for m in mcodes if m not in GrblCleaner.supported_m]):
+            self.respond(b'error: Unsupported command')
+            return
+
+        interpreter = self.interpreter
+        motion = ([g for g in gcodes if g in (0, 1, 2, 3)] or [interpreter.motion])[-1]
+        moves = [axis for axis in interpreter.axes if axis in words]
+        if moves and motion in (1, 2, 3) and interpreter.feed is None and 'F' not in words:
+            self.respond(b'error: Undefined feed rate')
+            return
+
+        dwell = interpreter.estimate.dwell
+        sync = [g for g in gcodes if g in (4, 28, 30, 53)] or [m for m in mcodes if m in interpreter.sync]
+        if sync and not self.drain(resets):
+            return
+
+        interpreter.follow(GStatement(*codes))
+        if None in interpreter.position:
+            # The machine origin is known here: homing goes there, and G53 moves relative to it
+            target = words if 53 in gcodes else {}
+            interpreter.position = [target.get(axis, 0) * interpreter.scale if p is None else p
+                                    for axis, p in zip(interpreter.axes, interpreter.position)]
+            with self.changed:
+                self.position = list(interpreter.position)
+        for block in interpreter.take():
+            if not self.queue(block, resets):
+                return
+        if interpreter.estimate.dwell > dwell:
+            time.sleep((interpreter.estimate.dwell - dwell) / self.speed)
+
+        with self.changed:
+            if self.resets != resets:
+                return
+        self.respond(b'ok')
+
+    def drain(self, resets):
+        'Waits for the planner to finish. Returns False if it was reset meanwhile'
+        with self.changed:
+            # Waiting on purpose, the planner running dry now is not starvation
+            self.syncing = True
+            while self.running and self.resets == resets and (self.blocks or self.moving):
+                self.changed.wait(0.1)
+            self.syncing = False
+            return self.running and self.resets == resets
+
+    def queue(self, block, resets):
+        'Waits for room in the planner and adds a block. Returns False if it was reset meanwhile'
+        with self.changed:
+            while self.running and self.resets == resets and len(self.blocks) >= self.block_buffer_size:
+                self.changed.wait(0.1)
+            if not self.running or self.resets != resets:
+                return False
+            self.blocks.append(block)
+            self.changed.notify_all()
+            return True
+
+    def motion_loop(self):
+        dry, waiting = None, False
+        while True:
+            with self.changed:
+                while self.running and not self.blocks:
+                    if self.moving:
+                        self.moving = False
+                        if self.state == 'Run':
+                            self.state = 'Idle'
+                        if not self.syncing:
+                            dry = time.time()
+                            waiting = self.busy or self.newline in self.rx
+                    self.changed.wait(0.01)
+                if not self.running:
+                    return
+
+                length, nominal, accel, end = self.blocks.popleft()
+                self.changed.notify_all()
+                seconds = length / nominal
+                if not self.moving:
+                    # Starting from a stop, accelerating costs half the time it takes
+                    seconds += nominal / accel / 2
+                if dry is not None:
+                    # Stopping with lines on their way, or only briefly, means the sender fell behind
+                    gap = time.time() - dry
+                    if waiting or gap < self.idle_gap:
+                        self.starved += 1
+                        self.starved_time += gap
+                    dry = None
+                self.moving = True
+                if self.state == 'Idle':
+                    self.state = 'Run'
+                start = list(self.position)
+                resets = self.resets
+
+            if self.run_block(start, end, seconds / self.speed, resets):
+                self.executed += 1
+
+    def run_block(self, start, end, seconds, resets):
+        'Moves from start to end in seconds, interpolating the position. Returns False if reset'
+        elapsed = 0.0
+        while elapsed < seconds:
+            with self.changed:
+                if self.resets != resets or not self.running:
+                    self.stopped(True)
+                    return False
+                if self.held:
+                    if self.stop_requested is not None:
+                        self.stopped()
+                    self.changed.wait(0.01)
+                    continue
+                fraction = elapsed / seconds
+                self.position = [start[i] + (end[i] - start[i]) * fraction for i in range(3)]
+            step = min(0.005, seconds - elapsed)
+            time.sleep(step)
+            elapsed += step
+
+        with self.changed:
+            if self.resets != resets:
+                self.stopped(True)
+                return False
+            self.position = list(end)
+        return True
+
+    def stopped(self, reset=False):
+        'Records how long motion took to stop, holding the lock'
+        if self.stop_requested is not None:
+            self.stop_latency.append(time.time() - self.stop_requested)
+            self.stop_requested = None
+        if reset:
+            self.moving = False
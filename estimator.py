@@ -0,0 +1,211 @@
+from gcode import GProgram, GWireImage
+from analyzer import Analyzer
+from array import array
+from math import sqrt, cos, sin, floor
+
+class Estimate(object):
+    '''Results of estimating the run time of a program
+
+    time is in seconds, including dwells. starved lists (first, last)
+    statement index ranges where lines could not be sent as fast as the
+    planner executes them, so its look-ahead would run dry. analysis is the
+    Analysis of the program, collected in the same pass.
+    '''
+    def __init__(self):
+        self.analysis = None
+        self.time = 0.0
+        self.dwell = 0.0
+        self.blocks = 0
+        self.starved = []
+
+
+class Estimator(Analyzer):
+    '''Estimates run time by modelling grbl's planner
+
+    Moves are split into blocks the way grbl does it, arcs into chords within
+    arc_tolerance. Blocks are limited by per-axis max rates (mm/min) and
+    accelerations (mm/s^2), and junction speeds by junction_deviation. As
+    the planner only sees buffer_blocks ahead and must be able to stop at the
+    end of its buffer, entry speeds are also limited by the distance
+    covered by that many blocks. Dwells, spindle and coolant changes empty
+    the planner. The defaults are grbl's Shapeoko 2 settings.
+    '''
+    sync = (0, 1, 2, 3, 4, 5, 7, 8, 9, 30)
+
+    def __init__(self, max_rate=(5000.0, 5000.0, 500.0), acceleration=(250.0, 250.0, 50.0),
+                 junction_deviation=0.02, buffer_blocks=16, arc_tolerance=0.002, baudrate=115200):
+        Analyzer.__init__(self)
+        self.max_rate = [rate / 60.0 for rate in max_rate]
+        self.acceleration = acceleration
+        self.junction_deviation = junction_deviation
+        self.buffer_blocks = buffer_blocks
+        self.arc_tolerance = arc_tolerance
+        self.baudrate = baudrate
+
+        self.wire = None
+        self.estimate = Estimate()
+        self.lengths = array('d')
+        self.nominal = array('d')
+        self.accel = array('d')
+        self.junction = array('d')
+        self.statements = array('L')
+        self.nbytes = array('L')
+        self.index = -1
+        self.pending = 0
+        self.unit = None
+        self.previous = 0.0
+
+    def analyze(self, program, wire=None):
+        if not isinstance(program, GProgram):
+            program = GProgram(program)
+        self.wire = wire if wire is not None else GWireImage(program)
+        return Analyzer.analyze(self, program)
+
+    def run(self, program, wire=None):
+        self.estimate.analysis = self.analyze(program, wire)
+        self.plan()
+        return self.estimate
+
+    def statement(self, words, gcodes, mcodes):
+        self.index += 1
+        if self.wire is not None:
+            ends = self.wire.statements
+            self.pending += ends[self.index + 1] - ends[self.index]
+
+        Analyzer.statement(self, words, gcodes, mcodes)
+
+        if 4 in gcodes:
+            # grbl 0.9 and later dwell for P seconds
+            self.estimate.dwell += words.get('P', 0)
+            self.unit = None
+        elif [m for m in mcodes if m in self.sync] or 28 in gcodes or 30 in gcodes:
+            self.unit = None
+
+    def line(self, start, end):
+        Analyzer.line(self, start, end)
+        self.block(start, end)
+
+    def arc(self, start, end, words):
+        geometry = Analyzer.arc(self, start, end, words)
+        if geometry is None:
+            return None
+
+        c0, c1, radius, begin, sweep = geometry
+        (a0, a1, linear), offsets = self.planes[self.plane]
+        tolerance = self.arc_tolerance
+        segments = 0
+        if radius > tolerance:
+            segments = int(floor(0.5 * sweep * radius / sqrt(tolerance * (2 * radius - tolerance))))
+
+        point = start
+        step = sweep / segments if segments else 0
+        if self.motion == 2:
+            step = -step
+        for k in range(1, segments):
+            angle = begin + k * step
+            chord = list(start)
+            chord[a0] = c0 + radius * cos(angle)
+            chord[a1] = c1 + radius * sin(angle)
+            chord[linear] = start[linear] + (end[linear] - start[linear]) * k / segments
+            self.block(point, chord)
+            point = chord
+        self.block(point, end)
+        return geometry
+
+    def block(self, start, end):
+        dx, dy, dz = end[0] - start[0], end[1] - start[1], end[2] - start[2]
+        length = sqrt(dx * dx + dy * dy + dz * dz)
+        if length < 1e-6:
+            return
+        unit = (dx / length, dy / length, dz / length)
+
+        nominal = float('inf') if self.motion == 0 or not self.feed else self.feed / 60.0
+        accel = float('inf')
+        for i in range(3):
+            if unit[i]:
+                nominal = min(nominal, self.max_rate[i] / abs(unit[i]))
+                accel = min(accel, self.acceleration[i] / abs(unit[i]))
+
+        junction = 0.0
+        if self.unit is not None:
+            cos_theta = -(self.unit[0] * unit[0] + self.unit[1] * unit[1] + self.unit[2] * unit[2])
+            if cos_theta < -0.999999:
+                junction = float('inf')
+            elif cos_theta < 0.999999:
+                sin_theta_d2 = sqrt(0.5 * (1.0 - cos_theta))
+                junction = accel * self.junction_deviation * sin_theta_d2 / (1.0 - sin_theta_d2)
+            junction = min(junction, nominal * nominal, self.previous * self.previous)
+
+        self.lengths.append(length)
+        self.nominal.append(nominal)
+        self.accel.append(accel)
+        self.junction.append(junction)
+        self.statements.append(self.index)
+        self.nbytes.append(self.pending)
+        self.pending = 0
+        self.unit = unit
+        self.previous = nominal
+
+    def plan(self):
+        lengths, nominal, accel = self.lengths, self.nominal, self.accel
+        n = len(lengths)
+        depth = self.buffer_blocks
+
+        # Distance from the start of every block to the end of the planner buffer
+        ahead = array('d', [0.0]) * (n + 1)
+        for k in range(n - 1, -1, -1):
+            ahead[k] = ahead[k + 1] + lengths[k]
+        entry = array('d', self.junction)
+        for k in range(n):
+            end = min(k + depth, n)
+            entry[k] = min(entry[k], 2 * accel[k] * (ahead[k] - ahead[end]))
+
+        # Squared entry speeds: decelerate backwards from a stop, then accelerate forwards
+        following = 0.0
+        for k in range(n - 1, -1, -1):
+            following = entry[k] = min(entry[k], following + 2 * accel[k] * lengths[k])
+        previous = 0.0
+        for k in range(n):
+            previous = entry[k] = min(entry[k], previous)
+            previous += 2 * accel[k] * lengths[k]
+
+        times = array('d', [0.0]) * n
+        for k in range(n):
+            v0, v1 = sqrt(entry[k]), sqrt(entry[k + 1]) if k + 1 < n else 0.0
+            vn, a, length = nominal[k], accel[k], lengths[k]
+            accelerating = (vn * vn - v0 * v0) / (2 * a)
+            decelerating = (vn * vn - v1 * v1) / (2 * a)
+            if accelerating + decelerating <= length:
+                times[k] = (vn - v0) / a + (vn - v1) / a + (length - accelerating - decelerating) / vn
+            else:
+                peak = sqrt((2 * a * length + v0 * v0 + v1 * v1) / 2)
+                times[k] = (peak - v0) / a + (peak - v1) / a
+
+        estimate = self.estimate
+        estimate.blocks = n
+        estimate.time = sum(times) + estimate.dwell
+        estimate.starved = self.starvation(times)
+
+    def starvation(self, times):
+        'Finds runs of full planner buffers that execute faster than they can be sent'
+        n, depth = len(times), self.buffer_blocks
+        # 8 data bits, a start and a stop bit
+        per_byte = 10.0 / self.baudrate
+        starved = []
+        run_time = sum(times[:depth])
+        run_bytes = sum(self.nbytes[:depth])
+        for k in range(n - depth + 1):
+            if run_time < run_bytes * per_byte:
+                first, last = self.statements[k], self.statements[k + depth - 1]
+                if starved and starved[-1][1] >= first:
+                    starved[-1] = (starved[-1][0], last)
+                else:
+                    starved.append((first, last))
+            if k + depth < n:
+                run_time += times[k + depth] - times[k]
+                run_bytes += self.nbytes[k + depth] - self.nbytes[k]
+        return starved
+
+
+def estimate(program, wire=None, **settings):
+    return Estimator(**settings).run(program, wire)
@@ -1,14 +1,33 @@
+import gc
+import re
+import pickle
+import struct
+from array import array
+from math import ceil, log10
+from itertools import islice
+
 class GManager(object):
     def __init__(self, *args):
+        if len(args) == 1 and isinstance(args[0], GProgram):
+            args = args[0]
         self.args = args
 
     def iter_codes(self):
+        if isinstance(self.args, GProgram):
+            return self.args.iter_codes()
+        return self._iter_codes()
+
+    def _iter_codes(self):
         for statement in self.args:
             for code in statement:
                 yield code
         return
 
     def limit_feedrate(self, max_feed):
+        if isinstance(self.args, GProgram):
+            self.args.limit('F', max_feed)
+            return
+
         for code in self.iter_codes():
             if code.type != 'code':
                 continue
@@ -184,11 +203,411 @@ class GFileMarker(object):
         return GFileMarker()
 
 
+class GProgram(object):
+    '''Array backed list of statements
+
+    Every code takes an address byte, a float64 value and a flag telling
+    whether the value was an int. Comments store an index into an interned
+    comment table, file markers store nothing. Statements are ranges of
+    codes, delimited by offsets. GStatements are only created on access.
+    '''
+    comment = ord('(')
+    filemark = ord('%')
+
+    def __init__(self, statements=()):
+        self.addresses = array('B')
+        self.values = array('d')
+        self.floats = array('B')
+        self.offsets = array('L', [0])
+        self.comments = []
+        self.interned = {}
+        self.extend(statements)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('statement index out of range')
+        return GStatement(*self.decode(self.offsets[key], self.offsets[key+1]))
+
+    def __iter__(self):
+        start = 0
+        for end in islice(self.offsets, 1, None):
+            yield GStatement(*self.decode(start, end))
+            start = end
+
+    def iter_codes(self):
+        start = 0
+        for end in islice(self.offsets, 1, None):
+            for code in self.decode(start, end):
+                yield code
+            start = end
+
+    def decode(self, start, end):
+        codes = []
+        addresses, values, floats = self.addresses, self.values, self.floats
+        for i in range(start, end):
+            address = addresses[i]
+            if address == self.comment:
+                codes.append(GComment(self.comments[int(values[i])]))
+            elif address == self.filemark:
+                codes.append(GFileMarker())
+            elif floats[i]:
+                codes.append(GCode(chr(address), values[i]))
+            else:
+                codes.append(GCode(chr(address), int(values[i])))
+        return codes
+
+    def intern(self, content):
+        index = self.interned.get(content)
+        if index is None:
+            index = self.interned[content] = len(self.comments)
+            self.comments.append(content)
+        return index
+
+    def append(self, statement):
+        for code in statement:
+            if code.type == 'code':
+                self.addresses.append(ord(code.address))
+                self.values.append(code.command)
+                self.floats.append(type(code.command) == float)
+            elif code.type == 'comment':
+                self.addresses.append(self.comment)
+                self.values.append(self.intern(code.content))
+                self.floats.append(0)
+            else:
+                self.addresses.append(self.filemark)
+                self.values.append(0)
+                self.floats.append(0)
+        self.offsets.append(len(self.addresses))
+
+    def extend(self, statements):
+        if not isinstance(statements, GProgram):
+            for statement in statements:
+                self.append(statement)
+            return
+
+        # Copy the arrays directly, only remapping offsets and comments
+        base = len(self.addresses)
+        values = array('d', statements.values)
+        if statements.comments:
+            remap = [self.intern(content) for content in statements.comments]
+            for i, address in enumerate(statements.addresses):
+                if address == self.comment:
+                    values[i] = remap[int(values[i])]
+
+        self.addresses.extend(statements.addresses)
+        self.values.extend(values)
+        self.floats.extend(statements.floats)
+        self.offsets.extend(array('L', [base + offset for offset in statements.offsets[1:]]))
+
+    def section(self, first, last=None):
+        'Program of statements first up to, not including, last, sliced straight from the arrays'
+        last = len(self) if last is None else min(last, len(self))
+        first = min(first, last)
+        start, end = self.offsets[first], self.offsets[last]
+        program = GProgram()
+        program.addresses = self.addresses[start:end]
+        program.values = self.values[start:end]
+        program.floats = self.floats[start:end]
+        program.offsets = array('L', [offset - start for offset in self.offsets[first:last + 1]])
+        program.comments = list(self.comments)
+        program.interned = dict(self.interned)
+        return program
+
+    def limit(self, address, maximum):
+        address = ord(address)
+        values = self.values
+        for i, a in enumerate(self.addresses):
+            if a == address and values[i] > maximum:
+                values[i] = maximum
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (self.addresses, self.values, self.floats, self.offsets))
+
+    def dump(self, fileobj):
+        'Writes the arrays in their machine representation, to be read back by load'
+        comments = pickle.dumps(self.comments, 2)
+        fileobj.write(struct.pack('<4Q', len(self.addresses), len(self.offsets), self.offsets.itemsize, len(comments)))
+        fileobj.write(comments)
+        for a in (self.addresses, self.values, self.floats, self.offsets):
+            a.tofile(fileobj)
+
+    @classmethod
+    def load(cls, fileobj):
+        header = fileobj.read(32)
+        if len(header) != 32:
+            raise ValueError('truncated program header')
+        ncodes, noffsets, itemsize, ncomments = struct.unpack('<4Q', header)
+        if itemsize != array('L').itemsize:
+            raise ValueError('program was written on a different platform')
+
+        program = cls()
+        program.comments = pickle.loads(fileobj.read(ncomments))
+        program.interned = dict((content, i) for i, content in enumerate(program.comments))
+        program.offsets = array('L')
+        for a, n in ((program.addresses, ncodes), (program.values, ncodes),
+                     (program.floats, ncodes), (program.offsets, noffsets)):
+            a.fromfile(fileobj, n)
+        return program
+
+
+class GCodeSerializerError(RuntimeError):
+    pass
+
+
+class GSerializer(object):
+    '''Formats statements in as few bytes as grbl needs to run them
+
+    Numbers get no more decimals than the machine resolution needs, without
+    trailing zeros or leading zeros (X.5, X-.25, X10). Words that would not
+    change anything, like a modal G code that is already active, a feedrate
+    that is already set or an absolute coordinate the machine is already at,
+    are dropped, and so are statements left empty. Statements that do not
+    fit in max_line have their feedrate, spindle, tool, M and modal G words
+    moved to lines of their own. Numbers are never truncated; a statement
+    that still does not fit raises GCodeSerializerError.
+
+    The modal state is carried from one statement to the next, so a
+    serializer must see the statements of a job in order. It is forgotten
+    after M2 and M30, where grbl puts the modes back to its defaults.
+    '''
+    axes = ('X', 'Y', 'Z', 'A', 'B', 'C')
+    groups = dict((command, group) for group, commands in
+                  (('motion', (0, 1, 2, 3, 38.2, 80)), ('plane', (17, 18, 19)),
+                   ('distance', (90, 91)), ('units', (20, 21)), ('feedmode', (93, 94)),
+                   ('system', (54, 55, 56, 57, 58, 59)), ('length', (43.1, 49)))
+                  for command in commands)
+    # Non-modal codes that take axis words, or leave the position unknown
+    lost = (10, 28, 28.1, 30, 30.1, 38.2, 53, 92, 92.1)
+    spindle = (3, 4, 5)
+    stops = (0, 1, 2, 30)
+    ends = (2, 30)
+
+    def __init__(self, resolution=0.001, max_line=70):
+        self.decimals = max(0, int(ceil(-log10(resolution) - 1e-9)))
+        self.max_line = max_line
+        self.reset()
+
+    def reset(self):
+        self.modal = {}
+        self.words = {}
+
+    def number(self, value):
+        if type(value) != float:
+            return '%d' % value
+        s = '%.*f' % (self.decimals, value)
+        if '.' in s:
+            s = s.rstrip('0').rstrip('.')
+        if s.startswith('0.'):
+            s = s[1:]
+        elif s.startswith('-0.'):
+            s = '-' + s[2:]
+        if s in ('-0', '', '-'):
+            s = '0'
+        return s
+
+    def word(self, code):
+        if code.type == 'comment':
+            return '(%s)' % code.content
+        elif code.type == 'filemark':
+            return '%'
+        return code.address + self.number(code.command)
+
+    def lines(self, statement):
+        '''Returns the lines for a statement, without newlines'''
+        codes = [code for code in statement]
+        gcodes = [code.command for code in codes if code.type == 'code' and code.address == 'G']
+        units = [g for g in gcodes if g in (20, 21)]
+        if units and self.modal.get('units') != units[-1]:
+            # Coordinates and feedrates now mean something else
+            self.words = {}
+        distance = [g for g in gcodes if g in (90, 91)]
+        absolute = (distance[-1] if distance else self.modal.get('distance', 90)) == 90
+        nonmodal = [g for g in gcodes if g in self.lost]
+        motion = [g for g in gcodes if g in (0, 1, 2, 3, 38.2, 80)]
+        # grbl wants at least one axis word with an arc
+        arc = (motion[-1] if motion else self.modal.get('motion')) in (2, 3)
+        inverse = (self.modal.get('feedmode') == 93 or 93 in gcodes) and 94 not in gcodes
+
+        kept = []
+        for code in codes:
+            if code.type != 'code':
+                kept.append((code, self.word(code)))
+                continue
+
+            s = self.word(code)
+            address = code.address
+            if address == 'G' and code.command in self.groups:
+                group = self.groups[code.command]
+                if self.modal.get(group) == code.command:
+                    continue
+                self.modal[group] = code.command
+            elif address == 'M' and code.command in self.spindle:
+                if self.modal.get('spindle') == code.command:
+                    continue
+                self.modal['spindle'] = code.command
+            elif address in self.axes and not nonmodal:
+                if absolute and not arc and self.words.get(address) == s:
+                    continue
+                self.words[address] = s if absolute else None
+            elif address == 'F' and not inverse:
+                if self.words.get('F') == s:
+                    continue
+                self.words['F'] = s
+            elif address == 'S':
+                if self.words.get('S') == s:
+                    continue
+                self.words['S'] = s
+            kept.append((code, s))
+
+        if nonmodal:
+            for axis in self.axes:
+                self.words.pop(axis, None)
+        if [code for code in codes if code.type == 'code' and code.address == 'M' and code.command in self.ends]:
+            self.reset()
+
+        line = ''.join(s for code, s in kept)
+        if len(line) < self.max_line:
+            return [line] if line else []
+        return self.split(kept)
+
+    def split(self, kept):
+        '''Moves every word that does not need to be in the same block as the
+        motion to a line of its own, stops after and the rest before'''
+        before, block, after = [], [], []
+        for code, s in kept:
+            if code.type != 'code':
+                before.append(s)
+            elif code.address == 'M':
+                (after if code.command in self.stops else before).append(s)
+            elif code.address in ('F', 'S', 'T') or (code.address == 'G' and code.command in self.groups and code.command not in (0, 1, 2, 3, 38.2)):
+                before.append(s)
+            else:
+                block.append(s)
+
+        lines = before + ([''.join(block)] if block else []) + after
+        for line in lines:
+            if len(line) >= self.max_line:
+                raise GCodeSerializerError('Statement does not fit in %d characters: %s' % (self.max_line - 1, line))
+        return lines
+
+
+class GWireImage(object):
+    '''Statements serialized into one contiguous buffer, as sent to the machine
+
+    Every statement is formatted once, followed by a newline, and appended
+    to a bytearray. Line offsets are kept in an array, so lines can be
+    handed out as memoryview slices without copying or formatting again.
+    Without a serializer, every statement is one line formatted by str().
+    With one, a statement can become any number of lines, so the byte offset
+    at the end of every statement is kept as well.
+    '''
+    def __init__(self, statements=(), serializer=None):
+        self.data = bytearray()
+        self.offsets = array('L', [0])
+        self.statements = array('L', [0])
+        self.serializer = serializer
+        self.extend(statements)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError('line index out of range')
+        return memoryview(self.data)[self.offsets[key]:self.offsets[key+1]]
+
+    def __iter__(self):
+        view = memoryview(self.data)
+        start = 0
+        for end in islice(self.offsets, 1, None):
+            yield view[start:end]
+            start = end
+
+    @staticmethod
+    def encode(statement, serializer=None):
+        if serializer is None:
+            lines = [str(statement)]
+        else:
+            lines = serializer.lines(statement)
+        encoded = []
+        for line in lines:
+            line += '\n'
+            encoded.append(line if isinstance(line, bytes) else line.encode('utf-8'))
+        return encoded
+
+    @classmethod
+    def iter_encode(cls, statements, serializer=None):
+        'Encodes statements one at a time, for when the job is not compiled up front'
+        for statement in statements:
+            for line in cls.encode(statement, serializer):
+                yield memoryview(line)
+
+    def append(self, statement):
+        for line in self.encode(statement, self.serializer):
+            self.data.extend(line)
+            self.offsets.append(len(self.data))
+        self.statements.append(len(self.data))
+
+    def extend(self, statements):
+        if isinstance(statements, GProgram) and self.serializer is None:
+            self.extend_program(statements)
+            return
+        elif isinstance(statements, GWireImage):
+            base = len(self.data)
+            self.data.extend(statements.data)
+            self.offsets.extend(array('L', [base + offset for offset in statements.offsets[1:]]))
+            self.statements.extend(array('L', [base + offset for offset in statements.statements[1:]]))
+            return
+
+        for statement in statements:
+            self.append(statement)
+
+    def extend_program(self, program):
+        'Formats straight from the arrays of a GProgram, without creating any GCodes'
+        addresses, values, floats, comments = program.addresses, program.values, program.floats, program.comments
+        data, offsets = self.data, self.offsets
+        letters = [chr(i) for i in range(256)]
+        start = 0
+        for end in islice(program.offsets, 1, None):
+            words = []
+            for i in range(start, end):
+                address = addresses[i]
+                if address == GProgram.comment:
+                    words.append('(%s)' % comments[int(values[i])])
+                elif address == GProgram.filemark:
+                    words.append('%')
+                elif floats[i]:
+                    words.append('%s%.5f' % (letters[address], values[i]))
+                else:
+                    words.append('%s%d' % (letters[address], values[i]))
+
+            line = ''.join(words)
+            if len(line) >= 70:
+                # Leave truncation of long statements to GStatement
+                line = str(GStatement(*program.decode(start, end)))
+            line += '\n'
+            data.extend(line if isinstance(line, bytes) else line.encode('utf-8'))
+            offsets.append(len(data))
+            start = end
+        self.statements.extend(offsets[len(self.statements):])
+
+    def write(self, fileobj):
+        fileobj.write(self.data)
+
+
 class GCodeParserError(RuntimeError):
     pass
 
 
-class GCodeParser(object):
+class GCodeReferenceParser(object):
+    'Character-at-a-time state machine parser, kept as the reference implementation'
     def __init__(self):
         self.parser = None
         self.statements = None
@@ -246,15 +665,14 @@ class GCodeParser(object):
             self.buffer = [c.upper(), '']
             self.change_parser(self.argument_parser)
 
-    def parse(self, string):
-        # Resetting...
+    def reset(self):
         self.parser = self.address_parser
         self.statements = []
         self.statement = None
         self.buffer = None
 
-        # Ready!
-        for c in string+'\n':
+    def feed(self, string):
+        for c in string:
             try:
                 self.parser(c)
             except GCodeParserError:
@@ -262,4 +680,160 @@ class GCodeParser(object):
             except:
                 raise GCodeParserError('Unknown symbol: [%s]' % ord(c))
 
+    def parse(self, string):
+        self.reset()
+        self.feed(string+'\n')
         return self.statements
+
+    def iter_parse(self, fileobj, size=65536):
+        self.reset()
+        while True:
+            data = fileobj.read(size)
+            if not data:
+                break
+            self.feed(data)
+
+            # Only the last statement can still receive codes
+            statements, self.statements = self.statements[:-1], self.statements[-1:]
+            for statement in statements:
+                yield statement
+
+        self.feed('\n')
+        for statement in self.statements:
+            yield statement
+
+
+class GCodeParser(object):
+    'Line-oriented parser, producing the same output as GCodeReferenceParser'
+    newline = re.compile(r'(\r|\n)')
+    plain = re.compile(r'(?: *[A-Z][-+.0-9]*)* *$')
+    words = re.compile(r' *([A-Z])([-+.0-9]*)')
+    token = re.compile(r' *(?:([A-Za-z])([-+.0-9]*)|(%)|\(([^)]*)\))')
+
+    def reference(self, line, sep):
+        # Slow path for anything the expressions do not cover. The reference
+        # parser either raises the exact same error, or yields the codes.
+        statements = GCodeReferenceParser().parse(line + sep)
+        return [code for statement in statements for code in statement]
+
+    def codes(self, line, sep):
+        if self.plain.match(line):
+            try:
+                return [GCode(address, float(arg) if '.' in arg else int(arg))
+                        for address, arg in self.words.findall(line)]
+            except ValueError:
+                return self.reference(line, sep)
+
+        codes = []
+        pos, end = 0, len(line)
+        while pos < end:
+            m = self.token.match(line, pos)
+            if m is None:
+                if line[pos:].strip(' '):
+                    return self.reference(line, sep)
+                break
+
+            address, arg, mark, comment = m.groups()
+            if address is not None:
+                try:
+                    codes.append(GCode(address.upper(), float(arg) if '.' in arg else int(arg)))
+                except ValueError:
+                    return self.reference(line, sep)
+            elif mark is not None:
+                codes.append(GFileMarker())
+            else:
+                # An opening parenthesis inside a comment restarts it
+                codes.append(GComment(comment.rsplit('(', 1)[-1]))
+            pos = m.end()
+
+        return codes
+
+    def iter_lines(self, string, first=True, final=True):
+        if '\r' in string:
+            parts = self.newline.split(string)
+            lines, seps = parts[::2], parts[1::2]
+        else:
+            lines = string.split('\n')
+            seps = None
+
+        if not final:
+            # The last line belongs to whatever comes after
+            lines.pop()
+
+        i, n = 0, len(lines)
+        while i < n:
+            line = lines[i]
+            sep = seps[i] if seps is not None and i < len(seps) else '\n'
+            i += 1
+
+            # Comments may span several lines
+            while '(' in line and line.rfind('(') > line.rfind(')'):
+                if i == n:
+                    if not final:
+                        raise GCodeParserError('Unterminated comment')
+                    # Unterminated comments are dropped along with the end of the input
+                    start = line.find('(', line.rfind(')') + 1)
+                    codes = self.codes(line[:start], line[start])
+                    if codes or not first:
+                        yield GStatement(*codes)
+                    return
+                line += sep + lines[i]
+                sep = seps[i] if seps is not None and i < len(seps) else '\n'
+                i += 1
+
+            codes = self.codes(line, sep)
+            # Like the reference, an empty first line does not get a statement
+            if codes or not first:
+                yield GStatement(*codes)
+            first = False
+
+        if final:
+            yield GStatement()
+
+    def split(self, data, start=0, end=None):
+        'Returns the end of the last complete line in data[start:end], or -1'
+        if end is None:
+            end = len(data)
+        last = max(data.rfind('\n', start, end), data.rfind('\r', start, end))
+        while last >= 0:
+            closing = data.rfind(')', start, last)
+            if data.rfind('(', start, last) <= closing:
+                break
+            # The line would end inside a comment, so split before it starts
+            opening = data.find('(', max(closing + 1, start), last)
+            last = max(data.rfind('\n', start, opening), data.rfind('\r', start, opening))
+        return last
+
+    def iter_parse(self, fileobj, size=65536):
+        'Parses fileobj in chunks of size bytes, yielding one statement at a time'
+        first = True
+        rest = ''
+        while True:
+            data = fileobj.read(size)
+            if not data:
+                break
+
+            data = rest + data
+            end = self.split(data)
+            if end < 0:
+                rest = data
+                continue
+
+            rest = data[end+1:]
+            for statement in self.iter_lines(data[:end+1], first, False):
+                yield statement
+            first = False
+
+        for statement in self.iter_lines(rest, first, True):
+            yield statement
+
+    def parse(self, string):
+        # None of the parsed objects can form reference cycles, so there is no
+        # point in letting the garbage collector rescan them as the list grows.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return list(self.iter_lines(string))
+        finally:
+            if enabled:
+                gc.enable()
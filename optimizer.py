@@ -1,207 +1,1379 @@
-from gcode import GStatement, GCode
-from math import sqrt
+from gcode import GStatement, GCode, GProgram, GWireImage
+from collections import deque
+from itertools import islice
+from math import sqrt, atan2, cos, floor, pi
+import resource
+import sys
+import time
+
+def peak_memory():
+    'Peak resident memory of the process in bytes'
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class PassProfile(object):
+    '''What one pass cost and what it saved
+
+    Bytes are those of the program written out with str(), counted outside
+    of the timed section. Peak memory is that of the whole process once the
+    pass is done, as Python 2 cannot tell which allocations were the pass's.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.statements_in = 0
+        self.statements_out = 0
+        self.codes_in = 0
+        self.codes_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.peak_memory = 0
+
+
 class Optimizer(object):
+    '''Runs statements through a list of passes
+
+    Set profile to a list to have a PassProfile appended to it for every
+    pass. The passes then run one after the other on whole programs rather
+    than chained, so each can be timed on its own. The output is the same.
+    '''
     def __init__(self, *args):
         self.optimizers = args
+        self.profile = None
 
-    def optimize(self, statements):
+    def iter_optimize(self, statements):
+        'Chains the passes, so that each statement runs through all of them before the next is read'
+        if self.profile is not None:
+            return iter(self.profiled(statements))
         for optimizer in self.optimizers:
-            statements = optimizer.optimize(statements)
+            if hasattr(optimizer, 'iter_optimize'):
+                statements = optimizer.iter_optimize(statements)
+            else:
+                statements = iter(optimizer.optimize(list(statements)))
         return statements
 
-class FileMarkRemover(object):
-    'Removes file markers'
     def optimize(self, statements):
-        for statement in statements:
-            codes = []
-            for code in statement:
-                if code.type != 'filemark':
-                    codes.append(code)
+        return list(self.iter_optimize(statements))
+
+    def profiled(self, statements):
+        program = statements if isinstance(statements, GProgram) else GProgram(statements)
+        nbytes = len(GWireImage(program).data)
+        for optimizer in self.optimizers:
+            profile = PassProfile(type(optimizer).__name__)
+            profile.statements_in, profile.codes_in, profile.bytes_in = len(program), len(program.addresses), nbytes
+
+            start = time.time()
+            if hasattr(optimizer, 'iter_optimize'):
+                program = GProgram(optimizer.iter_optimize(iter(program)))
+            else:
+                program = GProgram(optimizer.optimize(list(program)))
+            profile.seconds = time.time() - start
+
+            nbytes = len(GWireImage(program).data)
+            profile.statements_out, profile.codes_out, profile.bytes_out = len(program), len(program.addresses), nbytes
+            profile.peak_memory = peak_memory()
+            self.profile.append(profile)
+        return program
+
+    def reset(self):
+        for optimizer in self.optimizers:
+            optimizer.reset()
 
-            statement.codes = codes
+    def feed(self, statement):
+        '''Runs one statement through all passes, keeping their state. Together
+        with flush, this gives the same output as iter_optimize'''
+        statements = [statement]
+        for optimizer in self.optimizers:
+            statements = [nstatement for statement in statements for nstatement in optimizer.feed(statement)]
         return statements
 
-class FeedratePatcher(object):
-    'Ensures that F-codes are alone to help grbl'
+    def flush(self):
+        nstatements = []
+        for i, optimizer in enumerate(self.optimizers):
+            statements = list(optimizer.flush())
+            for following in self.optimizers[i+1:]:
+                statements = [nstatement for statement in statements for nstatement in following.feed(statement)]
+            nstatements.extend(statements)
+        return nstatements
+
+class OptimizerPass(object):
+    '''Base for passes that process one statement at a time, carrying their state between statements
+
+    Attributes named in counters only add up what the pass did, for
+    reporting. They do not affect its output, and start at zero on reset.
+    '''
+    counters = ()
+    def reset(self):
+        pass
+
+    def feed(self, statement):
+        return (statement,)
+
+    def flush(self):
+        return ()
+
+    def iter_optimize(self, statements):
+        self.reset()
+        for statement in statements:
+            for nstatement in self.feed(statement):
+                yield nstatement
+        for nstatement in self.flush():
+            yield nstatement
+
     def optimize(self, statements):
+        return list(self.iter_optimize(statements))
+
+class FileMarkRemover(OptimizerPass):
+    'Removes file markers'
+    def feed(self, statement):
+        codes = []
+        for code in statement:
+            if code.type != 'filemark':
+                codes.append(code)
+
+        statement.codes = codes
+        return (statement,)
+
+class FeedratePatcher(OptimizerPass):
+    'Ensures that F-codes are alone to help grbl'
+    def reset(self):
+        self.last_val = None
+
+    def feed(self, statement):
         cur_statement = GStatement()
-        nstatements = [cur_statement]
-        last_val = None
-        for statement in statements:
-            for code in statement:
-                if code.address == 'F':
-                    if code.command != last_val:
-                        s = GStatement(code)
-                        nstatements.insert(-1, s)
-                        last_val = code.command
-                else:
-                    cur_statement.append(code)
+        nstatements = []
+        for code in statement:
+            if code.address == 'F':
+                if code.command != self.last_val:
+                    nstatements.append(GStatement(code))
+                    self.last_val = code.command
+            else:
+                cur_statement.append(code)
 
-            cur_statement = GStatement()
-            nstatements.append(cur_statement)
+        nstatements.append(cur_statement)
         return nstatements
 
-class MPatcher(object):
+    def flush(self):
+        return (GStatement(),)
+
+class MPatcher(OptimizerPass):
     'Ensures that there is only one M-code per statement'
-    def optimize(self, statements):
+    def feed(self, statement):
         cur_statement = GStatement()
         nstatements = [cur_statement]
-        for statement in statements:
-            for code in statement:
-                if code.address == 'M':
-                    cur_statement = GStatement()
-                    nstatements.append(cur_statement)
-                cur_statement.append(code)
+        for code in statement:
+            if code.address == 'M':
+                cur_statement = GStatement()
+                nstatements.append(cur_statement)
+            cur_statement.append(code)
 
-            cur_statement = GStatement()
-            nstatements.append(cur_statement)
         return nstatements
 
-class CodeSaver(object):
+    def flush(self):
+        return (GStatement(),)
+
+class CodeSaver(OptimizerPass):
     'Ensures that no unnecessary G-codes are issued'
     move_desc = ('X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'K', 'R', 'F', 'S')
-    def optimize(self, statements):
+    def reset(self):
+        self.cur_code = None
+
+    def feed(self, statement):
         cur_statement = GStatement()
-        nstatements = [cur_statement]
-        cur_code = None
-        for statement in statements:
-            for code in statement:
-                if code.address in self.move_desc:
-                    cur_statement.append(code)
-                elif code == cur_code:
-                    pass
-                elif code.address == 'G' and code.command >= 0 and code.command <= 3:
-                    cur_code = code
-                    cur_statement.append(code)
-                else:
-                    cur_code = None
-                    cur_statement.append(code)
+        for code in statement:
+            if code.address in self.move_desc:
+                cur_statement.append(code)
+            elif code == self.cur_code:
+                pass
+            elif code.address == 'G' and code.command >= 0 and code.command <= 3:
+                self.cur_code = code
+                cur_statement.append(code)
+            else:
+                self.cur_code = None
+                cur_statement.append(code)
 
-            cur_statement = GStatement()
-            nstatements.append(cur_statement)
-        return nstatements
+        return (cur_statement,)
+
+    def flush(self):
+        return (GStatement(),)
 
-class EmptyMoveRemover(object):
+class EmptyMoveRemover(OptimizerPass):
     'Removes dummy move arguments'
     move_desc = ('X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'K', 'R', 'F', 'S')
-    def optimize(self, statements):
+    def reset(self):
+        self.state = {x:None for x in self.move_desc}
+        self.save = False
+
+    def feed(self, statement):
         cur_statement = GStatement()
-        nstatements = [cur_statement]
-        state = {x:None for x in self.move_desc}
-        save = False
-        for statement in statements:
-            for code in statement:
-                if code.address == 'G' and code.command in (0,1):
-                    save = True
-                elif code.address in ('G', 'M'):
-                    state = {x:None for x in self.move_desc}
-                    save = False
+        for code in statement:
+            if code.address == 'G' and code.command in (0,1):
+                self.save = True
+            elif code.address in ('G', 'M'):
+                self.state = {x:None for x in self.move_desc}
+                self.save = False
 
-                if not save:
-                    cur_statement.append(code)
-                    continue
+            if not self.save:
+                cur_statement.append(code)
+                continue
 
-                if code.address in self.move_desc:
-                    if code.command != state[code.address]:
-                        cur_statement.append(code)
-                        state[code.address] = code.command
-                else:
+            if code.address in self.move_desc:
+                if code.command != self.state[code.address]:
                     cur_statement.append(code)
+                    self.state[code.address] = code.command
+            else:
+                cur_statement.append(code)
+
+        return (cur_statement,)
+
+    def flush(self):
+        return (GStatement(),)
+
+class PositionTracker(object):
+    'Follows the modal state and tool position needed by the geometric passes'
+    axes = ('X', 'Y', 'Z')
+    lost = (10, 28, 28.1, 30, 30.1, 38.2, 53, 92, 92.1)
+    # Plane: indices of the first, second and linear axis, and the arc offset words
+    planes = {17: ((0, 1, 2), ('I', 'J')),
+              18: ((2, 0, 1), ('K', 'I')),
+              19: ((1, 2, 0), ('J', 'K'))}
+    def __init__(self):
+        self.metric = True
+        self.absolute = True
+        self.motion = None
+        self.plane = 17
+        self.position = (None, None, None)
+
+    def known(self):
+        return None not in self.position
+
+    def scale(self, mm):
+        'Converts mm to program units'
+        return mm if self.metric else mm / 25.4
+
+    def words(self, statement):
+        words = {}
+        for code in statement:
+            if code.type == 'code' and code.address in self.axes:
+                words[code.address] = code.command
+        return words
+
+    def target(self, words):
+        position = []
+        for axis, cur in zip(self.axes, self.position):
+            if axis not in words:
+                position.append(cur)
+            elif self.absolute:
+                position.append(words[axis])
+            elif cur is not None:
+                position.append(cur + words[axis])
+            else:
+                position.append(None)
+        return tuple(position)
+
+    def update(self, statement):
+        lost = False
+        for code in statement:
+            if code.type != 'code' or code.address != 'G':
+                continue
+            command = code.command
+            if command in (0, 1, 2, 3, 38.2):
+                self.motion = command
+            elif command == 80:
+                self.motion = None
+            elif command in (17, 18, 19):
+                self.plane = command
+            elif command in (20, 21):
+                if self.metric != (command == 21):
+                    lost = True
+                self.metric = command == 21
+            elif command == 90:
+                self.absolute = True
+            elif command == 91:
+                self.absolute = False
+
+            if command in self.lost:
+                lost = True
+
+        if lost:
+            self.position = (None, None, None)
+        else:
+            self.position = self.target(self.words(statement))
+
+
+def distance(p, a, b):
+    'Distance from point p to the segment from a to b'
+    dx, dy, dz = b[0]-a[0], b[1]-a[1], b[2]-a[2]
+    px, py, pz = p[0]-a[0], p[1]-a[1], p[2]-a[2]
+    length = dx*dx + dy*dy + dz*dz
+    if length:
+        t = max(0.0, min(1.0, (px*dx + py*dy + pz*dz) / float(length)))
+        px, py, pz = px - t*dx, py - t*dy, pz - t*dz
+    return sqrt(px*px + py*py + pz*pz)
+
+
+def planar(a, b):
+    'Distance between two points in the XY plane'
+    return sqrt((b[0] - a[0]) ** 2 + (b[1] - a[1]) ** 2)
+
+
+def simplify(points, tolerance):
+    'Douglas-Peucker, returning the indices of the points to keep'
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        a, b = points[first], points[last]
+        worst, index = tolerance, None
+        for i in range(first + 1, last):
+            d = distance(points[i], a, b)
+            if d > worst:
+                worst, index = d, i
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i, k in enumerate(keep) if k]
+
+
+def circle(p, q, r):
+    'Center of the circle through three points in a plane, or None if they are on a line'
+    bx, by = q[0] - p[0], q[1] - p[1]
+    cx, cy = r[0] - p[0], r[1] - p[1]
+    d = 2 * (bx * cy - by * cx)
+    if abs(d) < 1e-12:
+        return None
+    b2, c2 = bx * bx + by * by, cx * cx + cy * cy
+    return (p[0] + (cy * b2 - by * c2) / d, p[1] + (bx * c2 - cx * b2) / d)
+
+
+def fit_arc(points, tolerance):
+    '''Fits an arc through points in a plane
+
+    Returns the center, radius, sweep and whether the arc is clockwise, or
+    None if any point or chord strays more than tolerance from the arc.
+    '''
+    center = circle(points[0], points[len(points) // 2], points[-1])
+    if center is None:
+        return None
+
+    cx, cy = center
+    radius = sqrt((points[0][0] - cx) ** 2 + (points[0][1] - cy) ** 2)
+    sweep = 0.0
+    for p, q in zip(points, points[1:]):
+        px, py, qx, qy = p[0] - cx, p[1] - cy, q[0] - cx, q[1] - cy
+        if abs(sqrt(qx * qx + qy * qy) - radius) > tolerance:
+            return None
+        half = ((qx - px) ** 2 + (qy - py) ** 2) / 4
+        if half > radius * radius or radius - sqrt(radius * radius - half) > tolerance:
+            return None
+        angle = atan2(px * qy - py * qx, px * qx + py * qy)
+        if angle == 0 or (sweep and (angle > 0) != (sweep > 0)):
+            return None
+        sweep += angle
+
+    if abs(sweep) > 2 * pi - 1e-6:
+        return None
+    return center, radius, abs(sweep), sweep < 0
+
+
+class ArcFitter(OptimizerPass):
+    'Replaces runs of G1 moves lying on a circle within tolerance (in mm) with G2/G3 arcs'
+    move_desc = ('X', 'Y', 'Z')
+    min_moves = 3
+    def __init__(self, tolerance=0.01, max_run=1000):
+        self.tolerance = tolerance
+        self.max_run = max_run
+
+    def reset(self):
+        self.tracker = PositionTracker()
+        self.run = []
+        self.start = None
+        # An arc left the machine in G2/G3 where the program expects G1
+        self.restore = False
+
+    def is_move(self, statement):
+        if not self.tracker.absolute or not self.tracker.known():
+            return False
+
+        motion = self.tracker.motion
+        moves = False
+        for code in statement:
+            if code.type != 'code':
+                return False
+            if code.address in self.move_desc:
+                moves = True
+            elif code.address == 'G' and code.command == 1:
+                motion = 1
+            else:
+                return False
+        return moves and motion == 1
+
+    def emit(self, statement):
+        if not self.restore:
+            return statement
+
+        gcodes = [code.command for code in statement if code.type == 'code' and code.address == 'G']
+        if [g for g in gcodes if g in (0, 1, 2, 3, 38.2, 80)]:
+            self.restore = False
+        elif not [g for g in gcodes if g in (10, 28, 30, 53, 92)] and \
+                [code for code in statement if code.type == 'code' and code.address in self.move_desc]:
+            statement.codes.insert(0, GCode('G', self.tracker.motion))
+            self.restore = False
+        return statement
+
+    def feed(self, statement):
+        if not self.is_move(statement):
+            nstatements = self.flush()
+            nstatements.append(self.emit(statement))
+            self.tracker.update(statement)
+            return nstatements
+
+        if not self.run:
+            self.start = self.tracker.position
+            self.plane = self.tracker.plane
+        self.tracker.update(statement)
+        self.run.append((statement, self.tracker.position))
+
+        if len(self.run) >= self.max_run:
+            return self.flush()
+        return ()
+
+    def fit(self, points, first, last):
+        (a0, a1, linear), offsets = self.tracker.planes[self.plane]
+        if any(points[i][linear] != points[first][linear] for i in range(first, last + 1)):
+            return None
+        plane = [(points[i][a0], points[i][a1]) for i in range(first, last + 1)]
+        return fit_arc(plane, self.tracker.scale(self.tolerance))
+
+    def curved(self, fitted):
+        center, radius, sweep, clockwise = fitted
+        return radius * (1 - cos(min(sweep, pi) / 2)) > self.tracker.scale(self.tolerance)
+
+    def arc(self, points, first, last, fitted):
+        (a0, a1, linear), offsets = self.tracker.planes[self.plane]
+        (c0, c1), radius, sweep, clockwise = fitted
+        start, end = points[first], points[last]
+        self.restore = True
+        return GStatement(GCode('G', 2 if clockwise else 3),
+                          GCode(self.move_desc[a0], end[a0]),
+                          GCode(self.move_desc[a1], end[a1]),
+                          GCode(offsets[0], float(c0 - start[a0])),
+                          GCode(offsets[1], float(c1 - start[a1])))
+
+    def flush(self):
+        if not self.run:
+            return []
+
+        run, self.run = self.run, []
+        points = [self.start] + [position for statement, position in run]
+        nstatements = []
+        first = 0
+        while first < len(run):
+            # Grow the arc in doubling steps, then narrow down on the longest that fits
+            step, good, fitted = self.min_moves, None, None
+            while first + step <= len(run):
+                result = self.fit(points, first, first + step)
+                if result is None:
+                    break
+                good, fitted = first + step, result
+                step *= 2
+            if good is not None:
+                low, high = good, min(first + step, len(run) + 1)
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    result = self.fit(points, first, middle)
+                    if result is None:
+                        high = middle
+                    else:
+                        low, fitted = middle, result
+
+            # Arcs too flat to tell from a straight line are left to LinearMoveSaver
+            if good is not None and self.curved(fitted):
+                nstatements.append(self.arc(points, first, low, fitted))
+                first = low
+            else:
+                nstatements.append(self.emit(run[first][0]))
+                first += 1
 
-            cur_statement = GStatement()
-            nstatements.append(cur_statement)
         return nstatements
 
-class LinearMoveSaver(object):
-    'Removes dummy move arguments'
+
+class LinearMoveSaver(OptimizerPass):
+    'Drops G0/G1 moves that stay within tolerance (in mm) of the straight line past them'
     move_desc = ('X', 'Y', 'Z')
-    def optimize(self, statements):
+    def __init__(self, tolerance=0.01, max_run=1000):
+        self.tolerance = tolerance
+        self.max_run = max_run
+
+    def reset(self):
+        self.tracker = PositionTracker()
+        self.run = []
+        self.start = None
+
+    def is_move(self, statement):
+        if not self.tracker.absolute or not self.tracker.known():
+            return False
+
+        motion = self.tracker.motion
+        moves = False
+        for code in statement:
+            if code.type != 'code':
+                return False
+            if code.address in self.move_desc:
+                moves = True
+            elif code.address == 'G' and code.command in (0, 1):
+                motion = code.command
+            else:
+                return False
+
+        if not moves or motion not in (0, 1):
+            return False
+        return not self.run or motion == self.motion
+
+    def feed(self, statement):
+        if not self.is_move(statement):
+            nstatements = self.flush()
+            self.tracker.update(statement)
+            nstatements.append(statement)
+            return nstatements
+
+        if not self.run:
+            self.start = self.tracker.position
+        self.tracker.update(statement)
+        self.motion = self.tracker.motion
+        self.run.append((statement, self.tracker.position))
+
+        if len(self.run) >= self.max_run:
+            return self.flush()
+        return ()
+
+    def flush(self):
+        if not self.run:
+            return []
+
+        run, self.run = self.run, []
+        points = [self.start] + [position for statement, position in run]
+        keep = simplify(points, self.tracker.scale(self.tolerance))
+
         nstatements = []
-        state = {x:0 for x in self.move_desc}
-        last_vector = (None, None, None)
-        for statement in statements:
-            nstate = {x:state[x] for x in state}
-            for code in statement:
-                if code.address == 'G' and code.command in (0,1):
-                    save = True
-                elif code.address in self.move_desc:
-                    nstate[code.address] = code.command
-                elif code.address == 'F':
-                    if len(statement) != 1:
-                        raise RuntimeError("LinearMoveSaver requires FeedratePatcher to have run!")
-                    nstatements.append(statement)
-                    continue
-                else:
-                    save = False
-
-            if not save:
-                # Not only an X/Y/Z move...
-                state = nstate
-                last_vector = (None, None, None)
-                nstatements.append(statement)
+        for prev, index in zip(keep, keep[1:]):
+            if index == prev + 1:
+                nstatements.append(run[index-1][0])
                 continue
 
-            dX, dY, dZ = (nstate['X'] - state['X'],
-                         nstate['Y'] - state['Y'],
-                         nstate['Z'] - state['Z'])
+            # Moves were dropped, so restate whatever they changed
+            skipped = [statement for statement, position in run[prev:index]]
+            codes = []
+            if any(code.address == 'G' for statement in skipped for code in statement):
+                codes.append(GCode('G', self.motion))
+            for i, axis in enumerate(self.move_desc):
+                if points[index][i] == points[prev][i]:
+                    continue
+                for statement in reversed(skipped):
+                    words = [code for code in statement if code.address == axis]
+                    if words:
+                        codes.append(words[-1])
+                        break
+            if codes:
+                nstatements.append(GStatement(*codes))
+
+        return nstatements
+
+class RetractSaver(OptimizerPass):
+    '''Replaces a retract to the travel height, the highest Z so far, a hop
+    and a plunge back to the same depth with a straight move at that depth.
+    Lower retracts, like those over holding tabs, stay.
+
+    A hop qualifies when it is at most distance (in mm) long, or when it
+    runs along straight cuts made at that depth or deeper, never straying
+    more than tolerance (in mm) from them, so the move at depth only cuts
+    air. The last history cuts are remembered for that. Rapids down that
+    stay above the depth may come before the plunge, which has to be a G1,
+    and the move at depth keeps its feedrate.
+
+    Retracts removed are counted in removed, and the Z travel saved, in mm,
+    is summed into lifted.
+    '''
+    axes = ('X', 'Y', 'Z')
+    counters = ('removed', 'lifted')
+    # Size of the grid cells cuts are looked up in, in mm. Cuts longer than 20 cells are not remembered
+    cell = 5.0
+    max_samples = 2000
+    def __init__(self, distance=1.0, tolerance=0.05, history=2000):
+        self.distance = distance
+        self.tolerance = tolerance
+        self.history = history
+
+    def reset(self):
+        self.tracker = PositionTracker()
+        self.run = []
+        # Where the retract started, and the highest Z since
+        self.origin = None
+        self.peak = None
+        self.top = None
+        self.feeds = []
+        self.forget()
+        self.removed = 0
+        self.lifted = 0.0
+
+    def classify(self, statement):
+        'Tells retracts, plunges, rapids without Z and statements only setting the feedrate apart'
+        if not self.tracker.absolute or not self.tracker.known():
+            return None
+        motion = self.tracker.motion
+        axes = set()
+        for code in statement:
+            if code.type != 'code':
+                return None
+            if code.address == 'G' and code.command in (0, 1):
+                motion = code.command
+            elif code.address in self.axes:
+                axes.add(code.address)
+            elif code.address != 'F':
+                return None
+
+        if axes == set('Z'):
+            z = self.tracker.target(self.tracker.words(statement))[2]
+            if z > self.tracker.position[2]:
+                return 'retract'
+            if z < self.tracker.position[2]:
+                return 'plunge' if motion == 1 else 'approach' if motion == 0 else None
+        elif axes and 'Z' not in axes and motion == 0:
+            return 'hop'
+        elif not axes and motion == self.tracker.motion:
+            return 'feedrate'
+        return None
+
+    def mm(self, distance):
+        return distance if self.tracker.metric else distance * 25.4
+
+    def feed(self, statement):
+        kind = self.classify(statement)
+        start = self.tracker.position
+        self.tracker.update(statement)
+        position = self.tracker.position
+        feeds = [code.command for code in statement if code.type == 'code' and code.address == 'F']
+        if position[2] is not None and (self.top is None or position[2] > self.top):
+            self.top = position[2]
+        if None in position and self.cuts:
+            # Unit or offset changes leave the cuts so far somewhere else
+            self.forget()
+
+        nstatements = []
+        if self.run:
+            depth = self.origin[2]
+            if kind in ('hop', 'feedrate') or kind == 'approach' and position[2] > depth:
+                self.run.append(statement)
+                self.feeds.extend(feeds)
+                return ()
+            if kind == 'plunge' and position[2] == depth and self.peak >= self.top and \
+                    self.is_air(self.origin, position):
+                self.feeds.extend(feeds)
+                return self.replace(position)
+            nstatements, self.run = self.run, []
+
+        if kind == 'retract':
+            self.run = [statement]
+            self.origin = start
+            self.peak = position[2]
+            self.feeds = feeds
+            return nstatements
+
+        if kind is None and self.tracker.motion == 1 and None not in start and \
+                self.tracker.known() and position[:2] != start[:2]:
+            self.remember(start, position)
+        nstatements.append(statement)
+        return nstatements
+
+    def replace(self, position):
+        self.removed += 1
+        self.lifted += 2 * self.mm(self.peak - self.origin[2])
+        self.run = []
+
+        nstatements = []
+        if self.feeds:
+            nstatements.append(GStatement(GCode('F', self.feeds[-1])))
+        codes = [GCode('G', 1)]
+        for axis, a, b in zip(self.axes, self.origin, position):
+            if a != b:
+                codes.append(GCode(axis, b))
+        if len(codes) == 1:
+            codes.append(GCode('Z', position[2]))
+        nstatements.append(GStatement(*codes))
+        self.remember(self.origin, position)
+        return nstatements
+
+    def cell_of(self, x, y):
+        size = self.tracker.scale(self.cell)
+        return int(floor(x / size)), int(floor(y / size))
+
+    def remember(self, a, b):
+        'Notes a straight cut, as the segment and the depth it cut down to everywhere along it'
+        if not self.tolerance or planar(a, b) > self.tracker.scale(self.cell) * 20:
+            return
+        self.cuts.append([((a[0], a[1], 0.0), (b[0], b[1], 0.0), max(a[2], b[2])), None])
+        self.unindexed += 1
+        if len(self.cuts) > self.history:
+            cut, cells = self.cuts.popleft()
+            if cells is None:
+                self.unindexed -= 1
+                return
+            for cell in cells:
+                cuts = self.grid[cell]
+                cuts.remove(cut)
+                if not cuts:
+                    del self.grid[cell]
+
+    def forget(self):
+        self.cuts = deque()
+        self.unindexed = 0
+        self.grid = {}
+
+    def index(self):
+        'Adds the cuts remembered since the last hop that needed them to the grid'
+        margin = self.tracker.scale(self.tolerance)
+        for entry in islice(reversed(self.cuts), self.unindexed):
+            (ax, ay, _), (bx, by, _), depth = entry[0]
+            low = self.cell_of(min(ax, bx) - margin, min(ay, by) - margin)
+            high = self.cell_of(max(ax, bx) + margin, max(ay, by) + margin)
+            entry[1] = [(i, j) for i in range(low[0], high[0] + 1) for j in range(low[1], high[1] + 1)]
+            for cell in entry[1]:
+                self.grid.setdefault(cell, []).append(entry[0])
+        self.unindexed = 0
+
+    def is_air(self, a, b):
+        'Whether moving from a to b at the depth of a only recuts what was cut before'
+        length = planar(a, b)
+        if length <= self.tracker.scale(self.distance):
+            return True
+        if not self.tolerance:
+            return False
+
+        tolerance = self.tracker.scale(self.tolerance)
+        n = int(length / tolerance) + 1
+        if n > self.max_samples:
+            return False
+        self.index()
+        for k in range(n + 1):
+            t = float(k) / n
+            p = (a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1]), 0.0)
+            cuts = self.grid.get(self.cell_of(p[0], p[1]), ())
+            if not any(depth <= a[2] and distance(p, c, d) <= tolerance for c, d, depth in cuts):
+                return False
+        return True
+
+    def flush(self):
+        nstatements, self.run = self.run, []
+        return nstatements
+
+class AirMovePromoter(OptimizerPass):
+    '''Turns G1 moves that stay above the stock into rapids
+
+    A move qualifies when it starts and ends above stock_top, a Z in mm.
+    Runs of such moves, along with the rapids and feedrate changes between
+    them, are sent on as G0 moves, one for every point they visit, bar
+    points lying exactly on the line between their neighbours. The feedrate
+    they leave is restated once after the run, if it changed, and the motion
+    mode on the first move that relies on it.
+
+    Moves promoted are counted in promoted, and their length, in mm, is
+    summed into promoted_length.
+    '''
+    axes = ('X', 'Y', 'Z')
+    counters = ('promoted', 'promoted_length')
+    motions = (0, 1, 2, 3, 38.2, 80)
+    nonmodal = (4, 10, 28, 28.1, 30, 30.1, 92, 92.1)
+    def __init__(self, stock_top, max_run=1000):
+        self.stock_top = stock_top
+        self.max_run = max_run
+
+    def reset(self):
+        self.tracker = PositionTracker()
+        self.inverse = False
+        self.feedrate = None
+        # Statements with the motion they move with, None if they do not, and where they end
+        self.run = []
+        self.start = None
+        # The motion mode the statements sent on so far left
+        self.out_motion = None
+        self.promoted = 0
+        self.promoted_length = 0.0
 
-            state = nstate
+    def is_air(self, statement):
+        'Whether a statement only moves above the stock or sets the feedrate, and what it moves with'
+        if not self.tracker.absolute or self.inverse or not self.tracker.known():
+            return False, None
+        top = self.tracker.scale(self.stock_top)
+        if self.tracker.position[2] <= top:
+            return False, None
+        motion = self.tracker.motion
+        moves = False
+        for code in statement:
+            if code.type != 'code':
+                return False, None
+            if code.address == 'G' and code.command in (0, 1):
+                motion = code.command
+            elif code.address in self.axes:
+                moves = True
+            elif code.address != 'F':
+                return False, None
+        if not moves:
+            return motion == self.tracker.motion, None
+        if motion not in (0, 1):
+            return False, None
 
-            norm = sqrt(dX**2 + dY**2 + dZ**2)
+        return self.tracker.target(self.tracker.words(statement))[2] > top, motion
 
-            if (dX, dY, dZ) == (0, 0, 0):
-                # Well, this is stupid.
+    def mm(self, distance):
+        return distance if self.tracker.metric else distance * 25.4
+
+    def pass_on(self, statement, motion):
+        'Writes out the motion mode a statement moves with, when what was sent on before left another'
+        gcodes = [code.command for code in statement if code.type == 'code' and code.address == 'G']
+        if any(g in self.motions for g in gcodes):
+            self.out_motion = motion
+        elif motion is not None and motion != self.out_motion and not any(g in self.nonmodal for g in gcodes) and \
+                any(code.type == 'code' and code.address in 'XYZIJKR' for code in statement):
+            statement.codes.insert(0, GCode('G', motion))
+            self.out_motion = motion
+        return statement
+
+    def feed(self, statement):
+        air, motion = self.is_air(statement)
+        if air:
+            if not self.run:
+                self.start = self.tracker.position
+            self.tracker.update(statement)
+            self.run.append((statement, motion, self.tracker.position))
+            if len(self.run) >= self.max_run:
+                return self.flush()
+            return ()
+
+        nstatements = self.flush()
+        for code in statement:
+            if code.type != 'code':
                 continue
+            if code.address == 'G' and code.command in (93, 94):
+                self.inverse = code.command == 93
+            elif code.address == 'F':
+                self.feedrate = code.command
+        self.tracker.update(statement)
+        nstatements.append(self.pass_on(statement, self.tracker.motion))
+        return nstatements
 
-            vector = (dX/norm, dY/norm, dZ/norm)
+    def flush(self):
+        if not self.run:
+            return []
+        run, self.run = self.run, []
+        feedrate = self.feedrate
+        for statement, motion, position in run:
+            for code in statement:
+                if code.address == 'F':
+                    self.feedrate = code.command
+        if not any(motion == 1 for statement, motion, position in run):
+            # Nothing to promote
+            return [self.pass_on(statement, motion) for statement, motion, position in run]
 
-            if vector == last_vector:
-                nstatements.pop()
-            else:
-                last_vector = vector
+        moves = [(motion, position) for statement, motion, position in run if motion is not None]
+        points = [self.start] + [position for motion, position in moves]
+        for (motion, position), previous in zip(moves, points):
+            if motion == 1:
+                self.promoted += 1
+                self.promoted_length += self.mm(sqrt(sum((b - a) ** 2 for a, b in zip(previous, position))))
 
-            nstatements.append(statement)
+        nstatements = []
+        here = self.start
+        for i in range(1, len(points)):
+            # Points on the way from where the rapids are to the next one add nothing to the path
+            if i + 1 < len(points) and distance(points[i], here, points[i + 1]) == 0:
+                continue
+            codes = [GCode(axis, b) for axis, a, b in zip(self.axes, here, points[i]) if a != b]
+            if codes:
+                nstatements.append(self.pass_on(GStatement(*codes), 0))
+                here = points[i]
+        if self.feedrate != feedrate:
+            nstatements.append(GStatement(GCode('F', self.feedrate)))
+        return nstatements
+
+class Island(object):
+    'The statements from leaving the travel height until returning to it'
+    def __init__(self, entry):
+        self.entry = entry
+        self.exit = entry
+        # (statement, motion and feedrate in effect before it, position after it)
+        self.body = []
+        self.low = list(entry[:2])
+        self.high = list(entry[:2])
+        self.path = None
+
+    def include(self, x, y, r=0.0):
+        low, high = self.low, self.high
+        if x - r < low[0]:
+            low[0] = x - r
+        if y - r < low[1]:
+            low[1] = y - r
+        if x + r > high[0]:
+            high[0] = x + r
+        if y + r > high[1]:
+            high[1] = y + r
+
+    def add(self, statement, context, position, start):
+        self.body.append((statement, context, position))
+        self.exit = position
+        self.include(position[0], position[1])
+        if not any(code.address in 'IJR' for code in statement):
+            return
+        words = dict((code.address, code.command) for code in statement)
+        if 'R' in words:
+            self.include(position[0], position[1], abs(words['R']))
+        elif 'I' in words or 'J' in words:
+            # The whole circle, rather than working out which part the arc sweeps
+            cx, cy = start[0] + words.get('I', 0), start[1] + words.get('J', 0)
+            self.include(cx, cy, sqrt((start[0] - cx) ** 2 + (start[1] - cy) ** 2))
+
+    def overlaps(self, other, margin):
+        return (self.low[0] - margin <= other.high[0] and other.low[0] - margin <= self.high[0] and
+                self.low[1] - margin <= other.high[1] and other.low[1] - margin <= self.high[1])
 
+    @property
+    def closed(self):
+        return self.entry[:2] == self.exit[:2]
+
+    def find_path(self, top):
+        '''Looks for a plunge, straight G1 moves at a single depth and a
+        retract, the only shape cut backwards. Sets path to the plunge and
+        cut feedrates, the depth and the points visited'''
+        body = [(statement, context, position) for statement, context, position in self.body
+                if any(code.address in 'XYZ' for code in statement)]
+        if len(body) < 3:
+            return
+        (plunge, (motion, plunge_feed), bottom), moves, (retract, context, end) = body[0], body[1:-1], body[-1]
+        if bottom[:2] != self.entry[:2] or bottom[2] >= top or any(code.address in 'XY' for code in retract):
+            return
+        for code in plunge:
+            if code.address == 'F':
+                plunge_feed = code.command
+        points = [self.entry[:2]]
+        feeds = set()
+        for statement, (motion, feed), position in moves:
+            gcodes = [code.command for code in statement if code.address == 'G']
+            if position[2] != bottom[2] or (gcodes and gcodes != [1]) or (not gcodes and motion != 1):
+                return
+            if any(code.address not in 'GXY' for code in statement):
+                return
+            feeds.add(feed)
+            points.append(position[:2])
+        if len(feeds) != 1 or None in feeds or plunge_feed is None:
+            return
+        self.path = (plunge_feed, feeds.pop(), bottom[2], points)
+
+    def reversed(self):
+        'The body, cutting the path the other way'
+        plunge_feed, feed, depth, points = self.path
+        statement, context, end = self.body[-1]
+        body = [(GStatement(GCode('Z', depth)), (1, plunge_feed), points[-1] + (depth,))]
+        for x, y in reversed(points[:-1]):
+            body.append((GStatement(GCode('X', x), GCode('Y', y)), (1, feed), (x, y, depth)))
+        body.append((statement, context, points[0] + (end[2],)))
+        return body
+
+
+class RapidReorderer(OptimizerPass):
+    '''Reorders cut islands to shorten the rapids between them
+
+    An island runs from leaving the travel height, the highest Z so far, to
+    returning to it. Islands are only reordered among runs of statements
+    that do nothing but move in absolute mode and set feedrates, so tool,
+    spindle, coolant and other M codes, and mode and unit changes stay where
+    they are. Islands coming within margin (in mm) of each other keep their
+    order, as a later one may cut deeper into what an earlier one left.
+    The order is found nearest neighbour first and then improved with 2-opt.
+
+    Closed paths end where they start, so turning them around cannot shorten
+    a rapid. With reverse, open paths cut with straight moves at a single
+    depth may be cut backwards, which swaps climb and conventional milling.
+
+    Islands cut in another place or direction than the program had them are
+    counted in reordered, and rapid distances in mm, between islands as
+    straight lines, are summed into before and after.
+    '''
+    axes = ('X', 'Y', 'Z')
+    allowed = ('G', 'X', 'Y', 'Z', 'I', 'J', 'R', 'F')
+    counters = ('reordered', 'before', 'after')
+    nonmodal = (4, 10, 28, 28.1, 30, 30.1, 53, 92, 92.1)
+    max_overlaps = 20
+    def __init__(self, margin=3.175, reverse=False, max_islands=1000, max_run=20000):
+        self.margin = margin
+        self.reverse = reverse
+        self.max_islands = max_islands
+        self.max_run = max_run
+
+    def reset(self):
+        self.tracker = PositionTracker()
+        self.feedrate = None
+        self.top = None
+        self.islands = []
+        self.current = None
+        # Where the tool was when the islands being collected began, None outside of a run
+        self.start = None
+        self.buffered = 0
+        # What the statements sent on so far left the machine in
+        self.out_motion = None
+        self.out_feed = None
+        self.out_xy = None
+        # Where the program has the tool, if reordered islands left it elsewhere
+        self.pending = None
+        self.reordered = 0
+        self.before = 0.0
+        self.after = 0.0
+
+    def is_simple(self, statement):
+        if not self.tracker.absolute or self.tracker.plane != 17 or not self.tracker.known():
+            return False
+        for code in statement:
+            if code.type != 'code' or code.address not in self.allowed:
+                return False
+            if code.address == 'G' and code.command not in (0, 1, 2, 3):
+                return False
+        return True
+
+    def is_travel(self, statement, motion):
+        'Moves at the travel height, and statements that only set modes, dropped between islands'
+        for code in statement:
+            if code.address == 'G':
+                motion = code.command
+            elif code.address in 'IJR':
+                return False
+        return motion == 0 or not any(code.address in self.axes for code in statement)
+
+    def mm(self, distance):
+        return distance if self.tracker.metric else distance * 25.4
+
+    def feed(self, statement):
+        context = (self.tracker.motion, self.feedrate)
+        start = self.tracker.position
+        simple = self.is_simple(statement)
+        self.tracker.update(statement)
+        for code in statement:
+            if code.address == 'F':
+                self.feedrate = code.command
+        position = self.tracker.position
+
+        if not simple or not self.tracker.known():
+            nstatements = self.settle(start)
+            nstatements.extend(self.restore())
+            nstatements.extend(self.emit(statement, context, position))
+            self.start = None
+            return nstatements
+
+        if self.top is None or position[2] > self.top:
+            nstatements = self.settle(start)
+            nstatements.extend(self.restore())
+            nstatements.extend(self.emit(statement, context, position))
+            self.top = position[2]
+            self.start = position
+            return nstatements
+
+        at_top = position[2] >= self.top
+        if self.current is None:
+            if self.start is None:
+                if at_top:
+                    self.start = position
+                return self.emit(statement, context, position)
+            if at_top and start[2] >= self.top and self.is_travel(statement, context[0]):
+                return ()
+            self.current = Island(start)
+
+        self.current.add(statement, context, position, start)
+        self.buffered += 1
+        if at_top:
+            if self.reverse and not self.current.closed:
+                self.current.find_path(self.top)
+            self.islands.append(self.current)
+            self.current = None
+        if len(self.islands) >= self.max_islands or self.buffered >= self.max_run:
+            return self.settle(position)
+        return ()
+
+    def flush(self):
+        nstatements = self.settle(self.tracker.position)
+        nstatements.extend(self.restore())
+        return nstatements
+
+    def settle(self, position):
+        '''Sends the islands collected so far on, reordered, followed by the
+        one still being cut, if any. position is where the program has the
+        tool by now, which is where it has to be moved back to if the islands
+        left it elsewhere.'''
+        islands, tail = self.islands, self.current
+        if not islands and tail is None:
+            # Travel may still have been dropped since islands were last sent on
+            if self.start is not None and None not in position[:2] and self.out_xy not in (None, position[:2]):
+                self.before += self.mm(planar(self.start, position))
+                self.start = position
+                self.pending = position
+            return []
+
+        here, rapids = self.start, 0.0
+        for island in islands + ([tail] if tail else []):
+            rapids += planar(here, island.entry)
+            here = island.exit
+        if tail is None:
+            rapids += planar(here, position)
+        self.before += self.mm(rapids)
+
+        if rapids or self.out_xy != self.start[:2]:
+            end = tail.entry[:2] if tail is not None else position[:2]
+            order = self.order(islands, self.out_xy or self.start[:2], end)
+        else:
+            # Every island starts where the one before ended, nothing to gain
+            order = [(island, False) for island in islands]
+        if tail is not None:
+            order.append((tail, False))
+        nstatements = []
+        for island, flipped in order:
+            nstatements.extend(self.visit(island, flipped))
+
+        # Islands the order left in place and the right way round were not reordered
+        self.reordered += sum(1 for k, (island, flipped) in enumerate(order[:len(islands)])
+                              if flipped or island is not islands[k])
+        self.islands, self.current, self.buffered = [], None, 0
+        if tail is not None:
+            self.start = None
+        else:
+            self.start = position
+            if self.out_xy != position[:2]:
+                self.pending = position
+        return nstatements
+
+    def restore(self):
+        'Moves the tool back to where the program has it, after islands were reordered'
+        if self.pending is None:
+            return []
+        pending, self.pending = self.pending, None
+        self.after += self.mm(planar(self.out_xy, pending))
+        return self.travel(pending)
+
+    def order(self, islands, start, end):
+        '''Orders islands going from start to end nearest neighbour first,
+        then improves on that with 2-opt, reversing stretches of islands,
+        keeping the order they came in unless that is shorter. Returns
+        (island, flipped) pairs'''
+        n = len(islands)
+        if not n:
+            return []
+        flippable = [island.closed or island.path is not None for island in islands]
+        ends = [((i.entry[:2], i.exit[:2]), (i.exit[:2], i.entry[:2])) for i in islands]
+
+        # Islands that have to come before each island, by index. When most
+        # islands overlap, there is little freedom left and the order is kept
+        before = [set() for i in range(n)]
+        margin = self.tracker.scale(self.margin)
+        by_x = sorted(range(n), key=lambda i: islands[i].low[0])
+        edges = 0
+        for k, i in enumerate(by_x):
+            for j in by_x[k + 1:]:
+                if islands[j].low[0] - margin > islands[i].high[0]:
+                    break
+                if islands[i].overlaps(islands[j], margin):
+                    before[max(i, j)].add(min(i, j))
+                    edges += 1
+            if edges > self.max_overlaps * n:
+                return [(island, False) for island in islands]
+
+        waiting = [len(b) for b in before]
+        after = [[] for i in range(n)]
+        for j in range(n):
+            for i in before[j]:
+                after[i].append(j)
+
+        ready = set(i for i in range(n) if not waiting[i])
+        sequence, flips = [], []
+        here = start
+        while ready:
+            best = None
+            for i in ready:
+                for flip in ((False, True) if flippable[i] else (False,)):
+                    d = planar(here, ends[i][flip][0])
+                    if best is None or d < best[0]:
+                        best = (d, i, flip)
+            d, i, flip = best
+            ready.remove(i)
+            sequence.append(i)
+            flips.append(flip)
+            here = ends[i][flip][1]
+            for j in after[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    ready.add(j)
+
+        def link(a, fa, b, fb):
+            return planar(ends[a][fa][1], ends[b][fb][0])
+
+        def flipped(i, flip):
+            return not flip if flippable[i] else flip
+
+        def sums():
+            'Cost of the links inside any stretch, as it is and turned around'
+            forward, backward = [0.0], [0.0]
+            for p in range(n - 1):
+                a, b = sequence[p], sequence[p + 1]
+                forward.append(forward[-1] + link(a, flips[p], b, flips[p + 1]))
+                backward.append(backward[-1] + link(b, flipped(b, flips[p + 1]), a, flipped(a, flips[p])))
+            return forward, backward
+
+        improved, sweeps = True, 0
+        while improved and sweeps < 10:
+            improved = False
+            sweeps += 1
+            forward, backward = sums()
+            for i in range(n - 1):
+                a, fa = sequence[i], flips[i]
+                enter = planar(start, ends[a][fa][0]) if i == 0 else link(sequence[i - 1], flips[i - 1], a, fa)
+                inside = set([a])
+                for k in range(i + 1, n):
+                    b, fb = sequence[k], flips[k]
+                    if before[b] & inside:
+                        break
+                    inside.add(b)
+                    old = enter + forward[k] - forward[i]
+                    new = backward[k] - backward[i]
+                    if i == 0:
+                        new += planar(start, ends[b][flipped(b, fb)][0])
+                    else:
+                        new += link(sequence[i - 1], flips[i - 1], b, flipped(b, fb))
+                    if k < n - 1:
+                        c, fc = sequence[k + 1], flips[k + 1]
+                        old += link(b, fb, c, fc)
+                        new += link(a, flipped(a, fa), c, fc)
+                    else:
+                        old += planar(ends[b][fb][1], end)
+                        new += planar(ends[a][flipped(a, fa)][1], end)
+                    if new < old - 1e-9:
+                        sequence[i:k + 1] = reversed(sequence[i:k + 1])
+                        flips[i:k + 1] = [flipped(j, f) for j, f in zip(sequence[i:k + 1], reversed(flips[i:k + 1]))]
+                        forward, backward = sums()
+                        improved = True
+                        break
+
+        def cost(order):
+            here, total = start, 0.0
+            for i, flip in order:
+                total += planar(here, ends[i][flip][0])
+                here = ends[i][flip][1]
+            return total + planar(here, end)
+
+        # Nearest neighbour can start off worse than the program did, and 2-opt not make up for it
+        if cost(zip(sequence, flips)) >= cost((i, False) for i in range(n)):
+            return [(island, False) for island in islands]
+        return [(islands[i], flip and islands[i].path is not None) for i, flip in zip(sequence, flips)]
+
+    def visit(self, island, flipped):
+        entry = island.exit if flipped else island.entry
+        nstatements = []
+        self.pending = None
+        if self.out_xy != entry[:2]:
+            if self.out_xy is not None:
+                self.after += self.mm(planar(self.out_xy, entry))
+            nstatements.extend(self.travel(entry))
+        for statement, context, position in (island.reversed() if flipped else island.body):
+            nstatements.extend(self.emit(statement, context, position))
+        return nstatements
+
+    def travel(self, position):
+        x, y = position[:2]
+        return self.emit(GStatement(GCode('X', x), GCode('Y', y)), (0, self.out_feed), (x, y, self.top))
+
+    def emit(self, statement, context, position):
+        '''Sends a statement on, restating the motion mode and feedrate it
+        relies on where the statements sent before it left different ones'''
+        motion, feed = context
+        gcodes = [code.command for code in statement if code.address == 'G']
+        addresses = set(code.address for code in statement if code.type == 'code')
+        moves = bool(addresses.intersection(self.axes)) and not any(g in self.nonmodal for g in gcodes)
+
+        nstatements = []
+        explicit = [g for g in gcodes if g in (0, 1, 2, 3, 38.2, 80)]
+        if moves and not explicit and motion is not None and motion != self.out_motion:
+            statement.codes.insert(0, GCode('G', motion))
+            explicit = [motion]
+        if moves and (explicit[-1] if explicit else motion) in (1, 2, 3) and 'F' not in addresses and \
+                feed is not None and feed != self.out_feed:
+            nstatements.append(GStatement(GCode('F', feed)))
+            self.out_feed = feed
+
+        if explicit:
+            self.out_motion = None if explicit[-1] == 80 else explicit[-1]
+        for code in statement:
+            if code.address == 'F':
+                self.out_feed = code.command
+        self.out_xy = position[:2] if position[0] is not None and position[1] is not None else None
+        nstatements.append(statement)
         return nstatements
 
-class GrblCleaner(object):
+
+class GrblCleaner(OptimizerPass):
     'Removes codes that are not supported by grbl'
     supported_g = (0, 1, 2, 3, 4, 10, 17, 18, 19, 20, 21, 28, 28.1, 30, 30.1, 38.2, 43.1, 49, 53, 54, 55, 56, 57, 58, 59, 80, 90, 91, 92, 92.1, 93, 94)
     supported_m = (0, 2, 3, 4, 5, 8, 9, 30)
     move_desc = ('X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'K', 'R', 'F', 'S')
-    def optimize(self, statements):
-        for statement in statements:
-            codes = []
-            for code in statement:
-                if code.address == 'M':
-                    if code.command in self.supported_m:
-                        codes.append(code)
-                elif code.address == 'G':
-                    if code.command in self.supported_g:
-                        codes.append(code)
-                elif code.address in self.move_desc:
+    def feed(self, statement):
+        codes = []
+        for code in statement:
+            if code.address == 'M':
+                if code.command in self.supported_m:
+                    codes.append(code)
+            elif code.address == 'G':
+                if code.command in self.supported_g:
                     codes.append(code)
-            statement.codes = codes
+            elif code.address in self.move_desc:
+                codes.append(code)
+        statement.codes = codes
 
-        return statements
+        return (statement,)
 
-class CommentRemover(object):
+class CommentRemover(OptimizerPass):
     'Removes comments'
-    def optimize(self, statements):
-        for statement in statements:
-            codes = []
-            for code in statement:
-                if code.type != 'comment':
-                    codes.append(code)
+    def feed(self, statement):
+        codes = []
+        for code in statement:
+            if code.type != 'comment':
+                codes.append(code)
 
-            statement.codes = codes
-        return statements
+        statement.codes = codes
+        return (statement,)
 
-class EmptyStatementRemover(object):
+class EmptyStatementRemover(OptimizerPass):
     'Removes empty statements'
-    def optimize(self, statements):
-        nstatements = []
-        for statement in statements:
-            if len(statement.codes):
-                nstatements.append(statement)
-        return nstatements
+    def feed(self, statement):
+        if len(statement.codes):
+            return (statement,)
+        return ()
+
+
+def make_passes(noopt=False, tolerance=None, arcs=None, reorder=False, reverse=False, hops=None, stock_top=None):
+    'The passes parse and send run, for the options given on their command line'
+    if noopt:
+        return []
+    passes = [CommentRemover(),
+              FileMarkRemover(),
+              CodeSaver(),
+              EmptyMoveRemover(),
+              GrblCleaner(),
+              FeedratePatcher(),
+              MPatcher(),
+              EmptyStatementRemover()]
+    if hops is not None:
+        passes.append(RetractSaver(hops))
+    if stock_top is not None:
+        passes.append(AirMovePromoter(stock_top))
+    if reorder:
+        passes.append(RapidReorderer(reverse=reverse))
+    if arcs is not None:
+        passes.append(ArcFitter(arcs))
+    if tolerance is not None:
+        passes.append(LinearMoveSaver(tolerance))
+    return passes
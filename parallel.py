@@ -0,0 +1,192 @@
+from gcode import GProgram, GCodeParser
+from multiprocessing import Pool
+import copy
+import mmap
+import os
+import tempfile
+
+def snapshot(value):
+    'Turns optimizer state into nested tuples that compare equal only if the state behaves the same'
+    if isinstance(value, float):
+        # Keeps 1 and 1.0 apart, they are written differently
+        return ('float', repr(value))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(snapshot(v) for v in value)
+    if isinstance(value, dict):
+        return ('dict',) + tuple(sorted((k, snapshot(v)) for k, v in value.items()))
+    if hasattr(value, '__dict__'):
+        return (type(value).__name__, snapshot(vars(value)))
+    return value
+
+def merge(previous, start, end):
+    '''Guesses the state after a chunk had it started from previous, given
+    that it went from start to end. Whatever the chunk left alone is taken
+    from previous, the rest from end'''
+    if snapshot(start) == snapshot(end):
+        return previous
+    if type(previous) is type(start) is type(end):
+        if isinstance(end, tuple) and len(previous) == len(start) == len(end):
+            return tuple(merge(p, s, e) for p, s, e in zip(previous, start, end))
+        if isinstance(end, dict) and set(previous) == set(start) == set(end):
+            return dict((k, merge(previous[k], start[k], e)) for k, e in end.items())
+        if hasattr(end, '__dict__') and not isinstance(end, type):
+            state = dict(vars(previous))
+            for k, e in vars(end).items():
+                if k in state and k in vars(start):
+                    state[k] = merge(state[k], vars(start)[k], e)
+                else:
+                    state[k] = e
+            merged = object.__new__(type(end))
+            merged.__dict__.update(state)
+            return merged
+    return end
+
+def take_counts(optimizer):
+    '''Takes the report counters out of the passes, leaving them at zero, so
+    that they neither count as state nor get added up twice. Returns them as
+    a dict for every pass'''
+    counts = []
+    for p in optimizer.optimizers:
+        counts.append(dict((name, getattr(p, name)) for name in p.counters))
+        for name in p.counters:
+            setattr(p, name, type(getattr(p, name))())
+    return counts
+
+def add_counts(optimizer, counts):
+    for p, count in zip(optimizer.optimizers, counts):
+        for name, value in count.items():
+            setattr(p, name, getattr(p, name) + value)
+
+def chunks(path, count, min_size=1024 * 1024, warmup=256 * 1024):
+    '''Splits a file into at most count ranges of whole lines. Returns
+    (warmup, start, end) offsets, where warmup starts the whole lines of
+    the chunk before that come within warmup bytes of start'''
+    size = os.path.getsize(path)
+    count = max(1, min(count, size // min_size))
+    if count == 1:
+        return [(0, 0, size)]
+
+    parser = GCodeParser()
+    bounds = [0]
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for k in range(1, count):
+                end = parser.split(data, bounds[-1], size * k // count)
+                if end >= 0:
+                    bounds.append(end + 1)
+            bounds.append(size)
+
+            ranges = [(0, 0, bounds[1])]
+            for previous, start, end in zip(bounds, bounds[1:], bounds[2:]):
+                warm = parser.split(data, previous, max(previous, start - warmup))
+                ranges.append((warm + 1 if warm >= 0 else previous, start, end))
+            return ranges
+        finally:
+            data.close()
+
+def optimize_chunk(task):
+    '''Parses and optimizes one chunk, starting from the given optimizer
+    state. Lines from warmup to start are run first, only to bring the state
+    up to date. Returns a temporary file holding the program, the state at
+    the start and at the end of the chunk, and the report counters of the
+    chunk alone, which are left out of the states.
+
+    Errors only count when starting from the exact state, and are returned
+    so the other chunks can still be cleaned up. A guessed state may not
+    even be consistent, so then None is returned instead.'''
+    path, warmup, start, end, final, optimizer, exact = task
+    with open(path, 'rb') as f:
+        f.seek(warmup)
+        data = f.read(end - warmup)
+
+    parser = GCodeParser()
+    program = GProgram()
+    try:
+        for statement in parser.iter_lines(data[:start - warmup], warmup == 0, False):
+            optimizer.feed(statement)
+        take_counts(optimizer)
+        initial = copy.deepcopy(optimizer)
+        for statement in parser.iter_lines(data[start - warmup:], start == 0, final):
+            program.extend(optimizer.feed(statement))
+        if final:
+            program.extend(optimizer.flush())
+        counts = take_counts(optimizer)
+    except Exception as e:
+        return e if exact else None
+
+    fd, tmp = tempfile.mkstemp(suffix='.job')
+    with os.fdopen(fd, 'wb') as f:
+        program.dump(f)
+    return tmp, initial, optimizer, counts
+
+def parse_and_optimize(path, optimizer, jobs):
+    '''Parses and optimizes a file in chunks on a pool of processes, giving
+    the same program as optimizer.iter_optimize(GCodeParser().iter_parse(f))
+
+    Chunks first start from freshly reset passes, warmed up on the end of
+    the chunk before. A chunk is only kept once it is known to have started
+    from the exact state the passes were left in by the chunk before it.
+    The others run again, starting from the best guess of that state: the
+    previous chunk's state, with whatever the chunks in between changed
+    applied on top. Each round settles at least one more chunk, and
+    typically the first or second round settles all of them.
+
+    The report counters of the chunks kept are added into the passes of
+    optimizer, as running it on the whole file would have left them.
+    '''
+    ranges = chunks(path, jobs)
+    n = len(ranges)
+    optimizer.reset()
+    starts = [optimizer] * n
+    results = [None] * n
+    accepted = [False] * n
+    pending = list(range(n))
+
+    pool = Pool(min(jobs, n))
+    try:
+        while pending:
+            tasks = []
+            for i in pending:
+                warmup, start, end = ranges[i]
+                if starts[i] is not optimizer:
+                    warmup = start
+                tasks.append((path, warmup, start, end, i == n - 1, starts[i], i == 0 or accepted[i - 1]))
+            errors = []
+            for i, result in zip(pending, pool.map(optimize_chunk, tasks, 1)):
+                if results[i] is not None:
+                    os.remove(results[i][0])
+                    results[i] = None
+                if isinstance(result, Exception):
+                    errors.append(result)
+                else:
+                    results[i] = result
+            if errors:
+                raise errors[0]
+
+            accepted[0] = True
+            guess = results[0][2]
+            pending = []
+            for i in range(1, n):
+                if not accepted[i] and accepted[i - 1] and results[i] is not None:
+                    accepted[i] = snapshot(results[i][1]) == snapshot(results[i - 1][2])
+                if not accepted[i]:
+                    pending.append(i)
+                    previous = guess
+                    if results[i] is not None:
+                        guess = merge(guess, results[i][1], results[i][2])
+                    starts[i] = previous
+                else:
+                    guess = results[i][2]
+
+        program = GProgram()
+        for tmp, initial, state, counts in results:
+            with open(tmp, 'rb') as f:
+                program.extend(GProgram.load(f))
+            add_counts(optimizer, counts)
+        return program
+    finally:
+        pool.terminate()
+        for result in results:
+            if result is not None and os.path.exists(result[0]):
+                os.remove(result[0])
@@ -0,0 +1,235 @@
+from gcode import GProgram, GStatement, GCode
+from itertools import islice
+import copy
+
+class ModalState(object):
+    '''The modal state between two statements, as needed to restart there
+
+    Values are kept the way the program wrote them: the position is in
+    program units, in the active work coordinate system, and None where it is
+    not known. Offsets set with G92 or G10 cannot be restored, so they are
+    only noted.
+    '''
+    axes = ('X', 'Y', 'Z')
+    moves = (0, 1, 2, 3, 38.2)
+
+    def __init__(self):
+        self.units = None
+        self.absolute = True
+        self.motion = None
+        self.plane = 17
+        self.system = 54
+        self.inverse = False
+        self.feed = None
+        # The last feedrate in units per minute, which inverse time feeds leave alone
+        self.rate = None
+        self.spindle = 5
+        self.speed = None
+        self.coolant = ()
+        self.position = [None, None, None]
+        self.offsets = False
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def statement(self, words, gcodes, mcodes):
+        nonmodal = None
+        for command in gcodes:
+            if command in self.moves:
+                self.motion = command
+            elif command == 80:
+                self.motion = None
+            elif command in (17, 18, 19):
+                self.plane = command
+            elif command in (20, 21):
+                if self.units is not None and command != self.units:
+                    scale = 25.4 if command == 21 else 1 / 25.4
+                    self.position = [None if p is None else p * scale for p in self.position]
+                self.units = command
+            elif command == 90:
+                self.absolute = True
+            elif command == 91:
+                self.absolute = False
+            elif command in (93, 94):
+                self.inverse = command == 93
+            elif 54 <= command <= 59:
+                if command != self.system:
+                    self.position = [None, None, None]
+                self.system = command
+            elif command in (4, 10, 28, 28.1, 30, 30.1, 53, 92, 92.1):
+                nonmodal = command
+
+        for command in mcodes:
+            if command in (3, 4, 5):
+                self.spindle = command
+            elif command in (7, 8):
+                self.coolant = tuple(sorted(set(self.coolant + (command,))))
+            elif command == 9:
+                self.coolant = ()
+
+        if 'F' in words:
+            self.feed = words['F']
+            if not self.inverse:
+                self.rate = words['F']
+        if 'S' in words:
+            self.speed = words['S']
+
+        present = [axis in words for axis in self.axes]
+        if nonmodal in (10, 92):
+            self.offsets = True
+            for i, axis in enumerate(self.axes):
+                if present[i] and nonmodal == 92:
+                    self.position[i] = words[axis]
+            return
+        elif nonmodal == 92.1:
+            self.offsets = False
+            self.position = [None, None, None]
+            return
+        elif nonmodal in (28, 30):
+            self.position = [None, None, None]
+            return
+        elif nonmodal is not None or True not in present or self.motion is None:
+            return
+
+        for i, axis in enumerate(self.axes):
+            if not present[i]:
+                continue
+            elif self.absolute:
+                self.position[i] = words[axis]
+            elif self.position[i] is not None:
+                self.position[i] += words[axis]
+
+    def preamble(self, safe_z):
+        '''Statements that bring a machine in an unknown state back to this
+        one: restore the modal codes, retract to safe_z, start the spindle
+        and coolant, move over the position, and feed down to it'''
+        modes = [GCode('G', g) for g in (self.units, self.plane, self.system) if g is not None]
+        modes.append(GCode('G', 94))
+        modes.append(GCode('G', 90))
+        statements = [GStatement(*modes)]
+
+        x, y, z = self.position
+        if safe_z is not None:
+            statements.append(GStatement(GCode('G', 0), GCode('Z', max(safe_z, z) if z is not None else safe_z)))
+        if self.spindle != 5:
+            spindle = GStatement(GCode('M', self.spindle))
+            if self.speed is not None:
+                spindle.append(GCode('S', self.speed))
+            statements.append(spindle)
+        elif self.speed is not None:
+            # For an M3 or M4 without S later on
+            statements.append(GStatement(GCode('S', self.speed)))
+        for m in self.coolant:
+            statements.append(GStatement(GCode('M', m)))
+
+        xy = [GCode(axis, p) for axis, p in zip('XY', (x, y)) if p is not None]
+        if xy:
+            statements.append(GStatement(GCode('G', 0), *xy))
+        # Inverse time feeds only mean something for the move they are on,
+        # so those feed down at the feedrate in effect before them
+        if z is not None and self.rate is not None:
+            statements.append(GStatement(GCode('G', 1), GCode('Z', z), GCode('F', self.rate)))
+        elif z is not None and self.feed is None:
+            # Without a feedrate, the program only got here with rapids
+            statements.append(GStatement(GCode('G', 0), GCode('Z', z)))
+        elif z is not None:
+            raise RuntimeError('Unable to resume: no feedrate in units per minute to feed down with')
+        elif self.rate is not None and not self.inverse:
+            statements.append(GStatement(GCode('F', self.rate)))
+
+        modes = []
+        if self.inverse:
+            modes.append(GCode('G', 93))
+        if not self.absolute:
+            modes.append(GCode('G', 91))
+        if modes:
+            statements.append(GStatement(*modes))
+        return statements
+
+
+def iter_words(program):
+    'Yields the words, G codes and M codes of every statement of a GProgram'
+    addresses, values, floats = program.addresses, program.values, program.floats
+    letters = [chr(i) for i in range(256)]
+    start = 0
+    for end in islice(program.offsets, 1, None):
+        words, gcodes, mcodes = {}, [], []
+        for i in range(start, end):
+            address = addresses[i]
+            if address == GProgram.comment or address == GProgram.filemark:
+                continue
+            value = values[i] if floats[i] else int(values[i])
+            if address == 71:
+                gcodes.append(value)
+            elif address == 77:
+                mcodes.append(value)
+            else:
+                words[letters[address]] = value
+        yield words, gcodes, mcodes
+        start = end
+
+
+class CheckpointIndex(object):
+    '''The modal state of a program at every interval statements
+
+    Built in one pass, after which the state before any statement is found
+    by replaying at most interval statements from the checkpoint before it.
+    Also keeps the highest Z the program moves to, to retract to.
+    '''
+    def __init__(self, program, interval=1000):
+        self.program = program
+        self.interval = interval
+        self.checkpoints = []
+        self.top = None
+
+        state = ModalState()
+        for i, (words, gcodes, mcodes) in enumerate(iter_words(program)):
+            if i % interval == 0:
+                self.checkpoints.append(state.copy())
+            state.statement(words, gcodes, mcodes)
+            z = state.position[2]
+            if z is not None and (self.top is None or z > self.top):
+                self.top = z
+
+    def state(self, statement):
+        'The modal state right before the given statement'
+        statement = max(0, min(statement, len(self.program)))
+        checkpoint = min(statement // self.interval, len(self.checkpoints) - 1)
+        if checkpoint < 0:
+            return ModalState()
+        state = self.checkpoints[checkpoint].copy()
+        first = checkpoint * self.interval
+        for words, gcodes, mcodes in iter_words(self.program.section(first, statement)):
+            state.statement(words, gcodes, mcodes)
+        return state
+
+    def resume(self, statement, safe_z=None):
+        '''A program that restarts this one at the given statement: the
+        preamble of the state there, followed by the rest of the program.
+        Moves that rely on the motion mode get it written out, as the
+        preamble leaves a different one behind.'''
+        state = self.state(statement)
+        if state.offsets:
+            raise RuntimeError('Unable to resume: the program sets G92 or G10 offsets before statement %d' % statement)
+        if safe_z is None:
+            safe_z = self.top
+        if safe_z is None and state.position[2] is not None:
+            raise RuntimeError('Unable to resume: no safe height known, give one')
+
+        program = GProgram(state.preamble(safe_z))
+        rest = self.program.section(statement)
+        motion = state.motion
+        for i, (words, gcodes, mcodes) in enumerate(iter_words(rest)):
+            if motion is None:
+                break
+            if any(g in ModalState.moves or g == 80 for g in gcodes):
+                break
+            if any(axis in words for axis in ModalState.axes) and not any(g in (4, 10, 28, 30, 53, 92) for g in gcodes):
+                patched = rest[i]
+                patched.codes.insert(0, GCode('G', motion))
+                program.extend(rest.section(0, i))
+                program.append(patched)
+                rest = rest.section(i + 1)
+                break
+        program.extend(rest)
+        return program
@@ -0,0 +1,130 @@
+from array import array
+from bisect import bisect_left
+import mmap
+import os
+
+def split_lines(data):
+    lines = data.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    return lines
+
+class MappedView(object):
+    '''File-like, read-only view of part of a buffer, with a line index
+
+    The index is built lazily, in blocks of block bytes: for every block it
+    only stores how many lines came before it, so finding a line counts
+    newlines up to its block and then walks through at most one block.
+    Lines end with \\n, a last line without one still counts.
+    '''
+    block = 64 * 1024
+
+    def __init__(self, data, start=0, end=None, name=None):
+        self.data = data
+        self.start = start
+        self.end = len(data) if end is None else end
+        self.name = name
+        self.pos = start
+        # Newlines before every indexed block, plus the total after the last one
+        self.before = array('L', [0])
+        self.indexed = start
+
+    def __len__(self):
+        return self.end - self.start
+
+    def read(self, size=-1):
+        end = self.end if size is None or size < 0 else min(self.end, self.pos + size)
+        data = self.data[self.pos:end]
+        self.pos = max(self.pos, end)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos - self.start
+        elif whence == 2:
+            offset += self.end - self.start
+        self.pos = self.start + max(0, offset)
+
+    def tell(self):
+        return self.pos - self.start
+
+    def index(self, newlines=None):
+        'Extends the index until it covers the given number of newlines, or the end'
+        while self.indexed < self.end and (newlines is None or self.before[-1] < newlines):
+            end = min(self.indexed + self.block, self.end)
+            self.before.append(self.before[-1] + self.data[self.indexed:end].count(b'\n'))
+            self.indexed = end
+
+    def line_count(self):
+        self.index()
+        if self.end > self.start and self.data[self.end - 1:self.end] != b'\n':
+            return self.before[-1] + 1
+        return self.before[-1]
+
+    def offset(self, line):
+        'Offset of the start of a line, relative to the view. Past the last line, this is its length'
+        if line <= 0:
+            return 0
+        self.index(line)
+        if self.before[-1] < line:
+            return self.end - self.start
+        # The block holding the newline that ends the line before
+        b = bisect_left(self.before, line) - 1
+        pos = self.start + b * self.block
+        for i in range(line - self.before[b]):
+            pos = self.data.find(b'\n', pos, self.end) + 1
+        return pos - self.start
+
+    def section(self, first, last=None):
+        'View of lines first up to, not including, last'
+        start = self.start + self.offset(first)
+        end = self.end if last is None else self.start + self.offset(last)
+        return MappedView(self.data, start, max(start, end))
+
+    def lines(self, first, last=None):
+        return split_lines(self.section(first, last).read())
+
+    def head(self, n):
+        return self.lines(0, n)
+
+    def tail(self, n):
+        if n <= 0 or self.end == self.start:
+            return []
+        end = self.end
+        if end > self.start and self.data[end - 1:end] == b'\n':
+            end -= 1
+        pos = end
+        for i in range(n):
+            pos = self.data.rfind(b'\n', self.start, pos)
+            if pos < 0:
+                pos = self.start - 1
+                break
+        return self.data[pos + 1:end].split(b'\n')
+
+
+class MappedSource(MappedView):
+    '''A G-code file mapped into memory rather than read
+
+    Opening costs nothing whatever the size, and the parser, cache and
+    progress reporting use it like any file object.
+    '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        # Empty files cannot be mapped
+        data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        MappedView.__init__(self, data, 0, size, path)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,178 @@
+from array import array
+from math import log, floor
+import json
+import time
+
+class Histogram(object):
+    '''Counts values in buckets, cheaply enough to update on every line
+
+    With a ratio, bucket bounds grow by that factor from smallest up, so
+    percentiles are off by at most that factor whatever the range. Without
+    one, every integer value gets its own bucket.
+    '''
+    def __init__(self, ratio=None, smallest=1e-6):
+        self.ratio = ratio
+        self.smallest = smallest
+        self.scale = 1 / log(ratio) if ratio else None
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if self.ratio is None:
+            bucket = int(value)
+        elif value <= self.smallest:
+            bucket = 0
+        else:
+            bucket = int(floor(log(value / self.smallest) * self.scale)) + 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def bound(self, bucket):
+        'Upper bound of the values in a bucket'
+        if self.ratio is None:
+            return bucket
+        return self.smallest * self.ratio ** bucket
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.bound(bucket), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class Telemetry(object):
+    '''Records what happens to every line while sending
+
+    For every line, the time from writing it to its response, its size and
+    how many bytes the sender counted as sitting in grbl's receive buffer
+    when it was answered. Status reports add grbl's own planner and receive
+    buffer fill, when it reports them (Buf and RX in grbl 0.9, with $10
+    set to include them, Bf in grbl 1.1). Samples go in arrays, and
+    histograms are kept up to date as they arrive.
+    '''
+    # grbl 1.1 reports free rather than used space, out of this many blocks on an Uno
+    planner_size = 15
+
+    def __init__(self, rx_buffer_size=127):
+        self.rx_buffer_size = rx_buffer_size
+        self.start = None
+        self.written = {}
+        self.times = array('d')
+        self.latencies = array('d')
+        self.lines = array('l')
+        self.sizes = array('L')
+        self.fills = array('L')
+        self.statuses = []
+        self.nbytes = 0
+        self.errors = 0
+        self.latency = Histogram(1.1)
+        self.planner = Histogram()
+        self.rx = Histogram()
+
+    def now(self):
+        t = time.time()
+        if self.start is None:
+            self.start = t
+        return t - self.start
+
+    def sent(self, i):
+        self.written[i] = self.now()
+
+    def answered(self, i, size, buffered, ok=True):
+        t = self.now()
+        latency = t - self.written.pop(i, t)
+        self.times.append(t)
+        self.latencies.append(latency)
+        self.lines.append(i)
+        self.sizes.append(size)
+        self.fills.append(buffered)
+        self.nbytes += size
+        self.latency.add(latency)
+        if not ok:
+            self.errors += 1
+
+    def status(self, status):
+        planner = rx = None
+        if 'Buf' in status:
+            planner = int(status['Buf'][0])
+        if 'RX' in status:
+            rx = int(status['RX'][0])
+        if 'Bf' in status and len(status['Bf']) == 2:
+            planner = self.planner_size - int(status['Bf'][0])
+            rx = self.rx_buffer_size - int(status['Bf'][1])
+        if planner is not None:
+            self.planner.add(planner)
+        if rx is not None:
+            self.rx.add(rx)
+        self.statuses.append((self.now(), status['state'], planner, rx))
+
+    @property
+    def seconds(self):
+        return self.times[-1] if self.times else 0.0
+
+    @property
+    def throughput(self):
+        'Bytes acknowledged per second'
+        return self.nbytes / self.seconds if self.seconds else None
+
+    def summary(self):
+        return {'type': 'summary',
+                'seconds': self.seconds,
+                'lines': len(self.lines),
+                'errors': self.errors,
+                'bytes': self.nbytes,
+                'bytes_per_s': self.throughput,
+                'latency': self.latency.summary(),
+                'planner': self.planner.summary(),
+                'rx': self.rx.summary()}
+
+    def events(self):
+        'Line and status records, in the order they happened'
+        statuses = iter(self.statuses)
+        status = next(statuses, None)
+        for k, t in enumerate(self.times):
+            while status is not None and status[0] <= t:
+                yield self.status_record(status)
+                status = next(statuses, None)
+            yield {'type': 'line', 't': t, 'line': self.lines[k], 'bytes': self.sizes[k],
+                   'latency': self.latencies[k], 'buffered': self.fills[k]}
+        while status is not None:
+            yield self.status_record(status)
+            status = next(statuses, None)
+
+    @staticmethod
+    def status_record(status):
+        t, state, planner, rx = status
+        return {'type': 'status', 't': t, 'state': state, 'planner': planner, 'rx': rx}
+
+    def dump(self, fileobj):
+        'Writes one JSON object per line, ending with the summary'
+        for record in self.events():
+            fileobj.write(json.dumps(record, sort_keys=True) + '\n')
+        fileobj.write(json.dumps(self.summary(), sort_keys=True) + '\n')
@@ -0,0 +1,50 @@
+from gcode import GCodeParser, GProgram, GManager
+from analyzer import analyze
+from math import sqrt, pi
+import pytest
+
+def run(source):
+    return analyze(GProgram(GCodeParser().parse(source)))
+
+def length(x, y, z):
+    return sqrt(x * x + y * y + z * z)
+
+def test_distances_envelope_and_feedrates():
+    result = run('G21 G90\nG0 X10 Y10 Z5\nG1 Z-1 F100\nG1 X20 F500\nG0 Z5\n')
+    assert result.units == 'mm'
+    assert result.rapid_distance == pytest.approx(length(10, 10, 5) + 6)
+    assert result.cut_distance == pytest.approx(16)
+    assert result.feedrates == [100, 500]
+    assert result.envelope == {'X': (0, 20), 'Y': (0, 10), 'Z': (-1, 5)}
+    assert result.counts == {'G21': 1, 'G90': 1, 'G0': 2, 'G1': 2, 'X': 2, 'Y': 1, 'Z': 3, 'F': 2}
+
+def test_arcs_count_their_length_and_extremes():
+    result = run('G21 G90 G17\nG0 X10 Y0\nG3 X-10 Y0 I-10 J0 F300\n')
+    assert result.cut_distance == pytest.approx(pi * 10)
+    assert result.envelope['Y'] == pytest.approx((0, 10))
+    assert result.envelope['X'] == pytest.approx((-10, 10))
+    # R arcs, and a full circle
+    assert run('G21 G90\nG0 X10\nG2 X-10 R10 F300\n').cut_distance == pytest.approx(pi * 10)
+    assert run('G21 G90\nG0 X10\nG2 X10 I-10 F300\n').cut_distance == pytest.approx(2 * pi * 10)
+
+def test_units_and_distance_modes():
+    result = run('G20 G91\nG1 X1 F10\nX1\n')
+    assert result.units == 'inch'
+    assert result.cut_distance == pytest.approx(2 * 25.4)
+    assert result.envelope['X'] == pytest.approx((0, 50.8))
+    assert run('G20\nG1 X1 F10\nG21\nG1 X1\n').units == 'mixed'
+    assert run('G0 X1\n').units is None
+
+def test_unknown_positions_are_left_out():
+    result = run('G21 G90\nG0 X10 Y10\nG28\nG0 X5\nG0 Y5 Z0\nG1 X6 F100\nG92 X0\nG1 X1\n')
+    assert result.unknown_moves == 2
+    assert result.cut_distance == pytest.approx(2)
+    assert result.envelope['X'] == (0, 10)
+
+def test_matches_the_separate_scans():
+    source = 'G21 G90\nG0 X10 Y10 Z5\nG1 Z-1 F100\nG1 X20 F500\nY-5 F400\nG0 Z5\n'
+    result = run(source)
+    manager = GManager(*GCodeParser().parse(source))
+    assert result.feedrates == manager.detect_feedrates()
+    assert result.units == ('mm' if manager.detect_metric() else 'inch')
+    assert result.envelope == manager.detect_workarea()
@@ -0,0 +1,32 @@
+from optimizer import *
+from io import BytesIO
+import bench
+import pytest
+
+@pytest.mark.parametrize('name', sorted(bench.corpora))
+def test_corpora_are_generated_to_size(name):
+    sizes = []
+    for size in (1024, 64 * 1024):
+        f = BytesIO()
+        assert bench.generate(name, size, f) == len(f.getvalue()) >= size
+        sizes.append(f.getvalue())
+    # The same corpus every time, so runs can be compared
+    assert sizes[1].startswith(sizes[0][:512])
+
+def test_parse_size():
+    assert [bench.parse_size(s) for s in ('100', '1KB', '1.5MB', '2GB')] == [100, 1024, 1536 * 1024, 2 * 1024 ** 3]
+
+def test_every_stage_is_timed():
+    report = bench.run(['easel'], [16 * 1024], version='test')
+    assert report['version'] == 'test'
+    [result] = report['results']
+    stages = [stage['stage'] for stage in result['stages']]
+    assert stages == ['parse'] + [type(p).__name__ for p in bench.passes()] + ['stringify', 'serialize', 'send']
+    for stage in result['stages']:
+        assert stage['seconds'] >= 0 and stage['statements'] > 0
+
+def test_benchmarks_the_passes_parse_runs():
+    # parse and send build their passes with make_passes too
+    assert [type(p) for p in bench.passes()] == [type(p) for p in make_passes(**bench.options)]
+    assert set([RetractSaver, AirMovePromoter, RapidReorderer, ArcFitter, LinearMoveSaver]) <= \
+        set(type(p) for p in bench.passes())
@@ -0,0 +1,78 @@
+from gcode import GCodeParser, GProgram
+from optimizer import *
+from cache import JobCache
+from io import BytesIO
+import cache
+import os
+
+source = b'(job)\nG21 G90\nG0 X0 Y0 Z5\nG1 Z-1 F100\nG1 X10\nG1 X20\nG1 X30 Y0.001\nG0 Z5\n'
+
+def options(passes):
+    'The parser and passes a job was optimized with, as parse_and_optimize keys it'
+    return 'GCodeParser', [(type(p).__name__, sorted(vars(p).items())) for p in passes]
+
+def optimized(passes):
+    return [str(statement) for statement in Optimizer(*passes).iter_optimize(GCodeParser().parse(source))]
+
+def test_hits_return_the_stored_program(tmpdir):
+    def passes():
+        return [CommentRemover(), LinearMoveSaver(0.01)]
+    jobs = JobCache(str(tmpdir))
+    key = jobs.key(BytesIO(source), *options(passes()))
+    assert jobs.get(key) is None
+
+    statements = Optimizer(*passes()).iter_optimize(GCodeParser().parse(source))
+    assert [str(statement) for statement in jobs.iter_store(key, statements)] == optimized(passes())
+    program = JobCache(str(tmpdir)).get(jobs.key(BytesIO(source), *options(passes())))
+    assert isinstance(program, GProgram)
+    assert [str(statement) for statement in program] == optimized(passes())
+
+def test_keys_change_with_the_input_and_options(tmpdir):
+    jobs = JobCache(str(tmpdir))
+    key = jobs.key(BytesIO(source), *options([LinearMoveSaver(0.01)]))
+    assert jobs.key(BytesIO(source), *options([LinearMoveSaver(0.01)])) == key
+    assert jobs.key(BytesIO(source), *options([LinearMoveSaver(0.02)])) != key
+    assert jobs.key(BytesIO(source), *options([CommentRemover(), LinearMoveSaver(0.01)])) != key
+    assert jobs.key(BytesIO(source + b'G0 X0\n'), *options([LinearMoveSaver(0.01)])) != key
+
+def test_keys_leave_the_file_where_it_was(tmpdir):
+    f = BytesIO(source)
+    f.seek(5)
+    JobCache(str(tmpdir)).key(f)
+    assert f.tell() == 5
+
+def test_least_recently_used_jobs_are_evicted(tmpdir):
+    program = GProgram(GCodeParser().parse(source * 20))
+    jobs = JobCache(str(tmpdir))
+    jobs.put('a', program)
+    size = os.path.getsize(jobs.filename('a'))
+    jobs.max_size = 2 * size + size // 2
+
+    os.utime(jobs.filename('a'), (1000, 1000))
+    jobs.put('b', program)
+    os.utime(jobs.filename('b'), (2000, 2000))
+    # Reading a makes b the least recently used
+    assert jobs.get('a') is not None
+    jobs.put('c', program)
+    assert sorted(os.listdir(str(tmpdir))) == ['a.job', 'c.job']
+    assert sum(os.path.getsize(str(tmpdir.join(name))) for name in os.listdir(str(tmpdir))) <= jobs.max_size
+
+def test_unreadable_entries_are_misses(tmpdir):
+    jobs = JobCache(str(tmpdir))
+    tmpdir.join('a.job').write(b'not a program', 'wb')
+    assert jobs.get('a') is None
+
+class Module(object):
+    def __init__(self, path):
+        self.__file__ = path
+
+def test_keys_change_with_the_optimizer_source(tmpdir, monkeypatch):
+    module = tmpdir.join('passes.py')
+    module.write('a = 1\n')
+    first = cache.revision([Module(str(tmpdir.join('passes.pyc')))])
+    module.write('a = 2\n')
+    assert cache.revision([Module(str(module))]) != first
+
+    key = JobCache(str(tmpdir)).key(BytesIO(source), *options([LinearMoveSaver(0.01)]))
+    monkeypatch.setattr(cache, 'revision', lambda: first)
+    assert JobCache(str(tmpdir)).key(BytesIO(source), *options([LinearMoveSaver(0.01)])) != key
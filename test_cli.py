@@ -0,0 +1,63 @@
+from click.testing import CliRunner
+import cli
+import pytest
+
+def run(*args):
+    return CliRunner().invoke(cli.main, list(args))
+
+@pytest.mark.parametrize('line', ['-1', '7'])
+def test_resume_refuses_lines_outside_the_job(line):
+    # Two lines between the units, spindle and distance mode set first and the spindle stop
+    result = run('send', '/dev/null', '-y', '-c', 'G0 X1;G0 X2', '--resume-at', line)
+    assert result.output == 'The job has lines 1 to 6\n'
+
+def test_resume_needs_the_whole_job(tmpdir):
+    job = tmpdir.join('job.nc')
+    job.write('G0 X1\nG0 X2\n')
+    result = run('send', '/dev/null', '-y', '--stream', '-f', str(job), '--resume-at', '1')
+    assert result.output == 'Resuming requires the whole job up front, not streaming\n'
+
+def test_resume_at_line_0_is_refused(tmpdir):
+    result = run('send', '/dev/null', '-y', '-c', 'G0 X1;G0 X2', '--resume-at', '0')
+    assert result.output == 'The job has lines 1 to 6\n'
+
+    job = tmpdir.join('job.nc')
+    job.write('G0 X1\nG0 X2\n')
+    result = run('send', '/dev/null', '-y', '--stream', '-f', str(job), '--resume-at', '0')
+    assert result.output == 'Resuming requires the whole job up front, not streaming\n'
+
+def write_jobs(tmpdir, n=3):
+    paths = []
+    for k in range(n):
+        path = tmpdir.join('job%d.nc' % k)
+        path.write('(job %d)\nG21 G90\nG0 X0 Y0 Z5\nG1 Z-1 F100\n' % k + ''.join('G1 X%d Y%d F500\n' % (x, k) for x in range(20 + k)))
+        paths.append(str(path))
+    return paths
+
+def test_batch_writes_what_parse_writes_for_each_file(tmpdir):
+    paths = write_jobs(tmpdir)
+    result = run('parse', '-t', '0.01', '--no-cache', str(tmpdir))
+    assert result.exit_code == 0, result.output
+    assert '3 optimized, 0 failed' in result.output
+    for path in paths:
+        single = path + '.single'
+        assert run('parse', '-t', '0.01', '--no-cache', '-f', path, '-o', single).exit_code == 0
+        with open(single, 'rb') as expected, open(cli.output_path(path, None), 'rb') as output:
+            assert output.read() == expected.read()
+
+    # Earlier output is left out, and so is everything that is not G-code
+    tmpdir.join('notes.txt').write('G0 X1\n')
+    assert cli.expand_inputs([str(tmpdir)]) == paths
+    assert cli.expand_inputs([str(tmpdir.join('job*.nc')), paths[0]]) == paths
+
+def test_batch_on_a_pool_into_a_directory(tmpdir):
+    paths = write_jobs(tmpdir.mkdir('in'), 4)
+    outdir = tmpdir.join('out')
+    result = run('parse', '-j', '2', '--no-cache', '-O', str(outdir), *paths)
+    assert result.exit_code == 0, result.output
+    assert sorted(outdir.listdir()) == sorted(outdir.join('job%d.nc' % k) for k in range(4))
+
+def test_batch_refuses_to_overwrite_its_input(tmpdir):
+    paths = write_jobs(tmpdir, 1)
+    result = run('parse', '-O', str(tmpdir), paths[0])
+    assert 'would be overwritten' in result.output
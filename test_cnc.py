@@ -0,0 +1,173 @@
+from gcode import GCodeParser, GProgram
+from telemetry import Telemetry
+from threading import Lock
+import cnc
+import pytest
+
+def as_bytes(data):
+    return data.tobytes() if isinstance(data, memoryview) else bytes(data)
+
+def queued(sender):
+    'The lines of the queue as written, ending in a newline'
+    return [as_bytes(line).rstrip(b'\n') + b'\n' for line in sender.queue]
+
+class FakeGrbl(object):
+    '''Serial stand-in holding what was written in a receive buffer, like
+    grbl does, and only taking a line out to answer it when read from'''
+    def __init__(self):
+        self.lock = Lock()
+        self.buffer = b''
+        self.output = b'\r\nGrbl 0.9j [\'$\' for help]\r\n'
+        self.lines = []
+        self.peak = 0
+        self.timeout = None
+
+    @property
+    def in_waiting(self):
+        return len(self.output)
+
+    def write(self, data):
+        data = as_bytes(data)
+        with self.lock:
+            # Status requests are handled as they arrive, not buffered
+            self.buffer += data.replace(b'?', b'')
+            self.peak = max(self.peak, len(self.buffer))
+
+    def read(self, n=1):
+        with self.lock:
+            if not self.output and b'\n' in self.buffer:
+                line, self.buffer = self.buffer.split(b'\n', 1)
+                self.lines.append(line)
+                self.output += b'ok\r\n'
+            data, self.output = self.output[:n], self.output[n:]
+            return data
+
+    def close(self):
+        pass
+
+def program(n=400):
+    source = ''.join('G1 X%d.%03d Y%d Z-0.5 F%d\n' % (i, i % 1000, i % 7, 100 + i % 3) for i in range(n))
+    return GProgram(GCodeParser().parse(source))
+
+@pytest.fixture
+def grbl(monkeypatch):
+    grbl = FakeGrbl()
+    monkeypatch.setattr(cnc, 'Serial', lambda devpath, baudrate: grbl)
+    return grbl
+
+def send(sender, grbl, streaming):
+    codes = program()
+    sender.add_program(codes)
+    done = []
+    sender.oncomplete = lambda: done.append(True)
+    sender.connect()
+    try:
+        sender.send_queue(streaming)
+    finally:
+        # Duplex senders keep their threads until stopped
+        if hasattr(sender, 'stop'):
+            sender.stop()
+    assert done
+    lines = queued(sender)
+    assert grbl.lines == [line[:-1] for line in lines]
+    return max(len(line) for line in lines)
+
+def fills_the_receive_buffer(sender, grbl):
+    longest = send(sender, grbl, True)
+    assert grbl.peak <= cnc.CNC.rx_buffer_size
+    # More than one line at a time, or nothing was streamed
+    assert grbl.peak > cnc.CNC.rx_buffer_size - longest
+
+def test_streaming_never_overfills_the_receive_buffer(grbl):
+    fills_the_receive_buffer(cnc.CNC('grbl', 115200), grbl)
+
+def test_ping_pong_sends_a_line_at_a_time(grbl):
+    assert grbl.peak <= send(cnc.CNC('grbl', 115200), grbl, False)
+
+def test_duplex_streaming_never_overfills_the_receive_buffer(grbl):
+    fills_the_receive_buffer(cnc.DuplexCNC('grbl', 115200, 0), grbl)
+
+def test_duplex_ping_pong_sends_a_line_at_a_time(grbl):
+    assert grbl.peak <= send(cnc.DuplexCNC('grbl', 115200, 0), grbl, False)
+
+class UnpluggedGrbl(FakeGrbl):
+    'Fails every read once connected, as a port does when its cable is pulled'
+    def read(self, n=1):
+        if self.output:
+            return FakeGrbl.read(self, n)
+        raise cnc.SerialException('device reports readiness to read but returned no data')
+
+@pytest.mark.parametrize('make', [lambda: cnc.CNC('grbl', 115200), lambda: cnc.DuplexCNC('grbl', 115200, 0)])
+def test_read_errors_stop_the_job(monkeypatch, make):
+    grbl = UnpluggedGrbl()
+    monkeypatch.setattr(cnc, 'Serial', lambda devpath, baudrate: grbl)
+    sender = make()
+    sender.add_program(program())
+    done = []
+    sender.oncomplete = lambda: done.append(True)
+    sender.connect()
+    try:
+        with pytest.raises(cnc.SerialException):
+            sender.send_queue()
+    finally:
+        if hasattr(sender, 'stop'):
+            sender.stop()
+    assert not done
+
+def test_parse_status():
+    assert cnc.parse_status(b'<Idle,MPos:0.000,-1.500,2.000,WPos:1.000,0.000,0.000>') == \
+        {'state': 'Idle', 'MPos': (0.0, -1.5, 2.0), 'WPos': (1.0, 0.0, 0.0)}
+    assert cnc.parse_status(b'<Hold:0|MPos:1.000,2.000,3.000|Bf:15,128|FS:500,0>') == \
+        {'state': 'Hold:0', 'MPos': (1.0, 2.0, 3.0), 'Bf': (15.0, 128.0), 'FS': (500.0, 0.0)}
+
+def test_responses_split_across_reads():
+    results = []
+    parser = cnc.ResultParser(lambda *result: results.append(result))
+    for data in (b'o', b'k\r\nerr', b'or:20\r\nALARM:1\r', b'\nGrbl 1.1f\r\n'):
+        parser.feed_bytes(data)
+    assert results == [('ok',), ('error', b':20'), ('alarm', b'1'), ('info', b'Grbl 1.1f')]
+
+class PolledGrbl(FakeGrbl):
+    'Answers status requests and takes real-time commands as they arrive, like grbl does'
+    def __init__(self):
+        FakeGrbl.__init__(self)
+        self.realtime = []
+
+    def write(self, data):
+        data = as_bytes(data)
+        if data in (b'?', b'!', b'~'):
+            with self.lock:
+                self.realtime.append(data)
+                if data == b'?':
+                    self.output += b'<Idle|MPos:1.000,2.000,3.000|FS:0,0>\r\n'
+            return
+        FakeGrbl.write(self, data)
+
+def test_duplex_polls_status_while_sending(monkeypatch):
+    grbl = PolledGrbl()
+    monkeypatch.setattr(cnc, 'Serial', lambda devpath, baudrate: grbl)
+    sender = cnc.DuplexCNC('grbl', 115200, 0.001)
+    statuses = []
+    sender.onstatus = statuses.append
+    sender.add_program(program(2000))
+    sender.connect()
+    try:
+        sender.send_queue()
+        sender.hold()
+        sender.resume()
+    finally:
+        sender.stop()
+    assert grbl.lines == [line[:-1] for line in queued(sender)]
+    assert statuses and statuses[0] == {'state': 'Idle', 'MPos': (1.0, 2.0, 3.0), 'FS': (0.0, 0.0)}
+    # Polls go on while holding and resuming
+    assert [c for c in grbl.realtime if c != b'?'] == [b'!', b'~']
+
+def test_telemetry_records_every_line(grbl):
+    sender = cnc.CNC('grbl', 115200)
+    sender.telemetry = Telemetry(cnc.CNC.rx_buffer_size)
+    send(sender, grbl, True)
+    telemetry = sender.telemetry
+    assert list(telemetry.lines) == list(range(len(sender.queue)))
+    assert list(telemetry.sizes) == [len(line) for line in queued(sender)]
+    assert max(telemetry.fills) <= cnc.CNC.rx_buffer_size
+    assert not telemetry.written
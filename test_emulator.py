@@ -0,0 +1,72 @@
+from gcode import GCodeParser, GProgram
+from cnc import CNC, DuplexCNC
+from emulator import Emulator
+import os
+import time
+import pytest
+
+@pytest.fixture
+def grbl():
+    emulator = Emulator(speed=1000.0)
+    emulator.boot_time = 0.0
+    emulator.start()
+    yield emulator
+    emulator.close()
+
+def job(n=300):
+    moves = ''.join('G1 X%d.%d Y%d F%d\n' % (k % 50, k % 10, k % 7, 1000 + k) for k in range(n))
+    return GProgram(GCodeParser().parse('G21 G90\nG0 Z5\n' + moves + 'G0 X0 Y0 Z5\nG4 P0.5\n'))
+
+@pytest.mark.parametrize('streaming', [True, False])
+def test_runs_a_job_sent_to_it(grbl, streaming):
+    sender = CNC(grbl.path, 115200)
+    sender.add_program(job())
+    done = []
+    sender.oncomplete = lambda: done.append(True)
+    sender.connect()
+    sender.send_queue(streaming)
+    assert done
+
+    stats = grbl.stats()
+    assert stats['errors'] == stats['overflows'] == 0
+    assert stats['lines'] == len(sender.queue)
+    assert stats['peak_rx'] <= Emulator.rx_buffer_size
+    # Waiting for the dwell to be acknowledged waited for every move before it
+    assert grbl.position == [0, 0, 5]
+    assert grbl.state == 'Idle'
+
+def test_answers_status_and_refuses_what_grbl_would(grbl):
+    sender = DuplexCNC(grbl.path, 115200, 0.01)
+    statuses, errors = [], []
+    sender.onstatus = statuses.append
+    sender.onerror = errors.append
+    sender.add_program(GProgram(GCodeParser().parse('G21 G90\nG0 X1 Y2\nG1 X1\n')))
+    sender.connect()
+    try:
+        # A refused line ends the job, and the next one is sent on its own
+        sender.send_queue()
+        sender.add_program(GProgram(GCodeParser().parse('G7\n')))
+        sender.send_queue()
+        deadline = time.time() + 5
+        while not (statuses and statuses[-1]['state'] == 'Idle' and statuses[-1]['MPos'] == (1.0, 2.0, 0.0)) and \
+                time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        sender.stop()
+    assert errors == [b': Undefined feed rate', b': Unsupported command']
+    assert statuses[-1]['state'] == 'Idle'
+    assert statuses[-1]['MPos'] == (1.0, 2.0, 0.0)
+
+def test_overflowing_the_receive_buffer_drops_bytes(grbl):
+    port = os.open(grbl.path, os.O_RDWR | os.O_NOCTTY)
+    try:
+        deadline = time.time() + 5
+        while not grbl.connected and time.time() < deadline:
+            time.sleep(0.01)
+        os.write(port, b'G0 X1 Y1 Z1 ' * 20)
+        while grbl.overflows < 240 - Emulator.rx_buffer_size and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        os.close(port)
+    assert grbl.overflows == 240 - Emulator.rx_buffer_size
+    assert grbl.peak_rx == Emulator.rx_buffer_size
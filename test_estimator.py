@@ -0,0 +1,49 @@
+from gcode import GCodeParser, GProgram
+from analyzer import analyze
+from estimator import estimate
+from math import sqrt, pi
+import pytest
+
+def program(source):
+    return GProgram(GCodeParser().parse(source))
+
+def test_straight_moves_accelerate_cruise_and_stop():
+    # 10 mm/s, reached after 0.04 s and 0.2 mm at 250 mm/s^2, and the same to stop
+    timing = estimate(program('G21 G90\nG1 X100 F600\n'))
+    assert timing.blocks == 1
+    assert timing.time == pytest.approx(0.04 + 99.6 / 10 + 0.04)
+
+def test_rapids_run_at_the_max_rate_of_their_axes():
+    # Accelerating to v and stopping again takes v / a longer than cruising all the way
+    fast, slow = 5000 / 60.0, 500 / 60.0
+    assert estimate(program('G21 G90\nG0 X100\n')).time == pytest.approx(100 / fast + fast / 250)
+    assert estimate(program('G21 G90\nG0 Z-10\n')).time == pytest.approx(10 / slow + slow / 50)
+
+def test_straight_runs_of_moves_keep_their_speed():
+    one = estimate(program('G21 G90\nG1 X100 F600\n')).time
+    split = estimate(program('G21 G90\nG1 F600\n' + ''.join('X%d\n' % x for x in range(1, 101)))).time
+    assert split == pytest.approx(one)
+    # Square corners stop the tool, which takes longer
+    square = estimate(program('G21 G90\nG1 F600\nX25\nY25\nX0\nY0\n')).time
+    assert square > one
+
+def test_arcs_are_split_into_chords():
+    timing = estimate(program('G21 G90 G17\nG0 X10\nG2 X-10 I-10 J0 F600\n'))
+    assert timing.blocks > 50
+    # A rapid too short to reach its max rate, then half a circle at 10 mm/s
+    assert timing.time == pytest.approx(2 * sqrt(10 / 250.0) + pi * 10 / 10 + 0.04, rel=0.02)
+
+def test_dwells_add_their_time():
+    without = estimate(program('G21 G90\nG1 X10 F600\nG1 X20\n')).time
+    timing = estimate(program('G21 G90\nG1 X10 F600\nG4 P2.5\nG1 X20\n'))
+    assert timing.dwell == 2.5
+    assert timing.time > without + 2.5
+
+def test_slow_links_starve_the_planner():
+    source = 'G21 G90\nG1 F3000\n' + ''.join('G1 X%d.5 Y%d\n' % (k, k % 2) for k in range(200))
+    assert estimate(program(source), baudrate=1200).starved
+    assert not estimate(program(source)).starved
+
+def test_the_analysis_comes_from_the_same_pass():
+    source = 'G21 G90\nG0 X10 Y10 Z5\nG1 Z-1 F100\nG2 X20 I5 J0 F300\nG0 Z5\n'
+    assert vars(estimate(program(source)).analysis) == vars(analyze(program(source)))
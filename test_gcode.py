@@ -0,0 +1,159 @@
+from gcode import GCode, GStatement, GCodeParser, GCodeReferenceParser, GCodeParserError, GProgram, GWireImage, GSerializer, GCodeSerializerError
+from io import BytesIO
+import random
+import pytest
+
+samples = [
+    'G0 X1 Y2\nG1 Z-1.5 F300\n',
+    'g1x1y2z3\n',
+    'G1 X+1 Y-.5 Z1.\n',
+    '%\nG21 G90 (metric, absolute)\nM3 S12000\n%\n',
+    '(a comment\nspanning lines)\nG0 X1\n',
+    '(outer (inner)\nG1 X1 (after) Y2\n',
+    'G0 X1\r\nG0 X2\rG0 X3\n',
+    '\n\nG0 X1\n\n',
+    '\nG0 X1',
+    'G0 X1 (never closed\nG0 X2\n',
+    '   \nN10 G0 X1   \n',
+    '',
+]
+
+def codes(statements):
+    'What a list of statements parsed to, with ints and floats kept apart'
+    return [[(code.type, getattr(code, 'address', None), repr(getattr(code, 'command', getattr(code, 'content', None))))
+             for code in statement] for statement in statements]
+
+def reference(string, size=None):
+    try:
+        if size is not None:
+            return codes(GCodeReferenceParser().iter_parse(BytesIO(string), size))
+        return codes(GCodeReferenceParser().parse(string))
+    except GCodeParserError as e:
+        return str(e)
+
+def parse(string):
+    try:
+        return codes(GCodeParser().parse(string))
+    except GCodeParserError as e:
+        return str(e)
+
+@pytest.mark.parametrize('string', samples)
+def test_parse_matches_reference(string):
+    assert parse(string) == reference(string)
+
+@pytest.mark.parametrize('string', ['G0 X1 $\n', 'G1 X1-2\n', 'G1 X.\n', 'G1 X\n'])
+def test_parse_errors_match_reference(string):
+    assert parse(string) == reference(string)
+
+def test_parse_matches_reference_on_random_input():
+    rng = random.Random(0)
+    tokens = ['G1', 'g0', 'X-1.5', 'Y+2', 'z.25', 'F300', 'M3', ' ', '  ', '(', ')', '(note)', '%', '\n', '\r', '\r\n', '-', '.', '$']
+    for n in range(2000):
+        string = ''.join(rng.choice(tokens) for i in range(rng.randint(0, 20)))
+        assert parse(string) == reference(string), repr(string)
+
+def iter_parse(string, size):
+    try:
+        return codes(GCodeParser().iter_parse(BytesIO(string), size))
+    except GCodeParserError as e:
+        return str(e)
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64])
+@pytest.mark.parametrize('string', samples)
+def test_iter_parse_matches_reference_in_any_chunk_size(string, size):
+    assert iter_parse(string, size) == reference(string)
+
+@pytest.mark.parametrize('size', [1, 5, 64])
+def test_iter_parse_matches_reference_iter_parse(size):
+    string = ''.join(samples)
+    assert iter_parse(string, size) == reference(string, size)
+    string = ''.join(sample for sample in samples if 'never closed' not in sample)
+    assert iter_parse(string, size) == reference(string, size)
+
+def serialize(string, **options):
+    serializer = GSerializer(**options)
+    return [serializer.lines(statement) for statement in GCodeParser().parse(string) if list(statement)]
+
+def test_serializer_writes_short_numbers():
+    assert serialize('G1 X0.5000 Y-0.25 Z10.0 F300.\nX1.23456 Y-0.0001\n') == \
+        [['G1X.5Y-.25Z10F300'], ['X1.235Y0']]
+    assert serialize('G1 X1.23456\n', resolution=0.01) == [['G1X1.23']]
+
+def test_serializer_drops_words_that_change_nothing():
+    assert serialize('G21 G90 G1 X1 Y2 F300\nG1 X1 Y3 F300\nG21 G90 M3 S1000\nM3 S1000\nG1 Y3\n') == \
+        [['G21G90G1X1Y2F300'], ['Y3'], ['M3S1000'], [], []]
+
+def test_serializer_keeps_words_that_move():
+    # Relative moves, arcs and moves after a change of units or G92 all go somewhere
+    assert serialize('G91 G1 X1\nX1\nG90\nG2 X1 Y1 I1\nX1 Y1 I1\nG0 X5\nG20\nX5\nG92 X0\nG0 X5\n') == \
+        [['G91G1X1'], ['X1'], ['G90'], ['G2X1Y1I1'], ['X1Y1I1'], ['G0X5'], ['G20'], ['X5'], ['G92X0'], ['X5']]
+
+def test_serializer_splits_long_statements():
+    assert serialize('G21 G1 X1.5 Y2.5 Z-1 F300 S1000 M3 M8\n', max_line=20) == \
+        [['G21', 'F300', 'S1000', 'M3', 'M8', 'G1X1.5Y2.5Z-1']]
+    assert serialize('M5 G0 X10 Y20 Z30 M2\n', max_line=12) == [['M5', 'G0X10Y20Z30', 'M2']]
+    with pytest.raises(GCodeSerializerError):
+        serialize('G1 X100.123 Y100.123 Z100.123\n', max_line=20)
+
+def test_serializer_forgets_the_modes_after_a_program_end():
+    assert serialize('G21 G90 G1 X1 F300 M3 S1000\nM30\nG21 G90 G1 X1 F300 M3 S1000\n') == \
+        [['G21G90G1X1F300M3S1000'], ['M30'], ['G21G90G1X1F300M3S1000']]
+    assert serialize('G91 G1 X1 F300\nM2\nG91 G1 X1 F300\n') == [['G91G1X1F300'], ['M2'], ['G91G1X1F300']]
+
+program_source = '%\n(job)\nG21 G90\nG0 X1 Y2.5 Z-0.125\n(job)\nG1 X100000 F300 (fast)\n%\n'
+
+def test_program_gives_back_what_was_appended():
+    statements = [statement for statement in GCodeParser().parse(program_source) if list(statement)]
+    program = GProgram(statements)
+    assert len(program) == len(statements)
+    assert codes(program) == codes(statements)
+    assert codes([program[-1], program[0]]) == codes([statements[-1], statements[0]])
+    assert codes([list(program.iter_codes())]) == codes([[code for statement in statements for code in statement]])
+    with pytest.raises(IndexError):
+        program[len(program)]
+    # Comments are stored once
+    assert program.comments == ['job', 'fast']
+
+def test_program_extends_from_another_program():
+    first = GProgram(GCodeParser().parse('(b)\nG0 X1\n'))
+    second = GProgram(GCodeParser().parse(program_source))
+    joined = GProgram(first)
+    joined.extend(second)
+    assert codes(joined) == codes(list(first) + list(second))
+    assert joined.comments == ['b', 'job', 'fast']
+
+def test_program_dump_and_load(tmpdir):
+    program = GProgram(GCodeParser().parse(program_source))
+    path = str(tmpdir.join('job'))
+    with open(path, 'wb') as f:
+        program.dump(f)
+    with open(path, 'rb') as f:
+        loaded = GProgram.load(f)
+    assert codes(loaded) == codes(program)
+    assert loaded.comments == program.comments
+    with open(path, 'rb') as f:
+        with pytest.raises(ValueError):
+            GProgram.load(BytesIO(f.read(20)))
+
+def test_wire_image_holds_every_statement_as_a_line():
+    statements = GCodeParser().parse(program_source + 'G1 ' + ' '.join('X%d' % i for i in range(30)) + '\n')
+    wire = GWireImage(statements)
+    lines = [(str(statement) + '\n').encode('utf-8') for statement in statements]
+    assert [line.tobytes() for line in wire] == lines
+    assert wire[-1].tobytes() == lines[-1] and wire[1].tobytes() == lines[1]
+    assert bytes(wire.data) == b''.join(lines)
+    # Straight from the arrays of a program, too
+    assert GWireImage(GProgram(statements)).data == wire.data
+    with pytest.raises(IndexError):
+        wire[len(wire)]
+
+def test_wire_image_keeps_where_statements_end():
+    statements = [s for s in GCodeParser().parse('G21 G1 X1.5 Y2.5 Z-1 F300 S1000 M3 M8\nG0 X0\n') if list(s)]
+    wire = GWireImage(statements, GSerializer(max_line=20))
+    assert [line.tobytes() for line in wire] == [b'G21\n', b'F300\n', b'S1000\n', b'M3\n', b'M8\n', b'G1X1.5Y2.5Z-1\n', b'G0X0\n']
+    assert list(wire.statements) == [0, wire.offsets[6], wire.offsets[7]]
+
+    joined = GWireImage([GStatement(GCode('G', 0), GCode('X', 5))])
+    joined.extend(wire)
+    assert joined.data == b'G0X5\n' + wire.data
+    assert list(joined.statements)[1:] == [5] + [5 + offset for offset in list(wire.statements)[1:]]
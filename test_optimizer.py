@@ -0,0 +1,345 @@
+from gcode import GCodeParser
+from optimizer import *
+from math import sqrt, atan2, acos, cos, sin, pi
+import random
+import pytest
+
+def moves(statements):
+    'Every move a program in absolute mm makes, as (motion, feedrate, start, end, arc center)'
+    motion, feed, here = None, None, (0.0, 0.0, 0.0)
+    result = []
+    for statement in statements:
+        words = {}
+        for code in statement:
+            if code.type != 'code':
+                continue
+            if code.address == 'G' and code.command in (0, 1, 2, 3):
+                motion = code.command
+            elif code.address == 'F':
+                feed = code.command
+            else:
+                words[code.address] = code.command
+        if not any(axis in words for axis in 'XYZ'):
+            continue
+        end = tuple(float(words.get(axis, here[i])) for i, axis in enumerate('XYZ'))
+        center = None
+        if motion in (2, 3):
+            center = (here[0] + words.get('I', 0), here[1] + words.get('J', 0))
+        result.append((motion, None if motion == 0 else feed, here, end, center))
+        here = end
+    return result
+
+def cuts(statements):
+    'Moves that cut into the stock, its top being at Z0'
+    return sorted(move for move in moves(statements) if move[0] != 0 and move[2][2] < 0 and move[3][2] < 0)
+
+def optimize(source, *passes):
+    return Optimizer(*passes).optimize(GCodeParser().parse(source))
+
+def arc_points(start, end, center, clockwise, n=50):
+    'Points along an arc in the XY plane'
+    radius = sqrt((start[0] - center[0]) ** 2 + (start[1] - center[1]) ** 2)
+    begin = atan2(start[1] - center[1], start[0] - center[0])
+    sweep = atan2(end[1] - center[1], end[0] - center[0]) - begin
+    if clockwise:
+        sweep = -sweep
+    sweep %= 2 * pi
+    if sweep < 1e-9:
+        sweep = 2 * pi
+    if clockwise:
+        sweep = -sweep
+    return [(center[0] + radius * cos(begin + sweep * k / n), center[1] + radius * sin(begin + sweep * k / n), start[2])
+            for k in range(n + 1)]
+
+def path(statements):
+    'The tool path as a list of points, arcs broken into short chords'
+    points = []
+    for motion, feed, start, end, center in moves(statements):
+        if not points:
+            points.append(start)
+        if motion in (2, 3):
+            points.extend(arc_points(start, end, center, motion == 2)[1:])
+        else:
+            points.append(end)
+    return points
+
+def deviation(points, polyline):
+    'How far the farthest of points is from a polyline'
+    return max(min(distance(p, a, b) for a, b in zip(polyline, polyline[1:])) for p in points)
+
+def job(rng, islands=12):
+    '''Pockets, open paths and circles at random places, some cut twice,
+    deeper the second time, and some with a slot a short hop away'''
+    lines = ['G21 G90 G17', 'M3 S10000', 'G0 Z5', 'G0 X0 Y0']
+    for k in range(islands):
+        x, y = round(rng.uniform(0, 100), 3), round(rng.uniform(0, 100), 3)
+        shape = rng.choice(('square', 'open', 'circle'))
+        points = [(x + rng.uniform(-5, 5), y + rng.uniform(-5, 5)) for i in range(3)]
+        for depth in (-1, -2) if rng.random() < 0.3 else (-1,):
+            lines.append('G0 X%.3f Y%.3f' % (x, y))
+            lines.append('G1 Z1 F300')
+            lines.append('G1 Z%d F100' % depth)
+            if shape == 'square':
+                lines += ['G1 X%.3f F500' % (x + 4), 'Y%.3f' % (y + 4), 'X%.3f' % x, 'Y%.3f' % y]
+            elif shape == 'open':
+                lines += ['G1 X%.3f Y%.3f F500' % p for p in points]
+            else:
+                lines.append('G2 X%.3f Y%.3f I3 J0 F400' % (x, y))
+            if shape != 'open' and rng.random() < 0.3:
+                # A short hop to a slot next to it
+                lines += ['G0 Z5', 'G0 X%.3f' % (x - 0.5), 'G1 Z%d F100' % depth, 'G1 Y%.3f F500' % (y - 3)]
+            lines.append('G0 Z5')
+    lines += ['M5', 'G0 X0 Y0']
+    return '\n'.join(lines) + '\n'
+
+def test_linear_move_saver_stays_within_tolerance():
+    rng = random.Random(1)
+    lines = ['G21 G90', 'G0 X0 Y0 Z0']
+    for k in range(1, 500):
+        # A wavy line, with noise well within the tolerance on top
+        lines.append('G1 X%.4f Y%.4f' % (k * 0.2, 3 * sin(k * 0.02) + rng.uniform(-0.002, 0.002)))
+    source = '\n'.join(lines) + '\n'
+    original = path(GCodeParser().parse(source))
+
+    optimized = optimize(source, LinearMoveSaver(0.01))
+    simplified = path(optimized)
+    assert len(simplified) < len(original) / 4
+    assert simplified[0] == original[0] and simplified[-1] == original[-1]
+    assert deviation(original, simplified) <= 0.01 + 1e-9
+
+def test_linear_move_saver_keeps_moves_apart_from_the_line():
+    source = 'G21 G90\nG0 X0 Y0 Z0\nG1 X1 Y0.5 F100\nG1 X2 Y0\nG1 X3 Y0.001\nG1 X4 Y0\n'
+    assert path(optimize(source, LinearMoveSaver(0.01)))[1:] == [(0, 0, 0), (1, 0.5, 0), (2, 0, 0), (4, 0, 0)]
+
+def test_linear_move_saver_merges_moves_in_whole_numbers():
+    source = 'G21 G90\nG0 X0 Y0 Z0\nG1 F100\nG1 X5 Y0\nX10 Y0\nX10 Y10\n'
+    assert path(optimize(source, LinearMoveSaver(0.01)))[1:] == [(0, 0, 0), (10, 0, 0), (10, 10, 0)]
+
+def test_arc_fitter_stays_within_tolerance():
+    rng = random.Random(2)
+    lines = ['G21 G90 G17', 'G0 X0 Y0 Z-1', 'G1 F500']
+    x, y = 0.0, 0.0
+    for k in range(20):
+        # Polylines along circles of either direction, joined by straight moves
+        radius, direction = rng.uniform(1, 30), rng.choice((-1, 1))
+        cx, cy = x - radius, y
+        steps = rng.randint(3, 60)
+        # Chords short enough to stay within 0.004 of the circle
+        step = direction * 2 * acos(1 - 0.004 / radius) * rng.uniform(0.5, 1)
+        for i in range(1, steps + 1):
+            x = cx + radius * cos(step * i) + rng.uniform(-0.002, 0.002)
+            y = cy + radius * sin(step * i) + rng.uniform(-0.002, 0.002)
+            lines.append('G1 X%.4f Y%.4f' % (x, y))
+        x, y = x + rng.uniform(-5, 5), y + rng.uniform(-5, 5)
+        lines.append('G1 X%.4f Y%.4f' % (x, y))
+    source = '\n'.join(lines) + '\n'
+    original = path(GCodeParser().parse(source))
+
+    optimized = optimize(source, ArcFitter(0.01))
+    motions = [move[0] for move in moves(optimized)]
+    assert 2 in motions and 3 in motions
+    assert len(motions) < len(original) / 4
+    fitted = path(optimized)
+    assert fitted[-1] == original[-1]
+    assert deviation(original, fitted) <= 0.01 + 1e-6
+    assert deviation(fitted, original) <= 0.01 + 1e-6
+
+def test_arc_fitter_leaves_straight_and_3d_moves():
+    source = 'G21 G90\nG0 X0 Y0 Z0\nG1 X1 Y0 F100\nX2\nX3\nX4\nX5 Z-1\nX6 Y1 Z-2\nX7 Y3 Z-3\nX8 Y6 Z-4\n'
+    assert moves(optimize(source, ArcFitter(0.01))) == moves(GCodeParser().parse(source))
+
+def default_passes():
+    return [CommentRemover(), FileMarkRemover(), CodeSaver(), EmptyMoveRemover(), GrblCleaner(),
+            FeedratePatcher(), MPatcher(), EmptyStatementRemover(),
+            RetractSaver(1.0), AirMovePromoter(0.5), RapidReorderer(), ArcFitter(0.01), LinearMoveSaver(0.01)]
+
+def test_profiling_gives_the_same_output():
+    source = '(job)\n%\n' + job(random.Random(4), 40)
+    expected = [str(statement) for statement in optimize(source, *default_passes())]
+
+    optimizer = Optimizer(*default_passes())
+    optimizer.profile = []
+    assert [str(statement) for statement in optimizer.optimize(GCodeParser().parse(source))] == expected
+
+    assert [profile.name for profile in optimizer.profile] == [type(p).__name__ for p in optimizer.optimizers]
+    for profile, following in zip(optimizer.profile, optimizer.profile[1:]):
+        assert (profile.statements_out, profile.codes_out, profile.bytes_out) == \
+            (following.statements_in, following.codes_in, following.bytes_in)
+    assert optimizer.profile[-1].statements_out == len(expected)
+    assert optimizer.profile[0].bytes_in > optimizer.profile[-1].bytes_out
+
+def feed_moves(statements):
+    return sorted(move for move in moves(statements) if move[0] != 0)
+
+def rapid_travel(statements):
+    'Length of the rapids in the XY plane'
+    return sum(planar(start, end) for motion, feed, start, end, center in moves(statements) if motion == 0)
+
+def plunges(statements):
+    'Where the tool feeds down into the stock, in order'
+    return [end for motion, feed, start, end, center in moves(statements) if motion == 1 and end[2] < 0 <= start[2]]
+
+def test_rapid_reorderer_keeps_every_cut():
+    for seed in range(10):
+        source = job(random.Random(seed))
+        original = GCodeParser().parse(source)
+        reorderer = RapidReorderer()
+        optimized = optimize(source, reorderer)
+
+        assert feed_moves(optimized) == feed_moves(original)
+        assert moves(optimized)[-1][3] == moves(original)[-1][3]
+        assert 0 < reorderer.reordered
+        assert reorderer.after < reorderer.before
+        assert rapid_travel(original) - rapid_travel(optimized) == pytest.approx(reorderer.before - reorderer.after)
+
+        # A deeper pass never comes before the one above it
+        depths = {}
+        for x, y, z in plunges(optimized):
+            assert z <= depths.get((x, y), 0)
+            depths[(x, y)] = z
+
+def test_rapid_reorderer_reverse_keeps_every_cut():
+    for seed in range(10):
+        source = job(random.Random(seed))
+        original = GCodeParser().parse(source)
+        optimized = optimize(source, RapidReorderer(reverse=True))
+
+        def segments(statements):
+            'Straight cuts at depth, whichever way they are cut'
+            return sorted(tuple(sorted((start, end))) for motion, feed, start, end, center in moves(statements)
+                          if motion == 1 and start[2] == end[2] < 0)
+        assert segments(optimized) == segments(original)
+        assert len(plunges(optimized)) == len(plunges(original))
+        assert moves(optimized)[-1][3] == moves(original)[-1][3]
+
+def test_rapid_reorderer_leaves_ordered_islands():
+    lines = ['G21 G90', 'G0 Z5', 'G0 X0 Y0']
+    for x in range(0, 100, 10):
+        lines += ['G0 X%d Y0' % x, 'G1 Z-1 F100', 'G1 Y5 F500', 'G0 Z5']
+    source = '\n'.join(lines) + '\n'
+    reorderer = RapidReorderer()
+    assert moves(optimize(source, reorderer)) == moves(GCodeParser().parse(source))
+    assert reorderer.reordered == 0
+
+def test_retract_saver_stays_down_for_short_hops():
+    source = '''G21 G90
+G0 Z5
+G0 X0 Y0
+G1 Z-1 F100
+G1 X10 F500
+G0 Z5
+G0 X10.5
+G1 Z-1 F100
+G1 X20 F500
+G0 Z5
+G0 X50 Y50
+G1 Z-1 F100
+G1 X60 F500
+G0 Z5
+G0 X0 Y0
+'''
+    original = GCodeParser().parse(source)
+    hops = RetractSaver(1.0)
+    optimized = optimize(source, hops)
+    assert (hops.removed, hops.lifted) == (1, 12.0)
+    assert moves(optimized)[-1][3] == moves(original)[-1][3]
+    # The hop is cut at depth, at the feedrate the plunge left
+    assert cuts(optimized) == sorted(cuts(original) + [(1, 100, (10.0, 0.0, -1.0), (10.5, 0.0, -1.0), None)])
+
+def test_retract_saver_stays_down_along_earlier_cuts():
+    source = '''G21 G90
+G0 Z5
+G0 X0 Y0
+G1 Z-1 F100
+G1 X20 F500
+G0 Z5
+G0 X5
+G1 Z-1 F100
+G1 Y10 F500
+G0 Z5
+G0 Y30
+G1 Z-1 F100
+G1 X10 F500
+G0 Z5
+'''
+    hops = RetractSaver(1.0)
+    optimized = optimize(source, hops)
+    # Back along the cut at Y0, but not on across uncut stock to Y30
+    assert hops.removed == 1
+    assert (1, 100, (20.0, 0.0, -1.0), (5.0, 0.0, -1.0), None) in cuts(optimized)
+
+def test_retract_saver_keeps_every_cut():
+    for seed in range(10):
+        source = job(random.Random(seed))
+        original = GCodeParser().parse(source)
+        hops = RetractSaver(1.0)
+        optimized = optimize(source, hops)
+        added = list(cuts(optimized))
+        for cut in cuts(original):
+            added.remove(cut)
+        assert len(added) == hops.removed
+        assert all(planar(start, end) <= 1.0 for motion, feed, start, end, center in added)
+        assert moves(optimized)[-1][3] == moves(original)[-1][3]
+
+def test_air_move_promoter_keeps_every_cut():
+    for seed in range(10):
+        source = job(random.Random(seed))
+        original = GCodeParser().parse(source)
+        promoter = AirMovePromoter(0.5)
+        optimized = optimize(source, promoter)
+
+        def air(move):
+            return move[2][2] > 0.5 and move[3][2] > 0.5
+        assert not any(air(move) for move in feed_moves(optimized))
+        assert [move for move in feed_moves(optimized) if not air(move)] == \
+            [move for move in feed_moves(original) if not air(move)]
+        assert moves(optimized)[-1][3] == moves(original)[-1][3]
+
+        promoted = [move for move in feed_moves(original) if air(move)]
+        assert promoter.promoted == len(promoted) > 0
+        assert promoter.promoted_length == pytest.approx(
+            sum(sqrt(sum((b - a) ** 2 for a, b in zip(start, end))) for motion, feed, start, end, center in promoted))
+
+def test_air_move_promoter_restates_what_later_moves_rely_on():
+    source = 'G21 G90\nG0 X0 Y0 Z5\nG1 Z2 F300\nX10\nZ-1\nX20\nG0 Z5\n'
+    promoter = AirMovePromoter(0.5)
+    optimized = optimize(source, promoter)
+    assert promoter.promoted == 2
+    # The plunge still feeds, at the feedrate set above the stock
+    assert feed_moves(optimized) == [(1, 300, (10.0, 0.0, -1.0), (20.0, 0.0, -1.0), None),
+                                     (1, 300, (10.0, 0.0, 2.0), (10.0, 0.0, -1.0), None)]
+
+def test_air_move_promoter_keeps_the_path_around_detours():
+    source = 'G21 G90\nG0 X0 Y0 Z5\nG1 Z2 F300\nX50 Y0\nX50 Y50\nX0 Y50\nX0 Y60\nX0 Y70\nG1 Z-1\n'
+    optimized = optimize(source, AirMovePromoter(0.5))
+    # Every corner stays, only the point on the way from X0 Y50 to X0 Y70 goes
+    assert path(optimized) == [(0, 0, 0), (0, 0, 5), (0, 0, 2), (50, 0, 2), (50, 50, 2), (0, 50, 2), (0, 70, 2), (0, 70, -1)]
+    assert [move[0] for move in moves(optimized)] == [0, 0, 0, 0, 0, 0, 1]
+
+def test_passes_run_as_one_pipeline():
+    def passes():
+        return [CommentRemover(), FileMarkRemover(), CodeSaver(), EmptyMoveRemover(), GrblCleaner(),
+                FeedratePatcher(), MPatcher(), EmptyStatementRemover()]
+    source = '(job)\n%\n' + job(random.Random(5), 20)
+    one_by_one = GCodeParser().parse(source)
+    for p in passes():
+        one_by_one = p.optimize(one_by_one)
+
+    read = []
+    def statements():
+        for statement in GCodeParser().parse(source):
+            read.append(statement)
+            yield statement
+    pipeline = Optimizer(*passes()).iter_optimize(statements())
+    first = next(pipeline)
+    # Statements come out before the whole job has been read
+    assert len(read) < 10
+    assert [str(s) for s in [first] + list(pipeline)] == [str(s) for s in one_by_one]
+
+def test_feeding_statements_matches_the_pipeline():
+    source = '(job)\n%\n' + job(random.Random(6), 20)
+    expected = [str(statement) for statement in optimize(source, *default_passes())]
+    optimizer = Optimizer(*default_passes())
+    optimizer.reset()
+    fed = [s for statement in GCodeParser().parse(source) for s in optimizer.feed(statement)] + optimizer.flush()
+    assert [str(statement) for statement in fed] == expected
@@ -0,0 +1,36 @@
+from gcode import GCodeParser, GWireImage
+from optimizer import *
+from test_optimizer import job, default_passes
+import bench
+import parallel
+import random
+import pytest
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    'Splits even small files into chunks, so the tests stay quick'
+    chunks = parallel.chunks
+    monkeypatch.setattr(parallel, 'chunks', lambda path, count: chunks(path, count, 8 * 1024, 2 * 1024))
+
+@pytest.mark.parametrize('corpus', sorted(bench.corpora) + ['islands'])
+def test_parallel_output_matches_serial(tmpdir, small_chunks, corpus):
+    path = str(tmpdir.join(corpus + '.nc'))
+    with open(path, 'wb') as f:
+        if corpus == 'islands':
+            # Islands to reorder, hops to stay down for and moves above the stock
+            f.write(job(random.Random(3), 500).encode('ascii'))
+        else:
+            bench.generate(corpus, 64 * 1024, f)
+
+    serial = Optimizer(*default_passes())
+    with open(path, 'rb') as f:
+        expected = GWireImage(serial.iter_optimize(GCodeParser().iter_parse(f)))
+
+    chunked = Optimizer(*default_passes())
+    program = parallel.parse_and_optimize(path, chunked, 4)
+    assert GWireImage(program).data == expected.data
+
+    # Reports add up the same, whatever the chunks
+    for a, b in zip(serial.optimizers, chunked.optimizers):
+        for name in a.counters:
+            assert getattr(b, name) == pytest.approx(getattr(a, name))
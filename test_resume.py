@@ -0,0 +1,70 @@
+from gcode import GCodeParser, GProgram
+from resume import ModalState, CheckpointIndex, iter_words
+import pytest
+
+source = '''G21 G90 G17
+G55
+M3 S12000
+M8
+G0 Z5
+G0 X10 Y10
+G1 Z-1 F100
+G1 X20 F500
+G2 X30 Y10 I5 J0
+G91
+G1 X5 Y5
+X-5
+G90
+G93
+G1 X40 Y20 F2
+G94
+G1 X50 F300
+Y30
+G0 Z5
+M9
+M5
+G0 X0 Y0
+'''
+
+def program():
+    return GProgram(GCodeParser().parse(source))
+
+def follow(program, state=None):
+    '''The state after every statement that moves, as what the machine does
+    there: the motion, feedrate and position, and the modes they depend on'''
+    state = state or ModalState()
+    moves = []
+    for words, gcodes, mcodes in iter_words(program):
+        state.statement(words, gcodes, mcodes)
+        if any(axis in words for axis in ModalState.axes):
+            moves.append((state.motion, state.feed, tuple(state.position), state.units, state.plane,
+                          state.system, state.inverse, state.spindle, state.speed, state.coolant))
+    return moves, state
+
+def test_checkpoints_match_replaying_from_the_start():
+    index = CheckpointIndex(program(), interval=4)
+    for k in range(len(index.program) + 1):
+        moves, state = follow(index.program.section(0, k))
+        assert vars(index.state(k)) == vars(state)
+
+@pytest.mark.parametrize('k', range(1, len(program())))
+def test_resume_continues_with_the_same_moves(k):
+    index = CheckpointIndex(program(), interval=4)
+    resumed = index.resume(k)
+
+    before, state = follow(index.program.section(0, k))
+    expected, final = follow(index.program.section(k), state)
+    moves, resumed_final = follow(resumed)
+    assert moves[len(moves) - len(expected):] == expected
+    # Bar the motion mode, which the preamble may leave different after the last move
+    resumed_final.motion = final.motion
+    assert vars(resumed_final) == vars(final)
+
+    # The preamble stays at the top of the job until it feeds down where the job went on
+    for move in moves[:len(moves) - len(expected)]:
+        assert move[2][2] in (None, index.top, index.state(k).position[2])
+
+def test_resume_refuses_offsets():
+    index = CheckpointIndex(GProgram(GCodeParser().parse('G21 G90\nG0 X1 Y1 Z1\nG92 X0 Y0\nG0 X2\nG0 X3\n')))
+    with pytest.raises(RuntimeError):
+        index.resume(3)
@@ -0,0 +1,55 @@
+from gcode import GCodeParser
+from source import MappedView, MappedSource
+import random
+import pytest
+
+def text(rng, n, last_newline=True):
+    lines = [b'G1 X%d' % rng.randint(0, 10 ** rng.randint(0, 6)) if rng.random() < 0.9 else b'' for i in range(n)]
+    return b'\n'.join(lines) + (b'\n' if last_newline else b''), lines
+
+@pytest.mark.parametrize('block', [1, 7, 64, 65536])
+@pytest.mark.parametrize('last_newline', [True, False])
+def test_line_index_finds_every_line(block, last_newline):
+    data, lines = text(random.Random(block), 300, last_newline)
+    view = MappedView(data)
+    view.block = block
+    assert view.line_count() == len(lines)
+    for first in (0, 1, 17, 150, 299, 300, 400):
+        assert view.offset(first) == len(b''.join(line + b'\n' for line in lines[:first])[:len(data)])
+        for last in (first, first + 1, first + 40, None):
+            assert view.lines(first, last) == lines[first:last]
+    assert view.head(5) == lines[:5]
+    assert view.tail(5) == lines[-5:]
+    assert view.tail(1000) == lines
+
+def test_views_read_like_files():
+    data = b'G0 X1\nG0 X2\nG0 X3\n'
+    view = MappedView(data).section(1)
+    assert len(view) == 12
+    assert view.read(4) == b'G0 X'
+    assert view.tell() == 4
+    view.seek(-6, 2)
+    assert view.read() == b'G0 X3\n'
+    view.seek(0)
+    view.seek(6, 1)
+    assert view.read(100) == b'G0 X3\n'
+    assert view.read(1) == b''
+
+def test_mapped_files_parse_like_opened_ones(tmpdir):
+    data, lines = text(random.Random(1), 5000, False)
+    path = tmpdir.join('job.nc')
+    path.write(data, 'wb')
+    with open(str(path), 'rb') as f:
+        expected = [str(statement) for statement in GCodeParser().iter_parse(f, 1000)]
+    with MappedSource(str(path)) as source:
+        assert source.name == str(path)
+        assert source.line_count() == 5000
+        assert [str(statement) for statement in GCodeParser().iter_parse(source, 1000)] == expected
+
+def test_empty_files(tmpdir):
+    path = tmpdir.join('empty.nc')
+    path.write(b'', 'wb')
+    with MappedSource(str(path)) as source:
+        assert source.line_count() == 0
+        assert source.read() == b''
+        assert source.tail(3) == [] and source.head(3) == []
@@ -0,0 +1,54 @@
+from telemetry import Histogram, Telemetry
+import json
+import pytest
+
+def test_histogram_percentiles_stay_within_the_ratio():
+    histogram = Histogram(1.1)
+    for k in range(1, 1001):
+        histogram.add(k / 1000.0)
+    for p in (50, 90, 99):
+        assert p / 100.0 <= histogram.percentile(p) <= p / 100.0 * 1.1
+    assert histogram.percentile(100) == histogram.max == 1.0
+    assert histogram.min == 0.001
+    assert histogram.mean == pytest.approx(0.5005)
+
+def test_histogram_of_whole_numbers_is_exact():
+    histogram = Histogram()
+    for value in (3, 1, 4, 1, 5, 9, 2, 6):
+        histogram.add(value)
+    assert [histogram.percentile(p) for p in (25, 50, 75, 100)] == [1, 3, 5, 9]
+    assert Histogram().percentile(50) is None
+
+def clocked():
+    telemetry = Telemetry()
+    clock = [0.0]
+    telemetry.now = lambda: clock[0]
+    return telemetry, clock
+
+def test_lines_and_statuses_are_recorded(tmpdir):
+    telemetry, clock = clocked()
+    telemetry.sent(0)
+    telemetry.sent(1)
+    clock[0] = 0.010
+    telemetry.status({'state': 'Run', 'Buf': (3.0,), 'RX': (20.0,)})
+    clock[0] = 0.020
+    telemetry.answered(0, 10, 25)
+    clock[0] = 0.030
+    telemetry.status({'state': 'Run', 'Bf': (14.0, 100.0)})
+    telemetry.answered(1, 20, 15, ok=False)
+
+    summary = telemetry.summary()
+    assert (summary['lines'], summary['errors'], summary['bytes']) == (2, 1, 30)
+    assert summary['seconds'] == 0.030
+    assert summary['bytes_per_s'] == pytest.approx(1000)
+    assert list(telemetry.latencies) == [0.020, 0.030]
+    assert (summary['planner']['max'], summary['rx']['max']) == (3, 27)
+
+    path = str(tmpdir.join('telemetry.json'))
+    with open(path, 'w') as f:
+        telemetry.dump(f)
+    with open(path) as f:
+        records = [json.loads(line) for line in f]
+    assert [(record['type'], record.get('t')) for record in records] == \
+        [('status', 0.010), ('line', 0.020), ('status', 0.030), ('line', 0.030), ('summary', None)]
+    assert records[1] == {'type': 'line', 't': 0.020, 'line': 0, 'bytes': 10, 'latency': 0.020, 'buffered': 25}